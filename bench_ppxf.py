@@ -0,0 +1,501 @@
+##############################################################################
+#
+# Timing benchmarks for the procedure ppxf, using synthetic spectra.
+#
+# Usage: python bench_ppxf.py
+#
+##############################################################################
+
+from __future__ import print_function
+
+from timeit import default_timer as clock
+
+import numpy as np
+
+import ppxf as ppxf_module
+from ppxf import (ppxf, ppxf_batch, nnls_flags, fft_backend, rfft_cache, prune_templates,
+                  xcorr_kinematics, mc_errors, _convolve_templates, _losvd_kernels)
+from test_ppxf import (synthetic_spectrum, synthetic_batch, synthetic_grid, gaussian_losvd_rfft,
+                       losvd_convolve, sky_residuals, convolve_templates_loop, nnls_flags_doubled, losvd_loop)
+
+#------------------------------------------------------------------------
+
+def timeit(func, nrep=5):
+    """ Best wall-clock time of NREP calls to func() """
+    best = np.inf
+    for j in range(nrep):
+        t = clock()
+        func()
+        best = min(best, clock() - t)
+    return best
+
+#------------------------------------------------------------------------
+
+def bench_convolution(ntemps=(10, 50, 150, 300), npix=3000):
+    """
+    Per-template loop versus batched LOSVD convolution in ppxf._fitfunc
+
+    """
+    print("\nLOSVD convolution of the templates (npix=%d)" % npix)
+    print("%8s %12s %12s %9s" % ("ntemp", "loop [s]", "batch [s]", "speedup"))
+    for ntemp in ntemps:
+        templates, galaxy, noise, velscale = synthetic_spectrum(ntemp=ntemp, npix=npix)
+        pp = ppxf(templates, galaxy, noise, velscale, [100., 100.],
+                  degree=-1, quiet=True)
+        losvd_rfft = gaussian_losvd_rfft(pp, 5.3, 4.1)
+        out = np.empty((npix, ntemp))
+        t_loop = timeit(lambda: convolve_templates_loop(pp, losvd_rfft))
+        t_batch = timeit(lambda: _convolve_templates(
+            pp.star_rfft, losvd_rfft[:, None, None], pp.comp_index,
+            pp.npad, pp.factor, 1., out))
+        print("%8d %12.4f %12.4f %9.1f" % (ntemp, t_loop, t_batch, t_loop/t_batch))
+
+#------------------------------------------------------------------------
+
+def bench_losvd(cases=([4], [4, 2], [4, 2, 2], [6, 4, 2]), dx=60, factor=1):
+    """
+    LOSVDs evaluated one kinematic component and side at a time versus all
+    together, for one-sided (nspec=1) and two-sided (nspec=2) fitting
+
+    """
+    print("\nLOSVD construction (%d samples)" % (2*dx*factor + 1))
+    print("%12s %6s %12s %12s %9s" % ("moments", "nspec", "loop [us]", "batch [us]", "speedup"))
+    x = np.linspace(-dx, dx, 2*dx*factor + 1)
+    for moments in cases:
+        pars = np.concatenate([[3., 4., 0.05, -0.04, 0.03, 0.02][:mj] for mj in moments])
+        for nspec in [1, 2]:
+            t_loop = timeit(lambda: [losvd_loop(pars, moments, 2.5, x, nspec) for j in range(100)])/100
+            t_batch = timeit(lambda: [_losvd_kernels(pars, moments, 2.5, x, nspec) for j in range(100)])/100
+            print("%12s %6d %12.1f %12.1f %9.1f" % (moments, nspec, t_loop*1e6, t_batch*1e6, t_loop/t_batch))
+
+#------------------------------------------------------------------------
+
+def bench_nnls(ntemps=(50, 150, 300), npix=3000):
+    """
+    NNLS with doubled polynomial columns versus the active-set solver,
+    from a cold start and warm started from the final passive set
+
+    """
+    print("\nNNLS of the final ppxf design matrix (npix=%d, degree=8)" % npix)
+    print("%8s %12s %12s %12s" % ("ntemp", "doubled [s]", "cold [s]", "warm [s]"))
+    for ntemp in ntemps:
+        templates, galaxy, noise, velscale = synthetic_spectrum(ntemp=ntemp, npix=npix)
+        pp = ppxf(templates, galaxy, noise, velscale, [100., 100.],
+                  degree=8, moments=4, quiet=True)
+        A = pp.matrix/noise[:, None]
+        b = galaxy/noise
+        flag = np.arange(A.shape[1]) < 9
+        t_doubled = timeit(lambda: nnls_flags_doubled(A, b, flag), nrep=3)
+        t_cold = timeit(lambda: nnls_flags(A, b, flag), nrep=3)
+        t_warm = timeit(lambda: nnls_flags(A, b, flag, pp.passive), nrep=3)
+        print("%8d %12.4f %12.4f %12.4f" % (ntemp, t_doubled, t_cold, t_warm))
+
+#------------------------------------------------------------------------
+
+def bench_fitfunc(ntemps=(10, 50, 150), npix=3000, ncalls=50):
+    """
+    Time and peak memory allocated per ppxf._fitfunc call, the inner loop
+    of the MPFIT optimization
+
+    """
+    import tracemalloc  # Python 3 only
+
+    print("\nppxf._fitfunc calls (npix=%d, moments=4, mdegree=5)" % npix)
+    print("%8s %12s %12s" % ("ntemp", "time [ms]", "peak [MB]"))
+    for ntemp in ntemps:
+        templates, galaxy, noise, velscale = synthetic_spectrum(ntemp=ntemp, npix=npix)
+        pp = ppxf(templates, galaxy, noise, velscale, [100., 100.],
+                  moments=4, mdegree=5, quiet=True)
+        pars = np.array([7.5, 6., 0.05, -0.03, 0.01, -0.01, 0.02, 0.01, -0.02])
+        pp._fitfunc(pars)
+        t = timeit(lambda: [pp._fitfunc(pars) for j in range(ncalls)], nrep=3)
+        tracemalloc.start()
+        pp._fitfunc(pars)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print("%8d %12.2f %12.1f" % (ntemp, t/ncalls*1e3, peak/2.**20))
+
+#------------------------------------------------------------------------
+
+def bench_fft(cases=((4000, 50), (8400, 50), (8400, 150)), workers=4):
+    """
+    Fit time with the FFT length rounded up to a power of two (as in
+    pPXF V5.1.16) and to the next 5-smooth number, with the FFT backends.
+    npix=8400 corresponds to 4000-7000A at velscale=20km/s
+
+    """
+    pow2 = lambda n: int(2**np.ceil(np.log2(n)))
+    backends = [('numpy pow2', 'numpy', 1, pow2), ('numpy', 'numpy', 1, None),
+                ('scipy', 'scipy', 1, None), ('scipy x%d' % workers, 'scipy', workers, None)]
+    try:
+        import pyfftw
+        backends.append(('pyfftw x%d' % workers, 'pyfftw', workers, None))
+    except ImportError:
+        pass
+
+    print("\nppxf fits (moments=4, mdegree=5) with different FFT lengths and backends")
+    print("%8s %8s %8s" % ("npix", "ntemp", "npad") + "".join("%13s" % b[0] for b in backends) + "   [s]")
+    fast_fft_length = ppxf_module.fast_fft_length
+    for npix, ntemp in cases:
+        templates, galaxy, noise, velscale = synthetic_spectrum(ntemp=ntemp, npix=npix)
+        times = []
+        for name, backend, nthreads, length in backends:
+            ppxf_module.fast_fft_length = length or fast_fft_length
+            try:
+                fft = fft_backend(backend, workers=nthreads)
+                times.append(timeit(lambda: ppxf(templates, galaxy, noise, velscale, [100., 100.],
+                                                 moments=4, mdegree=5, quiet=True, fft=fft), nrep=3))
+            finally:
+                ppxf_module.fast_fft_length = fast_fft_length
+        npad = ppxf(templates, galaxy, noise, velscale, [100., 100.], quiet=True).npad
+        print("%8d %8d %8d" % (npix, ntemp, npad) + "".join("%13.3f" % t for t in times))
+
+#------------------------------------------------------------------------
+
+def accuracy_float32(snr=(10, 30, 100), nspec=20, npix=8400, ntemp=50):
+    """
+    Differences of the kinematics (V, sigma, h3, h4) fitted with FLOAT32
+    with respect to double precision, in units of the formal errors, for
+    NSPEC spectra at each signal-to-noise ratio SNR
+
+    """
+    import tracemalloc  # Python 3 only
+
+    print("\nppxf FLOAT32 accuracy (npix=%d, ntemp=%d, moments=4, %d spectra)" % (npix, ntemp, nspec))
+    print("%6s %10s" % ("S/N", "") + "".join("%10s" % p for p in ["V", "sigma", "h3", "h4"]))
+    for sn in snr:
+        diff = []
+        for seed in range(nspec):
+            templates, galaxy, noise, velscale = synthetic_spectrum(
+                ntemp=ntemp, npix=npix, noise=1./sn, seed=seed)
+            pp = [ppxf(templates, galaxy, noise, velscale, [100., 100.], moments=4,
+                       mdegree=5, quiet=True, float32=single) for single in [False, True]]
+            diff.append((pp[1].sol - pp[0].sol)/pp[0].error)
+        diff = np.abs(diff)
+        print("%6d %10s" % (sn, "median") + "".join("%10.1e" % d for d in np.median(diff, 0)))
+        print("%6s %10s" % ("", "max") + "".join("%10.1e" % d for d in diff.max(0)))
+
+    print("\nTime and peak memory of one fit (S/N=30)")
+    print("%10s %12s %12s" % ("", "time [s]", "peak [MB]"))
+    for single in [False, True]:
+        fit = lambda: ppxf(templates, galaxy, noise, velscale, [100., 100.], moments=4,
+                           mdegree=5, quiet=True, float32=single)
+        t = timeit(fit, nrep=3)
+        tracemalloc.start()
+        fit()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print("%10s %12.3f %12.1f" % ("float32" if single else "float64", t, peak/2.**20))
+
+#------------------------------------------------------------------------
+
+def bench_batch(cases=((1500, 10), (4000, 50), (8400, 50), (8400, 150)), nspec=32):
+    """
+    NSPEC spectra fitted one at a time with ppxf, sharing the template
+    FFTs through rfft_cache, versus a single ppxf_batch call
+
+    """
+    print("\n%d spectra fitted with ppxf and ppxf_batch (moments=4, mdegree=5)" % nspec)
+    print("%8s %8s %12s %12s %9s" % ("npix", "ntemp", "ppxf [s]", "batch [s]", "speedup"))
+    for npix, ntemp in cases:
+        templates, galaxy, noise, velscale = synthetic_batch(nspec, ntemp, npix)
+        cache = rfft_cache()
+        t_loop = timeit(lambda: [ppxf(templates, galaxy[:, j], noise[:, j], velscale, [100., 100.],
+                                      moments=4, mdegree=5, quiet=True, rfft_cache=cache)
+                                 for j in range(nspec)], nrep=1)
+        t_batch = timeit(lambda: ppxf_batch(templates, galaxy, noise, velscale, [100., 100.],
+                                            moments=4, mdegree=5, quiet=True), nrep=1)
+        print("%8d %8d %12.2f %12.2f %9.1f" % (npix, ntemp, t_loop, t_batch, t_loop/t_batch))
+
+#------------------------------------------------------------------------
+
+def bench_parallel_jacobian(cases=((4000, 50), (8400, 150)), workers=(2, 4)):
+    """
+    Fit time with finite-difference derivatives (AUTODERIVATIVE), with the
+    model evaluations of each Jacobian computed serially or by a thread pool.
+    Two components, moments=[4, 2] and mdegree=15 give 21 columns
+
+    """
+    from concurrent.futures import ThreadPoolExecutor  # Python 3 only
+
+    print("\nppxf fits with AUTODERIVATIVE (moments=[4, 2], mdegree=15)")
+    print("%8s %8s %12s" % ("npix", "ntemp", "serial") + "".join("%12s" % ("x%d" % n) for n in workers) + "   [s]")
+    for npix, ntemp in cases:
+        templates, galaxy, noise, velscale = synthetic_spectrum(ntemp=ntemp, npix=npix, ngas=3)
+        kwargs = dict(moments=[4, 2], component=[0]*ntemp + [1]*3, mdegree=15,
+                      quiet=True, autoderivative=True)
+        fit = lambda executor=None: ppxf(templates, galaxy, noise, velscale, [[100., 100.], [100., 50.]],
+                                         executor=executor, **kwargs)
+        times = [timeit(fit, nrep=1)]
+        for n in workers:
+            with ThreadPoolExecutor(n) as executor:
+                times.append(timeit(lambda: fit(executor), nrep=1))
+        print("%8d %8d" % (npix, ntemp) + "".join("%12.2f" % t for t in times))
+
+#------------------------------------------------------------------------
+
+def bench_lapack(mdegrees=(5, 15, 30), npix=4000, ntemp=50):
+    """
+    Fit time with the MINPACK translation and the LAPACK routines for the
+    QR factorizations of MPFIT, for an increasing number of parameters
+
+    """
+    print("\nppxf fits with MPFIT LAPACK=0/1 (npix=%d, ntemp=%d, moments=[4, 2])" % (npix, ntemp))
+    print("%8s %8s %12s %12s %9s" % ("mdegree", "npars", "minpack [s]", "lapack [s]", "speedup"))
+    templates, galaxy, noise, velscale = synthetic_spectrum(ntemp=ntemp, npix=npix, ngas=3)
+    for mdegree in mdegrees:
+        fit = lambda lapack: ppxf(templates, galaxy, noise, velscale, [[100., 100.], [100., 50.]],
+                                  moments=[4, 2], component=[0]*ntemp + [1]*3, mdegree=mdegree,
+                                  quiet=True, lapack=lapack)
+        t = [timeit(lambda: fit(lapack), nrep=3) for lapack in [False, True]]
+        print("%8d %8d %12.3f %12.3f %9.2f" % (mdegree, 6 + mdegree, t[0], t[1], t[0]/t[1]))
+
+#------------------------------------------------------------------------
+
+def bench_optimizers(nspec=10, npix=4000, ntemp=30, sn=30):
+    """
+    Number of model evaluations, fit time and differences of the kinematics,
+    in units of the formal errors, between the MPFIT and least_squares
+    optimizers, for NSPEC spectra and some typical settings
+
+    """
+    print("\nppxf OPTIMIZER='mpfit' versus 'least_squares' (npix=%d, ntemp=%d, S/N=%d, %d spectra)"
+          % (npix, ntemp, sn, nspec))
+    print("%22s %14s %14s %12s" % ("", "nfev", "time [s]", "max|dsol|"))
+    cases = [("moments=2", dict(moments=2)), ("moments=4", dict(moments=4)),
+             ("moments=4 mdegree=15", dict(moments=4, mdegree=15)),
+             ("two components", dict(moments=[4, 2], mdegree=15, component=[0]*ntemp + [1]*3)),
+             ("autoderivative", dict(moments=4, mdegree=8, autoderivative=True))]
+    for name, kwargs in cases:
+        nfev, times, diff = [], [], []
+        for seed in range(nspec):
+            templates, galaxy, noise, velscale = synthetic_spectrum(
+                ntemp=ntemp, npix=npix, noise=1./sn, seed=seed, ngas=3 if 'component' in kwargs else 0)
+            start = [[100., 100.], [100., 50.]] if 'component' in kwargs else [100., 100.]
+            pp = []
+            for opt in ['mpfit', 'least_squares']:
+                t = clock()
+                pp.append(ppxf(templates, galaxy, noise, velscale, start, quiet=True,
+                               optimizer=opt, **kwargs))
+                times.append(clock() - t)
+                nfev.append(pp[-1].nfev)
+            diff.append(np.max(np.abs(np.hstack(pp[1].sol) - np.hstack(pp[0].sol))/np.hstack(pp[0].error)))
+        nfev, times = [np.mean(np.reshape(a, (nspec, 2)), 0) for a in [nfev, times]]
+        print("%22s %7.1f%7.1f %7.3f%7.3f %12.2g" % (name, nfev[0], nfev[1], times[0], times[1], np.max(diff)))
+
+#------------------------------------------------------------------------
+
+def bench_analytic_losvd(npix=4000, ntemp=30, sn=300):
+    """
+    Time of one model evaluation with the LOSVD sampled in pixels and
+    transformed with an FFT, versus evaluated analytically in Fourier space,
+    and recovery of the kinematics when sigma < velscale, compared to OVERSAMPLE
+
+    """
+    print("\nppxf ANALYTIC_LOSVD (npix=%d, ntemp=%d)" % (npix, ntemp))
+    print("%22s %12s %14s %9s" % ("", "FFT [ms]", "analytic [ms]", "speedup"))
+    templates, galaxy, noise, velscale = synthetic_spectrum(ntemp=ntemp, npix=npix, seed=1)
+    cases = [("moments=2", dict(moments=2), [150., 120.]),
+             ("moments=4", dict(moments=4), [150., 120., 0.05, -0.03]),
+             ("moments=4 sigma=400", dict(moments=4), [150., 400., 0.05, -0.03]),
+             ("moments=6 oversample", dict(moments=6, oversample=True), [150., 120., 0.05, -0.03, 0., 0.])]
+    for name, kwargs, sol in cases:
+        t = []
+        for analytic in [False, True]:
+            pp = ppxf(templates, galaxy, noise, velscale, sol[:2], quiet=True,
+                      analytic_losvd=analytic, **kwargs)
+            pars = np.array(sol)/np.append([velscale]*2, [1]*(len(sol) - 2))
+            t.append(timeit(lambda: [pp._fitfunc(pars) for j in range(10)])/10)
+        print("%22s %12.2f %14.2f %9.2f" % (name, t[0]*1e3, t[1]*1e3, t[0]/t[1]))
+
+    print("\nRecovered [V, sigma] for V=7, sigma < velscale=%g (S/N=%d)" % (velscale, sn))
+    print("%8s %22s %22s %22s" % ("sigma", "default", "oversample", "analytic"))
+    spectrum = templates.dot(np.random.RandomState(1).uniform(0, 1, ntemp))
+    omega = 2*np.pi*np.fft.rfftfreq(spectrum.size)
+    noise = np.full(npix, 1./sn)
+    goodpixels = np.arange(50, npix - 50)
+    for sigma in [24., 16., 12., 8., 6.]:
+        galaxy = np.fft.irfft(np.fft.rfft(spectrum)*np.exp(-1j*omega*7./velscale - 0.5*(omega*sigma/velscale)**2),
+                              spectrum.size)[:npix]
+        galaxy += np.random.RandomState(2).normal(0, noise)
+        out = []
+        for kwargs in [dict(), dict(oversample=True), dict(analytic_losvd=True)]:
+            pp = ppxf(templates, galaxy, noise, velscale, [0., 20.], quiet=True,
+                      goodpixels=goodpixels, **kwargs)
+            out.append("%6.2f %6.2f (%5.2f)" % (pp.sol[0], pp.sol[1], pp.error[1]))
+        print("%8g %22s %22s %22s" % tuple([sigma] + out))
+
+#------------------------------------------------------------------------
+
+def bench_pruning(nspec=5, npix=4000, nage=15, nmetal=7, ngas=3, sn=50):
+    """
+    Time of the second fit of run_ppxf with all the templates versus only
+    the templates selected by prune_templates from the first fit, and
+    differences of the kinematics in units of the formal errors
+
+    """
+    print("\nTemplate pruning before the second fit (npix=%d, %dx%d grid + %d gas, S/N=%d, %d spectra)"
+          % (npix, nage, nmetal, ngas, sn, nspec))
+    print("%12s %10s %12s %12s %9s %12s" % ("neighbours", "ntemp", "full [s]", "pruned [s]", "speedup", "max|dsol|"))
+    start = [[100., 100.], [100., 50.]]
+    kwargs = dict(moments=[4, 2], degree=10, quiet=True)
+    for neighbours in [0, 1, 2]:
+        ntemp, times, diff = [], [], []
+        for seed in range(nspec):
+            templates, grid, galaxy, noise, velscale = synthetic_grid(
+                nage, nmetal, npix, ngas=ngas, noise=1./sn, seed=seed)
+            component = np.append(np.zeros(nage*nmetal, dtype=int), np.ones(ngas, dtype=int))
+            pp0 = ppxf(templates, galaxy, noise, velscale, start, component=component, **kwargs)
+            keep = prune_templates(pp0.weights, grid, neighbours)
+            t = clock()
+            pp = ppxf(templates, galaxy, noise, velscale, start, component=component, **kwargs)
+            t1 = clock()
+            pp1 = ppxf(templates[:, keep], galaxy, noise, velscale, start,
+                       component=component[keep], **kwargs)
+            times.append([t1 - t, clock() - t1])
+            ntemp.append(keep.size)
+            diff.append(np.max(np.abs(np.hstack(pp1.sol) - np.hstack(pp.sol))/np.hstack(pp.error)))
+        times = np.mean(times, 0)
+        print("%12d %10.1f %12.3f %12.3f %9.1f %12.2g" % (neighbours, np.mean(ntemp), times[0], times[1],
+                                                         times[0]/times[1], np.max(diff)))
+
+#------------------------------------------------------------------------
+
+def bench_eigen_templates(nspec=5, npix=4000, nage=15, nmetal=7, sn=50):
+    """
+    Fit time and differences of the kinematics, in units of the formal
+    errors, between the nonnegative fit of the full library and the
+    fits with NBASIS eigen-templates (EIGEN_TEMPLATES=True)
+
+    """
+    print("\nppxf EIGEN_TEMPLATES (npix=%d, %dx%d grid, S/N=%d, %d spectra)" % (npix, nage, nmetal, sn, nspec))
+    print("%8s %12s %12s %9s %12s %9s" % ("nbasis", "residual", "time [s]", "speedup", "max|dsol|", "positive"))
+    nbasis = [2, 3, 5, 10]
+    times, diff, positive, resid = np.zeros((4, len(nbasis) + 1, nspec))
+    for seed in range(nspec):
+        templates, grid, galaxy, noise, velscale = synthetic_grid(nage, nmetal, npix, noise=1./sn, seed=seed)
+        u, s, vt = np.linalg.svd(templates, full_matrices=False)
+        t = clock()
+        pp0 = ppxf(templates, galaxy, noise, velscale, [100., 100.], moments=4, quiet=True)
+        times[0, seed] = clock() - t
+        for j, k in enumerate(nbasis):
+            t = clock()
+            pp = ppxf(u[:, :k]*s[:k], galaxy, noise, velscale, [100., 100.], moments=4,
+                      quiet=True, eigen_templates=True)
+            times[j + 1, seed] = clock() - t
+            diff[j + 1, seed] = np.max(np.abs(pp.sol - pp0.sol)/pp0.error)
+            positive[j + 1, seed] = pp.positive
+            resid[j + 1, seed] = np.sqrt(np.sum(s[k:]**2)/np.sum(s**2))
+    times = times.mean(1)
+    print("%8s %12s %12.3f %9s %12s %9s" % (nage*nmetal, "(NNLS)", times[0], "", "", ""))
+    for j, k in enumerate(nbasis):
+        print("%8d %12.2g %12.3f %9.1f %12.2g %9.1f" % (k, resid[j + 1].max(), times[j + 1],
+              times[0]/times[j + 1], diff[j + 1].max(), positive[j + 1].mean()))
+
+#------------------------------------------------------------------------
+
+def bench_xcorr(nspec=20, npix=3000, ntemp=20, sn=30):
+    """
+    Number of model evaluations and fraction of fits converging to a wrong
+    minimum, for ppxf started from a fixed guess versus from the FFT
+    cross-correlation, for spectra with random velocities |V| < 1500 km/s
+
+    """
+    print("\nppxf started from xcorr_kinematics (npix=%d, ntemp=%d, S/N=%d, %d spectra)" % (npix, ntemp, sn, nspec))
+    rng = np.random.RandomState(0)
+    sols = np.column_stack([rng.uniform(-1500, 1500, nspec), rng.uniform(40, 300, nspec)])
+    templates, gal, noise, velscale = synthetic_spectrum(ntemp=ntemp, npix=npix, noise=1./sn)
+    galaxy = np.column_stack([losvd_convolve(templates.dot(rng.uniform(0, 1, ntemp)), tuple(sol) + (0.03, -0.02),
+                                             velscale)[:npix] for sol in sols])
+    galaxy += rng.normal(0, 1./sn, galaxy.shape)
+    cache = rfft_cache()
+    t = timeit(lambda: xcorr_kinematics(templates, galaxy, velscale, cache=cache), 3)
+    start, verr, r = xcorr_kinematics(templates, galaxy, velscale, cache=cache)
+    print("xcorr: %.2f ms per spectrum, median |dV| = %.1f km/s, median |dsigma|/sigma = %.2f"
+          % (t/nspec*1e3, np.median(np.abs(start[0] - sols[:, 0])),
+             np.median(np.abs(start[1] - sols[:, 1])/sols[:, 1])))
+    print("%16s %10s %10s %10s" % ("start", "nfev", "time [s]", "wrong"))
+    for name in ["[0, 50]", "xcorr"]:
+        nfev, wrong = [], 0
+        t = clock()
+        for j, sol in enumerate(sols):
+            st = [0., 50.] if name == "[0, 50]" else start[:, j]
+            pp = ppxf(templates, galaxy[:, j], noise, velscale, st, moments=4, quiet=True, rfft_cache=cache)
+            nfev.append(pp.nfev)
+            wrong += np.any(np.abs(pp.sol[:2] - sol) > 5*pp.error[:2])
+        print("%16s %10.1f %10.3f %10d" % (name, np.mean(nfev), clock() - t, wrong))
+
+#------------------------------------------------------------------------
+
+def bench_clean(nspec=8, npix=3000, ntemp=20, sn=50):
+    """
+    Time of the fits with CLEAN of spectra with sky residuals at 5577A and
+    cosmic rays, compared to a single fit without CLEAN, and differences of
+    the kinematics, in units of the formal errors, from a fit without CLEAN
+    of the final GOODPIXELS
+
+    """
+    print("\nppxf CLEAN with sky residuals (npix=%d, ntemp=%d, S/N=%d, %d spectra)" % (npix, ntemp, sn, nspec))
+    print("%6s %12s %12s %10s %12s" % ("seed", "clean [s]", "single [s]", "clipped", "max|dsol|"))
+    kwargs = dict(moments=4, mdegree=4, quiet=True)
+    for seed in range(nspec):
+        templates, galaxy, noise, velscale = synthetic_spectrum(ntemp=ntemp, npix=npix, noise=1./sn, seed=seed)
+        lam, galaxy = sky_residuals(galaxy, velscale, amplitude=np.random.uniform(0.1, 0.4), seed=seed)
+        t_clean = timeit(lambda: ppxf(templates, galaxy, noise, velscale, [100., 100.], clean=True, **kwargs), 3)
+        pp = ppxf(templates, galaxy, noise, velscale, [100., 100.], clean=True, **kwargs)
+        t_single = timeit(lambda: ppxf(templates, galaxy, noise, velscale, [100., 100.], **kwargs), 3)
+        pp0 = ppxf(templates, galaxy, noise, velscale, [100., 100.], goodpixels=pp.goodpixels, **kwargs)
+        print("%6d %12.3f %12.3f %10d %12.2g" % (seed, t_clean, t_single, npix - pp.goodpixels.size,
+                                               np.max(np.abs(pp.sol - pp0.sol)/pp0.error)))
+
+#------------------------------------------------------------------------
+
+def bench_mc_errors(nsim=200, npix=3000, ntemp=10, sn=50):
+    """
+    Monte Carlo errors from NSIM separate ppxf fits of noisy realizations
+    of a best fit, as in run_ppxf.pPXF.mc_errors before, versus mc_errors
+    with all the realizations and with early stopping
+
+    """
+    print("\nMonte Carlo errors (npix=%d, ntemp=%d, S/N=%d, nsim=%d)" % (npix, ntemp, sn, nsim))
+    print("%10s %10s %8s %32s" % ("", "time [s]", "nfit", "errors V, sigma, h3, h4"))
+    templates, galaxy, noise, velscale = synthetic_spectrum(ntemp=ntemp, npix=npix, noise=1./sn)
+    kwargs = dict(moments=4, degree=-1, mdegree=4)
+    pp = ppxf(templates, galaxy, noise, velscale, [100., 100.], quiet=True, **kwargs)
+    start = pp.sol[:2]
+    rng = np.random.RandomState(1)
+
+    def serial():
+        sol = [ppxf(templates, pp.bestfit + noise*rng.standard_normal(npix), noise, velscale, start,
+                    quiet=True, **kwargs).sol for j in range(nsim)]
+        return 1.4826*np.median(np.abs(sol - np.median(sol, 0)), 0), sol
+
+    for name, func in [("serial", serial),
+                       ("batch", lambda: mc_errors(templates, pp.bestfit, noise, velscale, start,
+                                                   nsim=nsim, seed=1, **kwargs)),
+                       ("rtol=0.1", lambda: mc_errors(templates, pp.bestfit, noise, velscale, start,
+                                                      nsim=nsim, seed=1, rtol=0.1, **kwargs))]:
+        t = clock()
+        error, sol = func()
+        print("%10s %10.2f %8d %32s" % (name, clock() - t, len(sol),
+                                        " ".join("%7.3g" % e for e in error)))
+
+#------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    bench_convolution()
+    bench_losvd()
+    bench_nnls()
+    bench_fitfunc()
+    bench_fft()
+    accuracy_float32()
+    bench_batch()
+    bench_parallel_jacobian()
+    bench_lapack()
+    bench_optimizers()
+    bench_analytic_losvd()
+    bench_pruning()
+    bench_eigen_templates()
+    bench_xcorr()
+    bench_clean()
+    bench_mc_errors()
@@ -603,6 +603,17 @@ import numpy
 def norm(x): # Euclidean norm
     return numpy.sqrt(numpy.sum(x**2))
 
+def _call_fcn(args):
+    """
+    Evaluate the user function at one point of the numerical derivatives.
+    This is a module-level function, so that it can be sent to a process pool
+    """
+    fcn, x, functkw, damp = args
+    [status, f] = fcn(x, fjac=None, **functkw)
+    if damp > 0:
+        f = numpy.tanh(f/damp)
+    return [status, f]
+
 class mpfit:
 
     def __init__(self, fcn, xall=None, functkw={}, parinfo=None,
@@ -610,7 +621,7 @@ class mpfit:
                  damp=0., maxiter=200, factor=100., nprint=1,
                  iterfunct='default', iterkw={}, nocovar=0,
                  rescale=0, autoderivative=1, quiet=0,
-                 diag=None, epsfcn=None, debug=0):
+                 diag=None, epsfcn=None, debug=0, executor=None, lapack=0):
         """
   Inputs:
     fcn:
@@ -635,6 +646,26 @@ class mpfit:
            NOTE: to supply your own analytical derivatives,
                  explicitly pass autoderivative=0
 
+     executor:
+        An object with a map(func, iterable) method returning the results in
+        order, like concurrent.futures.ThreadPoolExecutor/ProcessPoolExecutor
+        or multiprocessing.Pool. When given, the function evaluations of the
+        finite-difference derivatives (one or two per free parameter) are
+        computed concurrently with executor.map. The derivatives are the same
+        as the serial ones, as long as FCN only depends on its arguments.
+        With a process pool FCN and FUNCTKW must be picklable.
+           Default: None (serial evaluations)
+
+     lapack:
+        If set, the pivoted QR factorization of the Jacobian (qrfac) and the
+        solution of the Levenberg-Marquardt subproblem (qrsolv, lmpar) are
+        computed with the LAPACK routines of scipy.linalg, instead of the
+        Python loops of the MINPACK translation. The two versions implement
+        the same algorithm and follow the same sequence of iterations, apart
+        from rounding differences. This is faster for problems with many
+        residuals or parameters and requires Scipy.
+           Default: clear (=0)
+
      ftol:
         A nonnegative input variable. Termination occurs when both the actual
         and predicted relative reductions in the sum of squares are at most
@@ -855,6 +886,8 @@ class mpfit:
         self.errmsg = ''
         self.nfev = 0
         self.damp = damp
+        self.executor = executor
+        self.lapack = lapack
         self.dof = 0
 
         if fcn==None:
@@ -1093,7 +1126,10 @@ class mpfit:
                             fjac[:,whupeg[i]] = 0
 
             # Compute the QR factorization of the jacobian
-            [fjac, ipvt, wa1, wa2] = self.qrfac(fjac, pivot=1)
+            if self.lapack:
+                [fjac, ipvt, wa1, wa2, qtf] = self.qrfac_lapack(fjac, fvec)
+            else:
+                [fjac, ipvt, wa1, wa2] = self.qrfac(fjac, pivot=1)
 
             # On the first iteration if "diag" is unspecified, scale
             # according to the norms of the columns of the initial jacobian
@@ -1112,20 +1148,22 @@ class mpfit:
                     delta = factor
 
             # Form (q transpose)*fvec and store the first n components in qtf
+            # (with LAPACK this was done by qrfac_lapack)
             catch_msg = 'forming (q transpose)*fvec'
-            wa4 = fvec.copy()
-            for j in range(n):
-                lj = ipvt[j]
-                temp3 = fjac[j,lj]
-                if temp3 != 0:
-                    fj = fjac[j:,lj]
-                    wa4[j:] -= fj * numpy.sum(fj*wa4[j:]) / temp3
-                fjac[j,lj] = wa1[j]
-                qtf[j] = wa4[j]
-            # From this point on, only the square matrix, consisting of the
-            # triangle of R, is needed.
-            fjac = fjac[:n, :n]
-            fjac = fjac[:, ipvt]
+            if not self.lapack:
+                wa4 = fvec.copy()
+                for j in range(n):
+                    lj = ipvt[j]
+                    temp3 = fjac[j,lj]
+                    if temp3 != 0:
+                        fj = fjac[j:,lj]
+                        wa4[j:] -= fj * numpy.sum(fj*wa4[j:]) / temp3
+                    fjac[j,lj] = wa1[j]
+                    qtf[j] = wa4[j]
+                # From this point on, only the square matrix, consisting of the
+                # triangle of R, is needed.
+                fjac = fjac[:n, :n]
+                fjac = fjac[:, ipvt]
 
             # Check for overflow.  This should be a cheap test here since FJAC
             # has been reduced to a (small) square matrix, and the test is
@@ -1160,8 +1198,9 @@ class mpfit:
 
                 # Determine the levenberg-marquardt parameter
                 catch_msg = 'calculating LM parameter (MPFIT_)'
-                [fjac, par, wa1, wa2] = self.lmpar(fjac, ipvt, diag, qtf,
-                                                     delta, wa1, wa2, par=par)
+                lmpar = self.lmpar_lapack if self.lapack else self.lmpar
+                [fjac, par, wa1, wa2] = lmpar(fjac, ipvt, diag, qtf,
+                                              delta, wa1, wa2, par=par)
                 # Store the direction p and x+p. Calculate the norm of p
                 wa1 = -wa1
 
@@ -1509,23 +1548,19 @@ class mpfit:
             mperr = 0
             fjac = numpy.zeros(nall)
             fjac[ifree] = 1.0  # Specify which parameters need derivatives
-            [status, fp] = self.call(fcn, xall, functkw, fjac=fjac)
+            [status, fp, pderiv] = self.call(fcn, xall, functkw, fjac=fjac)
+            pderiv = numpy.asarray(pderiv, dtype=float)
 
-
-            if len(fjac) != m*nall:
+            if pderiv.size != m*nall:
                 print('ERROR: Derivative matrix was not computed properly.')
                 return None
 
             # This definition is consistent with CURVEFIT
             # Sign error found (thanks Jesus Fernandez <fernande@irm.chu-caen.fr>)
-            fjac.shape = [m,nall]
-            fjac = -fjac
+            fjac = -pderiv.reshape(m, nall)
 
             # Select only the free parameters
-            if len(ifree) < nall:
-                fjac = fjac[:,ifree]
-                fjac.shape = [m, n]
-                return fjac
+            return fjac[:, ifree]
 
         fjac = numpy.zeros([m, n])
 
@@ -1560,11 +1595,29 @@ class mpfit:
             wh = numpy.nonzero(mask)[0]
             if len(wh) > 0:
                 h[wh] = - h[wh]
-        # Loop through parameters, computing the derivative for each
+        # Parameters at which the function is evaluated: each one is
+        # displaced forward and, for two-sided derivatives, also backward
+        xps = []
         for j in range(n):
             xp = xall.copy()
             xp[ifree[j]] = xp[ifree[j]] + h[j]
-            [status, fp] = self.call(fcn, xp, functkw)
+            xps.append(xp)
+            if numpy.abs(dside[ifree[j]]) > 1:
+                xm = xall.copy()
+                xm[ifree[j]] = xall[ifree[j]] - h[j]
+                xps.append(xm)
+
+        if self.executor is None:
+            fvals = iter([self.call(fcn, xp, functkw) for xp in xps])
+        else:
+            if self.qanytied:
+                xps = [self.tie(xp, self.ptied) for xp in xps]
+            self.nfev += len(xps)
+            fvals = iter(self.executor.map(_call_fcn, [(fcn, xp, functkw, self.damp) for xp in xps]))
+
+        # Loop through parameters, computing the derivative for each
+        for j in range(n):
+            [status, fp] = next(fvals)
 
             if status < 0:
                 return None
@@ -1576,10 +1629,7 @@ class mpfit:
 
             else:
                 # COMPUTE THE TWO-SIDED DERIVATIVE
-                xp[ifree[j]] = xall[ifree[j]] - h[j]
-
-                mperr = 0
-                [status, fm] = self.call(fcn, xp, functkw)
+                [status, fm] = next(fvals)
                 if status < 0:
                     return None
 
@@ -2161,6 +2211,170 @@ class mpfit:
         return [r, par, x, sdiag]
 
 
+    # LAPACK versions of qrfac, qrsolv and lmpar, selected with the LAPACK
+    # keyword. They have the same inputs and outputs as the MINPACK
+    # translations above, except that qrfac_lapack directly returns the
+    # triangle R, in the order of the pivoted columns, and (q transpose)*b.
+    # The loops over the columns are replaced by calls to xGEQP3 (pivoted
+    # QR), xGEQRF and xTRTRS. The Householder convention of LAPACK is the
+    # one of MINPACK, so R is the same apart from rounding.
+
+    def qrfac_lapack(self, a, b):
+
+        from scipy import linalg  # Scipy is only required with LAPACK=1
+
+        if self.debug:
+            print('Entering qrfac_lapack...')
+
+        # Norms of the columns of A, before pivoting
+        acnorm = numpy.sqrt(numpy.sum(a**2, 0))
+
+        # a[:, ipvt] = q*r and qtb = (q transpose)*b, without forming q
+        qtb, r, ipvt = linalg.qr_multiply(a, b, mode='right', pivoting=True)
+        rdiag = numpy.diagonal(r).copy()
+
+        return [r, ipvt, rdiag, acnorm, qtb]
+
+
+    def qrsolv_lapack(self, r, ipvt, diag, qtb, sdiag):
+
+        from scipy import linalg
+
+        if self.debug:
+            print('Entering qrsolv_lapack...')
+        n = r.shape[1]
+
+        # Least-squares solution of [r; d*p]*z = [qtb; 0] from the QR
+        # factorization of the stacked matrix. Its triangle is s,
+        # with p^T*(a^T*a + d*d)*p = s^T*s
+        rd = numpy.vstack([numpy.triu(r), numpy.diag(diag[ipvt])])
+        wa, s = linalg.qr_multiply(rd, numpy.append(qtb, numpy.zeros(n)), mode='right')
+        sdiag[:] = numpy.diagonal(s)
+
+        # As qrsolv, store the strict upper triangle of s (transposed) in
+        # the strict lower triangle of r, leaving the upper triangle of r
+        low = numpy.tril_indices(n, -1)
+        r[low] = s.T[low]
+
+        # Solve the triangular system for z.  If the system is singular
+        # then obtain a least squares solution
+        nsing = n
+        wh = numpy.nonzero(sdiag == 0)[0]
+        if len(wh) > 0:
+            nsing = wh[0]
+            wa[nsing:] = 0
+        if nsing >= 1:
+            wa[:nsing] = linalg.solve_triangular(s[:nsing, :nsing], wa[:nsing])
+
+        # Permute the components of z back to components of x
+        x = numpy.empty(n)
+        x[ipvt] = wa
+        return (r, x, sdiag)
+
+
+    def lmpar_lapack(self, r, ipvt, diag, qtb, delta, x, sdiag, par=None):
+
+        from scipy import linalg
+
+        if self.debug:
+            print('Entering lmpar_lapack...')
+        dwarf = self.machar.minnum
+        machep = self.machar.machep
+        n = r.shape[1]
+
+        # Compute and store in x the gauss-newton direction.  If the
+        # jacobian is rank-deficient, obtain a least-squares solution
+        nsing = n
+        wa1 = qtb.copy()
+        rthresh = numpy.max(numpy.abs(numpy.diagonal(r))) * machep
+        wh = numpy.nonzero(numpy.abs(numpy.diagonal(r)) < rthresh)[0]
+        if len(wh) > 0:
+            nsing = wh[0]
+            wa1[wh[0]:] = 0
+        if nsing >= 1:
+            wa1[:nsing] = linalg.solve_triangular(r[:nsing, :nsing], wa1[:nsing])
+
+        # Note: ipvt here is a permutation array
+        x[ipvt] = wa1
+
+        # Initialize the iteration counter.  Evaluate the function at the
+        # origin, and test for acceptance of the gauss-newton direction
+        iter = 0
+        wa2 = diag * x
+        dxnorm = norm(wa2)
+        fp = dxnorm - delta
+        if fp <= 0.1*delta:
+            return [r, 0., x, sdiag]
+
+        # If the jacobian is not rank deficient, the newton step provides a
+        # lower bound, parl, for the zero of the function.  Otherwise set
+        # this bound to zero.
+        parl = 0.
+        if nsing >= n:
+            wa1 = diag[ipvt] * wa2[ipvt] / dxnorm
+            wa1 = linalg.solve_triangular(r, wa1, trans='T')
+            temp = norm(wa1)
+            parl = ((fp/delta)/temp)/temp
+
+        # Calculate an upper bound, paru, for the zero of the function
+        wa1 = numpy.dot(qtb, numpy.triu(r))/diag[ipvt]
+        gnorm = norm(wa1)
+        paru = gnorm/delta
+        if paru == 0:
+            paru = dwarf/numpy.min([delta,0.1])
+
+        # If the input par lies outside of the interval (parl,paru), set
+        # par to the closer endpoint
+        par = numpy.max([par,parl])
+        par = numpy.min([par,paru])
+        if par == 0:
+            par = gnorm/dxnorm
+
+        # Beginning of an interation
+        while(1):
+            iter = iter + 1
+
+            # Evaluate the function at the current value of par
+            if par == 0:
+                par = numpy.max([dwarf, paru*0.001])
+            temp = numpy.sqrt(par)
+            wa1 = temp * diag
+            [r, x, sdiag] = self.qrsolv_lapack(r, ipvt, wa1, qtb, sdiag)
+            wa2 = diag*x
+            dxnorm = norm(wa2)
+            temp = fp
+            fp = dxnorm - delta
+
+            if (numpy.abs(fp) <= 0.1*delta) or \
+               ((parl == 0) and (fp <= temp) and (temp < 0)) or \
+               (iter == 10):
+               break;
+
+            # Compute the newton correction, solving s^T*wa1 = p^T*d*x/dxnorm.
+            # The correction is zero if s is singular
+            parc = 0.
+            if numpy.all(sdiag != 0):
+                wa1 = diag[ipvt] * wa2[ipvt] / dxnorm
+                st = numpy.tril(r, -1) + numpy.diag(sdiag)
+                wa1 = linalg.solve_triangular(st, wa1, lower=True)
+                temp = norm(wa1)
+                parc = ((fp/delta)/temp)/temp
+
+            # Depending on the sign of the function, update parl or paru
+            if fp > 0:
+                parl = numpy.max([parl,par])
+            if fp < 0:
+                paru = numpy.min([paru,par])
+
+            # Compute an improved estimate for par
+            par = numpy.max([parl, par+parc])
+
+            # End of an iteration
+
+        # Termination
+        return [r, par, x, sdiag]
+
+
     # Procedure to tie one parameter to another.
     def tie(self, p, ptied=None):
         if self.debug:
@@ -137,6 +137,57 @@ def lector(wl, intens, noise, infile, vel=0, cols=(0,8,2,3,4,5,6,7),
             errors[i] = 2.5 * c2 * np.log10(np.e) / SN
     return results, errors
     
+def variable_gaussian_filter1d(intens, sigmas, truncate=4.0):
+    """ Convolve spectra with a Gaussian of variable width.
+
+    The flux of each pixel i is spread with a Gaussian of dispersion
+    sigmas[i] (in pixels), truncated and normalized as in gaussian_filter1d
+    with mode="constant", i.e. the flux spread beyond the edges is lost. The
+    result is the same as filtering each row of np.diag(intens) and adding
+    the rows, but the cost is O(N * kernel size) in time and O(N) in memory
+    instead of O(N^2).
+
+    ================
+    Input parameters
+    ================
+    intens: array_like
+        Intensity array, either 1-D or 2-D with one spectrum per column.
+
+    sigmas: array_like
+        Dispersion of the Gaussian at each pixel, in pixels.
+
+    truncate: float
+        Truncate the Gaussians at this many dispersions.
+
+    =================
+    Output parameters
+    =================
+    array_like
+        The convolved intensity array, with the same shape as intens.
+
+    """
+    intens = np.asarray(intens, dtype=float)
+    sigmas = np.asarray(sigmas, dtype=float)
+    npix = len(sigmas)
+    radius = (truncate * sigmas + 0.5).astype(int)
+    rmax = radius.max()
+    shape = (npix,) + (1,) * (intens.ndim - 1) # Broadcast over spectra
+    # Normalization of the truncated Gaussian of each pixel
+    norm = np.zeros(npix)
+    for k in range(-rmax, rmax + 1):
+        norm += np.where(abs(k) <= radius, np.exp(-0.5 / sigmas**2 * k**2), 0.)
+    # Add the contribution of all pixels at distance k from each pixel
+    out = np.zeros_like(intens)
+    for k in range(-rmax, rmax + 1):
+        weight = np.where(abs(k) <= radius, np.exp(-0.5 / sigmas**2 * k**2),
+                          0.) / norm
+        contrib = (weight.reshape(shape) * intens)
+        if k >= 0:
+            out[k:] += contrib[:npix - k]
+        else:
+            out[:k] += contrib[-k:]
+    return out
+
 def broad2lick(wl, intens, obsres, vel=0):
     """ Convolve spectra to match the Lick resolution.
         
@@ -180,11 +231,7 @@ def broad2lick(wl, intens, obsres, vel=0):
     fwhm_broad = np.sqrt(fwhm_lick**2 - obsres**2)
 
     sigma_b = fwhm_broad/ 2.3548 / dw
-    intens2D = np.diag(intens)
-    for i in range(len(sigma_b)):
-        intens2D[i] = gaussian_filter1d(intens2D[i], sigma_b[i],
-                      mode="constant", cval=0.0)
-    return intens2D.sum(axis=0)
+    return variable_gaussian_filter1d(intens, sigma_b)
     
 if __name__ == "__main__":
     pass
@@ -14,7 +14,7 @@ from scipy.interpolate import interp1d, InterpolatedUnivariateSpline
 from scipy.ndimage.filters import gaussian_filter1d
 from scipy.constants import c
 
-from lector import lector
+from lector import lector, variable_gaussian_filter1d
 
 ckms = c / 1000. # Convert speed of light to km / s
 
@@ -127,11 +127,7 @@ def broad2lick(wl, intens, obsres, vel=0):
     fwhm_lick = flick(wl)
     fwhm_broad = np.sqrt(fwhm_lick**2 - obsres**2)
     sigma_b = fwhm_broad/ 2.3548 / dw
-    intens2D = np.diag(intens)
-    for i in range(len(sigma_b)):
-        intens2D[i] = gaussian_filter1d(intens2D[i], sigma_b[i],
-                      mode="constant", cval=0.0)
-    return intens2D.sum(axis=0)
+    return variable_gaussian_filter1d(intens, sigma_b)
 
 def bands_shift(bands, vel):
     return  bands * np.sqrt((1 + vel/ckms)/(1 - vel/ckms))
@@ -217,6 +217,39 @@ def make_templates():
         f.write("\n".join(gas_files))
 
 
+def pca_templates(templates, nbasis=None, tol=1e-4):
+    """ Truncated SVD basis (PCA without subtraction of the mean) of a
+    library of templates[npix, ntemp], to fit the kinematics with
+    ppxf(..., eigen_templates=True). Returns the eigen-templates
+    [npix, nbasis], scaled by the singular values, and the coefficients
+    [nbasis, ntemp] such that templates ~ basis.dot(coeffs). If nbasis
+    is None, it is the smallest number of eigen-templates for which the
+    relative rms residual of the library is below tol. """
+    u, s, vt = np.linalg.svd(templates, full_matrices=False)
+    if nbasis is None:
+        resid = np.sqrt(np.cumsum(s[::-1]**2)[::-1] / np.sum(s**2))
+        nbasis = np.flatnonzero(np.append(resid, 0) < tol)[0]
+    return u[:,:nbasis] * s[:nbasis], vt[:nbasis]
+
+def load_pca_templates(nbasis=20, redo=False):
+    """ Eigen-templates of the MILES library produced by make_templates.
+    They are computed only once and cached in the templates directory. """
+    library = os.path.join(templates_dir, 'miles_FWHM_3.7.fits')
+    filename = os.path.join(templates_dir,
+                            'miles_pca{0}_FWHM_3.7.fits'.format(nbasis))
+    if redo or not os.path.exists(filename):
+        basis, coeffs = pca_templates(pf.getdata(library, 0), nbasis)
+        hdu = pf.PrimaryHDU(basis)
+        hdu2 = pf.ImageHDU(pf.getdata(library, 1))
+        hdu3 = pf.ImageHDU(coeffs)
+        hdulist = pf.HDUList([hdu, hdu2, hdu3])
+        hdulist.writeto(filename, clobber=True)
+    basis = pf.getdata(filename, 0)
+    logLam2 = pf.getdata(filename, 1)
+    coeffs = pf.getdata(filename, 2)
+    return basis, logLam2, coeffs
+
+
 if __name__ == "__main__":
     os.chdir(templates_dir)
     # em_hdelta = emission_line_template(4103., velscale, return_log=0)
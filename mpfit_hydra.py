@@ -595,6 +595,17 @@ import scipy.linalg
 #
 #	 **********
 
+def _call_fcn(args):
+	"""
+	Evaluate the user function at one point of the numerical derivatives.
+	This is a module-level function, so that it can be sent to a process pool
+	"""
+	fcn, x, functkw, damp = args
+	[status, f] = fcn(x, fjac=None, **functkw)
+	if damp > 0:
+		f = numpy.tanh(f/damp)
+	return [status, f]
+
 class mpfit:
 
 	blas_enorm32, = scipy.linalg.get_blas_funcs(['nrm2'],numpy.array([0],dtype=numpy.float32))
@@ -606,7 +617,7 @@ class mpfit:
 				 damp=0., maxiter=200, factor=100., nprint=1,
 				 iterfunct='default', iterkw={}, nocovar=0,
 				 rescale=0, autoderivative=1, quiet=0,
-				 diag=None, epsfcn=None, debug=0):
+				 diag=None, epsfcn=None, debug=0, executor=None):
 		"""
   Inputs:
 	fcn:
@@ -631,6 +642,16 @@ class mpfit:
 		   NOTE: to supply your own analytical derivatives,
 				 explicitly pass autoderivative=0
 
+	 executor:
+		An object with a map(func, iterable) method returning the results in
+		order, like concurrent.futures.ThreadPoolExecutor/ProcessPoolExecutor
+		or multiprocessing.Pool. When given, the function evaluations of the
+		finite-difference derivatives (one or two per free parameter) are
+		computed concurrently with executor.map. The derivatives are the same
+		as the serial ones, as long as FCN only depends on its arguments.
+		With a process pool FCN and FUNCTKW must be picklable.
+		   Default: None (serial evaluations)
+
 	 ftol:
 		A nonnegative input variable. Termination occurs when both the actual
 		and predicted relative reductions in the sum of squares are at most
@@ -851,6 +872,7 @@ class mpfit:
 		self.errmsg = ''
 		self.nfev = 0
 		self.damp = damp
+		self.executor = executor
 		self.dof=0
 
 		if fcn==None:
@@ -1577,11 +1599,29 @@ class mpfit:
 			wh = (numpy.nonzero(mask))[0]
 			if len(wh) > 0:
 				h[wh] = - h[wh]
-		# Loop through parameters, computing the derivative for each
+		# Parameters at which the function is evaluated: each one is
+		# displaced forward and, for two-sided derivatives, also backward
+		xps = []
 		for j in range(n):
 			xp = xall.copy()
 			xp[ifree[j]] = xp[ifree[j]] + h[j]
-			[status, fp] = self.call(fcn, xp, functkw)
+			xps.append(xp)
+			if numpy.abs(dside[ifree[j]]) > 1:
+				xm = xall.copy()
+				xm[ifree[j]] = xall[ifree[j]] - h[j]
+				xps.append(xm)
+
+		if self.executor is None:
+			fvals = iter([self.call(fcn, xp, functkw) for xp in xps])
+		else:
+			if self.qanytied:
+				xps = [self.tie(xp, self.ptied) for xp in xps]
+			self.nfev += len(xps)
+			fvals = iter(self.executor.map(_call_fcn, [(fcn, xp, functkw, self.damp) for xp in xps]))
+
+		# Loop through parameters, computing the derivative for each
+		for j in range(n):
+			[status, fp] = next(fvals)
 			if status < 0:
 				return None
 
@@ -1592,10 +1632,7 @@ class mpfit:
 
 			else:
 				# COMPUTE THE TWO-SIDED DERIVATIVE
-				xp[ifree[j]] = xall[ifree[j]] - h[j]
-
-				mperr = 0
-				[status, fm] = self.call(fcn, xp, functkw)
+				[status, fm] = next(fvals)
 				if status < 0:
 					return None
 
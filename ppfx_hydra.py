@@ -430,7 +430,7 @@
 import numpy as np    
 import matplotlib.pyplot as plt
 from numpy import polynomial
-from scipy import ndimage, optimize, signal, linalg
+from scipy import ndimage, optimize, signal, linalg, sparse
 import mpfit # https://code.google.com/p/astrolibpy/
 
 eps = np.MachAr().eps
@@ -516,11 +516,40 @@ def reddening_curve(lam, ebv):
 
 #----------------------------------------------------------------------------
 
-def _bvls_solve(A, b, npoly):
+def _regularization_matrix(reg_dim, regul, npoly, ncols):
+    """
+    Sparse operator of the second-degree 1D, 2D or 3D linear regularization
+    of the templates, which start at column NPOLY of a design matrix with
+    NCOLS columns.
+    Press W.H., et al., 1992, Numerical Recipes, 2nd ed. equation (18.5.10)
+    
+    """
+    reg_dim = np.atleast_1d(reg_dim)
+    i = npoly + np.arange(np.prod(reg_dim)).reshape(reg_dim)
+    cols = []
+    for ax in range(reg_dim.size):
+        ia = np.rollaxis(i,ax)
+        cols.append(np.column_stack([ia[:-2].ravel(), ia[1:-1].ravel(), ia[2:].ravel()]))
+    cols = np.vstack(cols)
+    nreg = cols.shape[0]
+    rows = np.repeat(np.arange(nreg),3)
+    diff = np.tile(np.array([-1.,2.,-1.])*regul, nreg)
+    
+    return sparse.csr_matrix((diff, (rows, cols.ravel())), shape=(nreg,ncols))
+
+#----------------------------------------------------------------------------
+
+def _bvls_solve(A, b, npoly, reg=None):
 
     # No need to enforce positivity constraints if fitting one single template:
     # use faster linear least-squares solution instead of NNLS.
+    # The regularization rows REG, if given, are appended to A only here.
+    # They are dense, as required by optimize.nnls, and are converted from
+    # the sparse operator only once per fit (see _fitfunc).
     #
+    if reg is not None:
+        A = np.vstack([A, reg])
+        b = np.hstack([b, np.zeros(reg.shape[0])])
     m, n = A.shape
     if m == 1: # A is a vector, not an array
         soluz = A.dot(b)/A.dot(A)
@@ -715,6 +744,8 @@ class ppxf(object):
         #
         good = self.goodpixels.copy()
         self.parinfo = parinfo
+        self.reg_matrix = None # Sparse regularization operator, see _fitfunc
+        self.reg_rows = None # Its dense rows, as required by optimize.nnls
         for j in range(4): # Do at most five cleaning iterations
             self.clean = False # No cleaning during chi2 optimization
             mp = mpfit.mpfit(self._fitfunc, parinfo=parinfo, quiet=1, ftol=1e-4)
@@ -801,6 +832,90 @@ class ppxf(object):
 
     #------------------------------------------------------------------
 
+    @property
+    def matrix_unbroad(self):
+        """
+        Design matrix of the last fit, with the templates convolved with
+        a unit-sigma Gaussian instead of the LOSVD. This is computed only
+        once, when first requested after the fit has converged.
+        
+        """
+        if self._matrix_unbroad is None:
+            self._matrix_unbroad = self._unbroadened_matrix(*self._unbroad[:2])
+        return self._matrix_unbroad
+
+    #------------------------------------------------------------------
+
+    @property
+    def bestfit_unbroad(self):
+        """ Best fitting spectrum computed with matrix_unbroad """
+        return self.matrix_unbroad.dot(self._unbroad[2])
+
+    #------------------------------------------------------------------
+
+    def _unbroadened_matrix(self, pars, mpoly):
+        nspec = len(self.galaxy.shape)
+        npix = self.galaxy.shape[0]
+        
+        dx = 0
+        p = 0
+        for j in range(self.ncomp): # loop over kinematic components
+            tmp = np.ceil(abs(self.vsyst) + abs(pars[0+p]) + 5.*pars[1+p]) # Sample the Gaussian at least to vsyst+vel+5*sigma
+            dx = max(dx, tmp)
+            p += self.moments[j]
+
+        n = 2*dx*self.factor + 1
+        x = np.linspace(-dx,dx,n)   # Evaluate the Gaussian using steps of 1/factor pixel
+        losvd = np.empty((n,self.ncomp,nspec))
+        p = 0
+        for j in range(self.ncomp): # loop over kinematic components
+            for k in range(nspec):    # nspec=2 for two-sided fitting, otherwise nspec=1
+                if k ==0:
+                    s = 1   # s=+1 for left spectrum, s=-1 for right one
+                else:
+                    s = -1
+                vel = self.vsyst + s*pars[0+p]
+                w = (x - vel)/1.
+                losvd[:,j,k] = np.exp(-0.5*w**2)/(np.sqrt(2.*np.pi)) # Normalized total(Gaussian)=1
+                p += self.moments[j]
+
+        skydim = len(np.shape(self.sky))
+        if skydim == 0:
+            nsky = 0
+        elif skydim == 1:
+            nsky = 1 # Number of sky spectra
+        else:
+            nsky = np.shape(self.sky)[1]
+        ntemp = self.star.shape[1]
+        
+        # Same columns as the design matrix of _fitfunc, with the additive
+        # polynomials left to zero
+        #
+        d = np.zeros((npix*nspec,(self.degree + 1 + nsky)*nspec + ntemp))
+        tmp = np.empty((self.star.shape[0],nspec))
+        for j in range(ntemp):
+            if self.factor == 1: # No oversampling of the template spectrum
+                for k in range(nspec):
+                    tmp[:,k] = signal.fftconvolve(self.star[:,j],losvd[:,self.component[j],k],mode='same')
+            else:             # Oversample the template spectrum before convolution
+                st = ndimage.interpolation.zoom(self.star[:,j],self.factor,order=1)
+                for k in range(nspec):
+                    tmp[:,k] = rebin(signal.fftconvolve(st,losvd[:,self.component[j],k],mode='same'),self.factor)
+            d[:,(self.degree+1)*nspec+j] = mpoly*tmp[:npix,:].ravel() # reform into a vector
+        
+        for j in range(nsky):
+            skyj = self.sky[:,j]
+            k = (self.degree+1)*nspec + ntemp
+            if nspec == 2:
+                d[:,k+2*j] = [skyj,skyj*0]   # Sky for left spectrum
+                d[:,k+2*j+1] = [skyj*0,skyj] # Sky for right spectrum
+            else: 
+                d[:npix,k+j] = skyj
+        
+        return d
+
+    #------------------------------------------------------------------
+
     def _fitfunc(self, pars, fjac=None):
         nspec = len(self.galaxy.shape)
         npix = self.galaxy.shape[0]
@@ -820,7 +935,6 @@ class ppxf(object):
         n = 2*dx*self.factor + 1
         x = np.linspace(-dx,dx,n)   # Evaluate the Gaussian using steps of 1/factor pixel
         losvd = np.empty((n,self.ncomp,nspec))
-        losvd2 = losvd.copy()
         p = 0
         for j in range(self.ncomp): # loop over kinematic components
             for k in range(nspec):    # nspec=2 for two-sided fitting, otherwise nspec=1
@@ -830,11 +944,8 @@ class ppxf(object):
                     s = -1
                 vel = self.vsyst + s*pars[0+p]
                 w = (x - vel)/pars[1+p]
-                w_un = (x - vel)/1.
                 w2 = w**2
-                w2_un = w_un**2
                 losvd[:,j,k] = np.exp(-0.5*w2)/(np.sqrt(2.*np.pi)*pars[1+p]) # Normalized total(Gaussian)=1
-                losvd2[:,j,k] = np.exp(-0.5*w2_un)/(np.sqrt(2.*np.pi)) # Normalized total(Gaussian)=1
                 # Hermite polynomials normalized as in Appendix A of van der Marel & Franx (1993).
                 # Coefficients for h5, h6 are given e.g. in Appendix C of Cappellari et al. (2002)
                 #
@@ -883,23 +994,10 @@ class ppxf(object):
             ntemp = 1
         
         nrows = (self.degree + 1 + nsky)*nspec + ntemp
-        ncols = npix*nspec
-        if self.regul > 0:
-            dim = self.reg_dim.size
-            reg2 = self.reg_dim - 2
-            if dim == 1:
-                nreg = reg2
-            elif dim == 2:
-                nreg = 2*np.prod(reg2) + 2*np.sum(reg2) # Rectangle sides have one finite difference
-            elif dim == 3:                               # Hyper-rectangle edges have one finite difference
-                nreg = 3*np.prod(reg2) + 4*np.sum(reg2) 
-                + 4*( np.prod(reg2[[0,1]]) + np.prod(reg2[[0,2]]) + np.prod(reg2[[1,2]]) )
-            ncols = ncols + nreg
-        c = np.zeros((ncols,nrows))  # This array is used for estimating predictions
-        ######################################################################
-        # Make copy of c for unconvolved template
-        d = c.copy()
-        ######################################################################
+        if self.regul > 0 and self.reg_matrix is None: # Built once per fit
+            self.reg_matrix = _regularization_matrix(self.reg_dim, self.regul, (self.degree+1)*nspec, nrows)
+            self.reg_rows = self.reg_matrix.toarray()
+        c = np.zeros((npix*nspec,nrows))  # This array is used for estimating predictions
         
         for j in range(self.degree+1): # Fill first columns of the Design Matrix
             coeff = np.zeros(j+1)
@@ -916,58 +1014,15 @@ class ppxf(object):
         # CONVOLVE(a,b,/EDGE_ZERO) = signal.fftconvolve(a,b[::-1],'same')
         
         tmp = np.empty((self.star.shape[0],nspec))
-        tmp2 = tmp.copy()
         for j in range(ntemp):
             if self.factor == 1: # No oversampling of the template spectrum
                 for k in range(nspec):
                     tmp[:,k] = signal.fftconvolve(self.star[:,j],losvd[:,self.component[j],k],mode='same')
-                    tmp2[:,k] = signal.fftconvolve(self.star[:,j],losvd2[:,self.component[j],k],mode='same')
             else:             # Oversample the template spectrum before convolution
                 st = ndimage.interpolation.zoom(self.star[:,j],self.factor,order=1)
                 for k in range(nspec):
                     tmp[:,k] = rebin(signal.fftconvolve(st,losvd[:,self.component[j],k],mode='same'),self.factor)
-                    tmp2[:,k] = rebin(signal.fftconvolve(st,losvd2[:,self.component[j],k],mode='same'),self.factor)
             c[:npix*nspec,(self.degree+1)*nspec+j] = mpoly*tmp[:npix,:].ravel() # reform into a vector
-            d[:npix*nspec,(self.degree+1)*nspec+j] = mpoly*tmp2[:npix,:].ravel() # reform into a vector
-        
-        # Add second-degree 1D, 2D or 3D linear regularization
-        # Press W.H., et al., 1992, Numerical Recipes, 2nd ed. equation (18.5.10)
-        #
-        if self.regul > 0:
-            if dim == 1:
-                i = np.arange(self.reg_dim)
-            else:
-                i = np.arange(np.prod(self.reg_dim)).reshape(self.reg_dim)
-            i += (self.degree+1)*nspec
-            p = npix*nspec
-            diff = np.array([-1,2,-1])*self.regul
-            ind = np.array([-1,0,1])
-            if dim == 1:
-                for j in range(1,self.reg_dim-1): 
-                    c[p,i[j+ind]] = diff
-                    p += 1
-            elif dim == 2:
-                for k in range(self.reg_dim[1]):
-                    for j in range(self.reg_dim[0]):
-                        if j != 0 and j != self.reg_dim[0]-1:
-                            c[p,i[j+ind,k]] = diff
-                            p += 1
-                        if k != 0 and k != self.reg_dim[1]-1:
-                            c[p,i[j,k+ind]] = diff
-                            p += 1
-            elif dim == 3:
-                for q in range(self.reg_dim[2]):
-                    for k in range(self.reg_dim[1]):
-                        for j in range(self.reg_dim[0]):
-                            if j != 0 and j != self.reg_dim[0]-1:
-                                c[p,i[j+ind,k,q]] = diff
-                                p += 1
-                            if k != 0 and k != self.reg_dim[1]-1:
-                                c[p,i[j,k+ind,q]] = diff
-                                p += 1
-                            if q != 0 and q != self.reg_dim[2]-1:
-                                c[p,i[j,k,q+ind]] = diff
-                                p += 1
         
         for j in range(nsky):
             skyj = self.sky[:,j]
@@ -975,35 +1030,26 @@ class ppxf(object):
             if nspec == 2:
                 c[:npix*nspec,k+2*j] = [skyj,skyj*0]   # Sky for left spectrum
                 c[:npix*nspec,k+2*j+1] = [skyj*0,skyj] # Sky for right spectrum
-                d[:npix*nspec,k+2*j] = [skyj,skyj*0]   # Sky for left spectrum
-                d[:npix*nspec,k+2*j+1] = [skyj*0,skyj] # Sky for right spectrum
             else: 
                 c[:npix,k+j] = skyj
-                d[:npix,k+j] = skyj
 
         npoly = (self.degree+1)*nspec # Number of additive polynomials in the fit
         
         # Select the spectral region to fit and solve the overconditioned system
         # using SVD/BVLS. Use unweighted array for estimating bestfit predictions.
+        # The regularization rows self.reg_rows are built once per fit.
         # Iterate to exclude pixels deviating more than 3*sigma if /CLEAN keyword is set.
         #
-        a = c.copy() # This array is used for the actual solution of the system
-        a[:npix*nspec,:] = c[:npix*nspec,:] / self.noise[:,np.newaxis] # Weight all columns with errors
+        a = c / self.noise[:,np.newaxis] # Weight all columns with errors
         b = self.galaxy / self.noise
                 
         m = 1
         while m != 0:
-            if self.regul > 0:
-                aa = a[np.hstack([self.goodpixels, np.arange(npix*nspec,ncols)]), :]
-                bb = np.hstack([b[self.goodpixels], np.zeros(nreg)])
-            else:
-                aa = a[self.goodpixels,:]
-                bb = b[self.goodpixels]
-            self.weights = _bvls_solve(aa,bb,npoly)
+            aa = a[self.goodpixels,:]
+            bb = b[self.goodpixels]
+            self.weights = _bvls_solve(aa,bb,npoly,self.reg_rows)
             self.matrix = c[:npix*nspec,:]
-            self.matrix_unbroad = d[:npix*nspec,:]
             self.bestfit = c[:npix*nspec,:].dot(self.weights)
-            self.bestfit_unbroad = d[:npix*nspec,:].dot(self.weights)
             err = (self.galaxy[self.goodpixels] - self.bestfit[self.goodpixels]) \
                 /  self.noise[self.goodpixels]
             if self.clean is True:
@@ -1016,6 +1062,12 @@ class ppxf(object):
             else: 
                 break
         
+        # The unbroadened model is only built on request, for the last
+        # evaluated solution (see matrix_unbroad and bestfit_unbroad)
+        #
+        self._unbroad = (pars.copy(), mpoly, self.weights)
+        self._matrix_unbroad = None
+        
         # Penalize the solution towards (h3,h4,...)=0 if the inclusion of
         # these additional terms does not significantly decrease the error.
         #
@@ -109,6 +109,11 @@
 #       with elements sigma(i, j). When the errors in the spectrum are uncorrelated
 #       it is mathematically equivalent to input in PPXF an error vector NOISE=errvec
 #       or a NxN diagonal matrix NOISE=np.diag(errvec**2) (note squared!).
+#     - The covariance matrix is factored once with a Cholesky decomposition.
+#       It can also be given as a scipy.sparse matrix. When its nonzero
+#       elements are within a narrow band around the diagonal (as for
+#       spectra resampled or combined with a small kernel) the banded
+#       factorization is used, and large correlated-noise fits are fast.
 #     - IMPORTANT: the penalty term of the pPXF method is based on the *relative*
 #       change of the fit residuals. For this reason the penalty will work as
 #       expected even if no reliable estimate of the NOISE is available
@@ -133,6 +138,17 @@
 #           start = [[V1, sigma1], [V2, sigma2]]
 #
 # KEYWORDS:
+#   ANALYTIC_LOSVD: set this keyword to evaluate the Fourier transform of the
+#       LOSVD analytically, instead of sampling the LOSVD in pixels space and
+#       computing its FFT at every function call. This is faster and remains
+#       accurate when sigma < velScale, without the need to OVERSAMPLE the
+#       templates. See Section 3.2 of Cappellari (2017, MNRAS, 466, 798).
+#   AUTODERIVATIVE: set this keyword to compute the derivatives of the fit
+#       residuals with respect to the nonlinear parameters (LOSVD, MDEGREE or
+#       REDDENING) by finite differences. By default the derivatives are
+#       computed analytically, eliminating the linear weights with the
+#       variable projection method of Golub & Pereyra (1973). This requires
+#       fewer evaluations of the model and is generally faster.
 #   BIAS: This parameter biases the (h3, h4, ...) measurements towards zero
 #       (Gaussian LOSVD) unless their inclusion significantly decreases the
 #       error in the fit. Set this to BIAS=0.0 not to bias the fit: the
@@ -161,6 +177,38 @@
 #   DEGREE: degree of the *additive* Legendre polynomial used to correct
 #       the template continuum shape during the fit (default: 4).
 #       Set DEGREE = -1 not to include any additive polynomial.
+#   EIGEN_TEMPLATES: set this keyword when the TEMPLATES are an eigen-basis of
+#       a template library, e.g. its principal components computed with
+#       load_templates.pca_templates. In this case the weights of the templates
+#       are not constrained to be positive and a few eigen-templates can replace
+#       hundreds of templates when only the kinematics is needed. At the end of
+#       the fit the positivity of the reconstructed (unconvolved) template of
+#       every kinematic component is checked (see the output POSITIVE).
+#       This keyword cannot be used with REGUL.
+#   EXECUTOR: an object with a map(func, iterable) method, like
+#       concurrent.futures.ThreadPoolExecutor or multiprocessing.Pool, used by
+#       MPFIT to evaluate concurrently the model at the displaced parameters of
+#       the finite-difference derivatives. This is only used with
+#       AUTODERIVATIVE. The numpy FFTs and linear algebra release the GIL, so a
+#       thread pool is generally sufficient. For example:
+#           with ThreadPoolExecutor(4) as pool:
+#               pp = ppxf(..., autoderivative=True, executor=pool)
+#       With a process pool (ProcessPoolExecutor or multiprocessing.Pool) a
+#       new pool of the same size is started for the fit, to which the ppxf
+#       object is sent once by the initializer, instead of being pickled
+#       with every function evaluation.
+#   FFT: name of the FFT implementation ('numpy', 'scipy' or 'pyfftw') or an
+#       instance of the FFT_BACKEND class below, which also sets the number of
+#       threads. Default: 'numpy'. For example, to use four threads:
+#           pp = ppxf(..., fft=fft_backend('scipy', workers=4))
+#   FLOAT32: set this keyword to store the template FFTs, the LOSVDs and the
+#       convolved templates in single precision. This halves the memory usage
+#       and speeds up the FFTs, which is useful when fitting many spectra in
+#       parallel. The linear fit of the weights and the fit residuals are still
+#       computed in double precision. The kinematics typically change by a
+#       small fraction of the formal errors (see bench_ppxf.accuracy_float32),
+#       but one should verify this for the data at hand. In this case the
+#       output MATRIX is single precision.
 #   GOODPIXELS: integer vector containing the indices of the good pixels in the
 #       GALAXY spectrum (in increasing order). Only these pixels are included in
 #       the fit. If the CLEAN keyword is set, in output this vector will be updated
@@ -172,6 +220,11 @@
 #       If one uses my LOG_REBIN routine to rebin the spectrum before the PPXF fit:
 #           LOG_REBIN, lamRange, galaxy, galaxyNew, logLam
 #       the wavelength can be obtained as lam = np.exp(logLam).
+#   LAPACK: set this keyword to perform the QR factorizations of the MPFIT
+#       Levenberg-Marquardt iterations with the LAPACK routines of
+#       scipy.linalg, instead of the Python loops of the MINPACK translation.
+#       The iterations are the same, apart from rounding, but the overhead per
+#       iteration is smaller, especially with many nonlinear parameters.
 #   MDEGREE: degree of the *multiplicative* Legendre polynomial (with mean of 1)
 #       used to correct the continuum shape during the fit (default: 0). The
 #       zero degree multiplicative polynomial is always included in the fit as
@@ -196,6 +249,18 @@
 #           component = [0]*100 + [1]*5   # --> [0,0,...,0,1,1,1,1,1]
 #           moments = [-4, 2]
 #           start = [[V, sigma, h3, h4], [V, sigma]]
+#   OPTIMIZER: method used to minimize the fit residuals with respect to the
+#       nonlinear parameters. It can be:
+#     - 'mpfit': the Levenberg-Marquardt method of CAP_MPFIT (default).
+#     - 'least_squares': the Trust Region Reflective method of
+#       scipy.optimize.least_squares, with the same limits on the parameters,
+#       via the LEAST_SQUARES_FIT class below.
+#     - A function or class with the same interface as cap_mpfit.mpfit,
+#       called as optimizer(fcn, parinfo=parinfo, quiet=1, ftol=1e-4,
+#       autoderivative=autoderivative), returning an object with the
+#       attributes PARAMS, PERROR and NFEV.
+#       The EXECUTOR and LAPACK keywords only apply to 'mpfit'.
+#       See bench_ppxf.bench_optimizers to compare the methods.
 #   OVERSAMPLE: Set this keyword to oversample the template by a factor 30x
 #       before convolving it with a well sampled LOSVD. This can be useful to
 #       extract proper velocities, even when sigma < 0.7*velScale and the
@@ -206,6 +271,13 @@
 #       at the end of the fit.
 #   QUIET: set this keyword to suppress verbose output of the best fitting
 #       parameters at the end of the fit.
+#   RFFT_CACHE: an instance of the RFFT_CACHE class below. The FFT of the
+#       templates is taken from this cache, or computed and stored in it,
+#       so that fits of many spectra with the same templates (e.g. all the
+#       spectra of one night) compute it only once. Example:
+#           cache = rfft_cache(directory='rfft')
+#           for galaxy, noise in spectra:
+#               pp = ppxf(templates, galaxy, noise, velScale, start, rfft_cache=cache)
 #   REDDENING: Set this keyword to an initial estimate of the reddening E(B-V)>=0
 #       to fit a positive reddening together with the kinematics and the templates.
 #       The fit assumes the extinction curve of Calzetti et al. (2000, ApJ, 533, 682)
@@ -332,6 +404,11 @@
 #       The polynomial can be explicitly evaluated as:
 #           x = np.linspace(-1, 1, len(galaxy))
 #           mpoly = np.polynomial.legendre.legval(x, np.append(1, pp.mpolyweights))
+#   NFEV: number of evaluations of the model in the last call to the OPTIMIZER.
+#   POSITIVE: with EIGEN_TEMPLATES this is True when the best fitting
+#       combination of the eigen-templates of each kinematic component,
+#           pp.star[:, pp.component == j].dot(pp.weights[:ntemp][pp.component == j])
+#       is positive at all pixels, as required for a physical template.
 #   REDDENING: Best fitting E(B-V) value if the REDDENING keyword is set.
 #   SOL: Vector containing in output the parameters of the kinematics.
 #       If MOMENTS=2 this contains [Vel, Sigma]
@@ -528,29 +605,111 @@
 
 from __future__ import print_function
 
+import os
+import warnings
+import multiprocessing
+import multiprocessing.pool
+import threading
+import hashlib
+from collections import OrderedDict
+
 import numpy as np
 import matplotlib.pyplot as plt
 from numpy.polynomial import legendre
-from scipy import ndimage, optimize, linalg
+from scipy import ndimage, linalg, sparse, optimize
  
 import cap_mpfit as mpfit
 
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:  # Python 2
+    ProcessPoolExecutor = None
+
 #-------------------------------------------------------------------------------
 
-def nnls_flags(A, b, flag):
+def nnls_flags(A, b, flag, passive=None, reg=None, normal=None):
     """
     Solves min||A*x - b|| with
     x[j] >= 0 for flag[j] == False
     x[j] free for flag[j] == True
     where A[m, n], b[m], x[n], flag[n]
 
+    Uses the active-set method of Lawson & Hanson (1974, Solving Least
+    Squares Problems, Chapter 23), in which the free variables never leave
+    the passive set. As in Bro & de Jong (1997, J. Chemometrics, 11, 393)
+    the subproblems are solved with the normal equations, which are only
+    computed once. The optional boolean vector PASSIVE[n], e.g. the nonzero
+    elements of a previous solution, is used as starting passive set: when
+    it is close to the final one only a few iterations are needed.
+    As in Lawson & Hanson, the gradient is compared with a tolerance
+    relative to norm(A)*norm(b), and a warning is issued if the solution
+    has not converged after 3*n iterations.
+    The optional sparse matrix REG[k, n] contains additional rows of the
+    system, with zero right-hand side (e.g. a regularization operator).
+    The optional tuple NORMAL = (A.T.dot(A), A.T.dot(b)) contains the normal
+    equations, when they are already available, e.g. updated after the
+    removal of a few rows of A.
+
     """
     m, n = A.shape
-    AA = np.hstack([A, -A[:, flag]])
-    x, err = optimize.nnls(AA, b)
-    x[:n][flag] -= x[n:]
+    flag = np.asarray(flag, dtype=bool)
+    p = flag.copy()
+    if passive is not None:
+        p |= passive
+    if normal is None:
+        AtA = A.T.dot(A)
+        Atb = A.T.dot(b)
+    else:
+        AtA, Atb = normal[0].copy(), normal[1]
+    if reg is not None:
+        AtA += reg.T.dot(reg).toarray()
+    eps = 10*np.finfo(float).eps*max(m, n)
+    gtol = eps*np.sqrt(np.trace(AtA))*np.linalg.norm(b)  # Scale of the gradient
+
+    def solve(p):
+        z = np.zeros(n)
+        if np.any(p):
+            try:
+                z[p] = linalg.cho_solve(linalg.cho_factor(AtA[np.ix_(p, p)]), Atb[p])
+            except linalg.LinAlgError:  # Degenerate columns
+                if reg is None:
+                    z[p] = linalg.lstsq(A[:, p], b)[0]
+                else:
+                    ap = np.vstack([A[:, p], reg[:, np.flatnonzero(p)].toarray()])
+                    z[p] = linalg.lstsq(ap, np.append(b, np.zeros(reg.shape[0])))[0]
+        return z
+
+    # Remove from the starting passive set the variables that would
+    # become negative, until the starting point is feasible
+    #
+    x = solve(p)
+    neg = ~flag & p & (x <= 0)
+    while np.any(neg):
+        p &= ~neg
+        x = solve(p)
+        neg = ~flag & p & (x <= 0)
+
+    for it in range(3*n):
+        w = Atb - AtA.dot(x)  # Negative gradient of the chi2
+        w[p] = 0
+        j = np.argmax(w)
+        if w[j] <= gtol:
+            break
+        p[j] = True
+        z = solve(p)
+        neg = ~flag & p & (z <= 0)
+        while np.any(neg):  # Move towards Z until a variable reaches zero
+            alpha = np.min(x[neg]/(x[neg] - z[neg]))
+            x += alpha*(z - x)
+            p &= flag | (x > eps*np.abs(x).max())  # Zero to rounding in the scale of X
+            x[~p] = 0
+            z = solve(p)
+            neg = ~flag & p & (z <= 0)
+        x = z
+    else:
+        warnings.warn("nnls_flags: no convergence after %d iterations" % (3*n))
 
-    return x[:n]
+    return x
 
 #-------------------------------------------------------------------------------
 
@@ -612,28 +771,148 @@ def reddening_curve(lam, ebv):
 
 #-------------------------------------------------------------------------------
 
-def _bvls_solve(A, b, npoly):
+def prune_templates(weights, grid, neighbours=1):
+    """
+    Indices of the templates to keep for a refit, given the WEIGHTS of a
+    coarse fit: the templates with nonzero weight and their NEIGHBOURS on
+    the grid of stellar population parameters (e.g. age and metallicity).
+    GRID[ntemp, ndim] contains the integer coordinates of each template on
+    the grid. Templates with a negative coordinate are not part of the grid
+    (e.g. gas emission lines) and are always kept.
+
+    """
+    weights = np.asarray(weights)
+    grid = np.atleast_2d(np.asarray(grid).T).T
+    on_grid = np.all(grid >= 0, 1)
+    used = grid[on_grid & (weights[:grid.shape[0]] != 0)]
+    dist = np.abs(grid[:, None, :] - used[None, :, :]).max(2)
+    keep = ~on_grid | np.any(dist <= neighbours, 1)
+
+    return np.flatnonzero(keep)
+
+#-------------------------------------------------------------------------------
+
+def _bvls_solve(A, b, npoly, passive=None, reg=None, normal=None):
 
     # No need to enforce positivity constraints if fitting one single template:
     # use faster linear least-squares solution instead of NNLS.
+    # The boolean vector PASSIVE, if given, is the starting passive set of NNLS.
+    # The sparse regularization rows REG, if given, are appended to A.
+    # The normal equations NORMAL, if given, are used by NNLS (see nnls_flags).
+    # The first NPOLY columns of A have unconstrained weights: the additive
+    # polynomials, followed by the eigen-templates with EIGEN_TEMPLATES.
     #
     m, n = A.shape
     if m == 1: # A is a vector, not an array
         soluz = A.dot(b)/A.dot(A)
-    elif n == npoly + 1: # Fitting a single template
+    elif n <= npoly + 1: # Fitting a single template, or all weights unconstrained
         soluz = linalg.lstsq(A, b)[0]
     else:               # Fitting multiple templates
         flag = np.zeros(n, dtype=bool)
         flag[:npoly] = True  # flag = True on Legendre polynomials
-        soluz = nnls_flags(A, b, flag)
+        soluz = nnls_flags(A, b, flag, passive, reg, normal)
 
     return soluz
 
 #-------------------------------------------------------------------------------
 
-def _rfft_templates(templates, vsyst, vlims, sigmax, factor, nspec):
+def _regularization_matrix(reg_dim, regul, npoly, ncols):
+    """
+    Sparse operator of the second-degree 1D, 2D or 3D linear regularization
+    of the templates, which start at column NPOLY of a design matrix with
+    NCOLS columns. Each template grid side contributes one finite difference
+    per interior node along it.
+    Press W.H., et al., 2007, Numerical Recipes, 3rd ed. equation (19.5.10)
+
+    """
+    reg_dim = np.atleast_1d(reg_dim)
+    i = npoly + np.arange(np.prod(reg_dim)).reshape(reg_dim)
+    cols = []
+    for ax in range(reg_dim.size):
+        ia = np.rollaxis(i, ax)
+        cols.append(np.column_stack([ia[:-2].ravel(), ia[1:-1].ravel(), ia[2:].ravel()]))
+    cols = np.vstack(cols)
+    nreg = cols.shape[0]
+    rows = np.repeat(np.arange(nreg), 3)
+    diff = np.tile(np.array([-1., 2., -1.])*regul, nreg)
+
+    return sparse.csr_matrix((diff, (rows, cols.ravel())), shape=(nreg, ncols))
+
+#-------------------------------------------------------------------------------
+
+def fast_fft_length(n):
+    """
+    Smallest length >= N of the form 2**a * 3**b * 5**c, for which all
+    FFT implementations are efficient. This is generally much closer to N
+    than the next power of two (e.g. 4320 instead of 8192 for N=4200)
+
+    """
+    best = 2**int(np.ceil(np.log2(n)))
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            p = p35*2**max(0, int(np.ceil(np.log2(float(n)/p35))))
+            best = min(best, p)
+            p35 *= 3
+        p5 *= 5
+
+    return best
+
+#-------------------------------------------------------------------------------
+
+class fft_backend(object):
+    """
+    Real FFT used by ppxf. NAME can be:
+      - 'numpy': numpy.fft (default, always available).
+      - 'scipy': scipy.fft, using WORKERS threads for the 2-dim transforms
+            of the template blocks (requires scipy >= 1.4).
+      - 'pyfftw': the numpy-like interface of pyFFTW, using WORKERS threads.
+            The FFTW plans are created once and kept in the pyFFTW cache,
+            so they are reused by all later calls with the same shapes.
+    WORKERS=-1 uses all the available CPUs.
+
+    """
+    def __init__(self, name='numpy', workers=1):
+
+        self.name = name
+        self.workers = workers
+        if name == 'numpy':
+            self._fft = np.fft
+            self._kwargs = {}
+        elif name == 'scipy':
+            from scipy import fft as scipy_fft
+            self._fft = scipy_fft
+            self._kwargs = {'workers': workers}
+        elif name == 'pyfftw':
+            import pyfftw
+            import pyfftw.interfaces.numpy_fft as pyfftw_fft
+            pyfftw.interfaces.cache.enable()
+            pyfftw.interfaces.cache.set_keepalive_time(60)
+            self._fft = pyfftw_fft
+            self._kwargs = {'threads': multiprocessing.cpu_count() if workers == -1 else workers,
+                            'planner_effort': 'FFTW_MEASURE'}
+        else:
+            raise ValueError("FFT backend must be 'numpy', 'scipy' or 'pyfftw'")
+
+    def __reduce__(self):
+        """ The FFT module cannot be pickled: re-create the backend instead """
+        return fft_backend, (self.name, self.workers)
+
+    def rfft(self, a, n, axis=0):
+        """ Real FFT of A zero padded to length N along AXIS """
+        return self._fft.rfft(a, n, axis=axis, **self._kwargs)
+
+    def irfft(self, a, n, axis=0):
+        """ Inverse of rfft, giving a real output of length N along AXIS """
+        return self._fft.irfft(a, n, axis=axis, **self._kwargs)
+
+#-------------------------------------------------------------------------------
+
+def _rfft_templates(templates, vsyst, vlims, sigmax, factor, nspec, cache=None, fft=None):
     """
-    Pre-compute the FFT and possibly oversample the templates
+    Pre-compute the FFT and possibly oversample the templates,
+    or take them from CACHE if given
 
     """
 
@@ -644,21 +923,431 @@ def _rfft_templates(templates, vsyst, vlims, sigmax, factor, nspec):
     else:
         dx = int(np.max(np.ceil(np.abs(vsyst + vlims) + 5*sigmax)))
 
+    nk = 2*dx*factor + 1
+    nf = templates.shape[0]*factor
+    npad = fast_fft_length(nf + nk//2)  # vector length for zero padding
+
+    if cache is None:
+        rfft_templates = _rfft_oversampled(templates, factor, npad, fft)
+    else:
+        rfft_templates = cache.get(templates, factor, npad, fft)
+
+    return rfft_templates, npad
+
+#-------------------------------------------------------------------------------
+
+def _rfft_oversampled(templates, factor, npad, fft=None):
+    """
+    FFT of the templates, zero padded to NPAD and oversampled by FACTOR
+
+    """
+    if fft is None:
+        fft = fft_backend()
+
     # Oversample all templates (if requested)
     #
     if factor > 1:
         templates = ndimage.interpolation.zoom(templates, [factor, 1], order=1)
 
-    nk = 2*dx*factor + 1
-    nf = templates.shape[0]
-    npad = int(2**np.ceil(np.log2(nf + nk/2)))  # vector length for zero padding
+    # Pre-compute the FFT of all templates.
+    # Columns are stored contiguously for the block convolution in _fitfunc.
+    #
+    # Single precision templates give a single precision FFT with all backends.
+    #
+    rfft = fft.rfft(np.ascontiguousarray(templates.T), npad, axis=-1)
+
+    return rfft.astype(np.result_type(templates.dtype, np.complex64), copy=False).T
+
+#-------------------------------------------------------------------------------
+
+class rfft_cache(object):
+    """
+    Cache of the template FFTs, shared by many ppxf fits with the same
+    templates. Entries are keyed by a hash of the templates, the
+    oversampling factor and the padded length NPAD. The velocity range
+    of the LOSVD (VSYST and the velocity limits) only affects the FFT
+    through NPAD, so fits with different VSYST share the same entry.
+
+    At most MAXSIZE entries are kept in memory and the least recently used
+    one is evicted first. If DIRECTORY is given, every FFT is also saved
+    there as a .npy file and read back memory-mapped: this keeps the memory
+    usage low and the cache persists across sessions and processes.
+
+    """
+    def __init__(self, maxsize=4, directory=None):
+
+        self.maxsize = maxsize
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, templates, factor, npad, fft=None):
+        """
+        FFT of the templates, computed with the FFT_BACKEND FFT
+        only if not already in the cache
+
+        """
+        templates = np.ascontiguousarray(templates)
+        key = "%s_%dx%d_%d_%d" % ((hashlib.sha1(templates).hexdigest(),)
+                                 + templates.shape + (factor, npad))
+        if key in self.entries:
+            self.hits += 1
+            rfft = self.entries.pop(key)  # Re-inserted below as most recent
+        else:
+            rfft = None
+            if self.directory is not None:
+                fname = os.path.join(self.directory, "rfft_" + key + ".npy")
+                if os.path.exists(fname):
+                    rfft = np.load(fname, mmap_mode='r')
+            if rfft is None:
+                self.misses += 1
+                rfft = _rfft_oversampled(templates, factor, npad, fft)
+                if self.directory is not None:
+                    tmp = fname + ".%d.tmp" % os.getpid()
+                    with open(tmp, 'wb') as f:
+                        np.save(f, rfft)
+                    os.rename(tmp, fname)  # Atomic: never read partial files
+                    rfft = np.load(fname, mmap_mode='r')
+            else:
+                self.hits += 1
 
-    # Pre-compute the FFT of all templates
-    # (Use Numpy's rfft as Scipy adopted an odd output format)
+        self.entries[key] = rfft
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+        return rfft
+
+#-------------------------------------------------------------------------------
+
+def xcorr_kinematics(templates, galaxy, velScale, vsyst=0, vlims=None, weights=None,
+                     goodpixels=None, cache=None, fft=None, lowcut=100.):
+    """
+    Fast estimate of the velocity V and of a rough dispersion sigma of one
+    spectrum GALAXY[npix], or many spectra GALAXY[npix, nspec], by FFT
+    cross-correlation with the combination TEMPLATES.dot(WEIGHTS) of the
+    templates (by default their mean), following Tonry & Davis (1979, AJ,
+    84, 1511). It is meant to give a good starting guess to ppxf.
+
+    The spectra and templates must be logarithmically rebinned as for ppxf.
+    VSYST and VLIMS = [Vmin, Vmax] are in km/s and have the same meaning as
+    in ppxf. By default V is searched over the whole range of velocities
+    for which the templates cover at least 90% of the galaxy spectrum.
+    Pixels outside GOODPIXELS are ignored. The continuum is removed by
+    filtering out the scales longer than LOWCUT pixels from the
+    cross-correlation function.
+    The FFT of the templates is taken from CACHE, an rfft_cache, if given.
+
+    Returns [V, sigma] in km/s, the error of V from the width of the
+    correlation peak, and the ratio R of the peak height to the noise of
+    the correlation function: a peak with R < 3 is generally unreliable.
+    The outputs are arrays of length nspec for a 2-dim GALAXY.
+
+    """
+    if fft is None:
+        fft = fft_backend()
+    elif not isinstance(fft, fft_backend):
+        fft = fft_backend(fft)
+    templates = templates.reshape(templates.shape[0], -1)
+    npix = galaxy.shape[0]
+    vsyst = vsyst/velScale
+    if vlims is None:
+        vlims = np.array([npix - templates.shape[0] - npix//10, npix//10]) - vsyst
+    else:
+        vlims = np.asarray(vlims)/velScale
+    star_rfft, npad = _rfft_templates(templates, vsyst, vlims, 1e3/velScale, 1, 1, cache, fft)
+    if weights is None:
+        weights = np.full(templates.shape[1], 1./templates.shape[1])
+    template_rfft = star_rfft.dot(weights)
+
+    # Apodize the spectra and set the masked pixels to the mean
+    #
+    good = np.zeros(npix, dtype=bool)
+    good[slice(None) if goodpixels is None else goodpixels] = True
+    spectra = galaxy.reshape(npix, -1).T.astype(float)
+    spectra -= spectra[:, good].mean(1)[:, None]
+    spectra[:, ~good] = 0
+    m = npix//20  # No taper for spectra shorter than 20 pixels
+    taper = np.ones(npix)
+    if m > 0:
+        taper[:m] = 0.5*(1 - np.cos(np.pi*np.arange(m)/m))
+        taper[npix-m:] = taper[m-1::-1]
+    galaxy_rfft = fft.rfft(spectra*taper, npad, axis=-1)
+
+    # Cosine ramp from zero to one between npad/lowcut and 2*npad/lowcut
     #
-    rfft_templates = np.fft.rfft(templates, n=npad, axis=0)
+    k = np.arange(npad//2 + 1)*lowcut/npad
+    filt = np.clip(k - 1, 0, 1)
+    filt = 0.5*(1 - np.cos(np.pi*filt))
 
-    return rfft_templates, npad
+    ccf = fft.irfft(galaxy_rfft*np.conj(template_rfft)*filt, npad, axis=-1)
+
+    # The width of the correlation peak is calibrated against the width of
+    # the autocorrelation of the template, convolved with Gaussians of
+    # dispersion sigma, measured in the same way
+    #
+    sigma_grid = np.append(0, np.geomspace(0.1, 1e3/velScale, 50))
+    omega = 2*np.pi*np.arange(npad//2 + 1)/npad
+    acf = fft.irfft(np.abs(template_rfft)**2*filt*np.exp(-0.5*np.outer(sigma_grid, omega)**2), npad, axis=-1)
+    width_grid = [_peak_width(np.roll(a, npad//2), npad//2) for a in acf]
+
+    # Search the correlation peak at shifts vsyst + V with Vmin < V < Vmax
+    #
+    shift = np.arange(int(np.floor(vsyst + vlims[0])), int(np.ceil(vsyst + vlims[1])) + 1)
+    nspec = spectra.shape[0]
+    vel, sigma, error, r = np.empty((4, nspec))
+    for j in range(nspec):
+        y = ccf[j, shift % npad]
+        jmax = np.clip(np.argmax(y), 1, y.size - 2)
+        den = y[jmax-1] - 2*y[jmax] + y[jmax+1]
+        dx = 0.5*(y[jmax-1] - y[jmax+1])/den if den < 0 else 0.
+        vel[j] = shift[jmax] + dx - vsyst
+        width = _peak_width(y, jmax)
+        sigma[j] = np.interp(width, width_grid, sigma_grid)
+        d = np.arange(1, min(jmax, y.size - 1 - jmax) + 1)
+        noise = np.sqrt(np.mean(0.25*(y[jmax+d] - y[jmax-d])**2)) if d.size else np.inf
+        r[j] = y[jmax]/(np.sqrt(2)*noise)
+        error[j] = 3/8.*np.sqrt(8*np.log(2))*width/(1 + r[j])
+
+    sol = np.array([vel, sigma])*velScale
+    error *= velScale
+    if galaxy.ndim == 1:
+        return sol[:, 0], error[0], r[0]
+    else:
+        return sol, error, r
+
+#-------------------------------------------------------------------------------
+
+def _peak_width(y, j):
+    """
+    Dispersion of a Gaussian fitted to the points of the peak of Y at the
+    index J, with values above half of the maximum
+
+    """
+    half = 0.5*y[j]
+    lo = j
+    while lo > 0 and y[lo-1] > half:
+        lo -= 1
+    hi = j
+    while hi < y.size - 1 and y[hi+1] > half:
+        hi += 1
+    lo, hi = min(lo, j - 1), max(hi, j + 1)
+    x = np.arange(lo, hi + 1) - j
+    a = np.polyfit(x, np.log(np.maximum(y[lo:hi+1], 1e-3*y[j])), 2)[0]
+
+    return np.sqrt(-0.5/a) if a < 0 else 0.
+
+#-------------------------------------------------------------------------------
+
+class _whitening(object):
+    """
+    Cholesky factor L of the covariance matrix COV = L.L^T of the galaxy
+    spectrum. The fit is performed on the whitened system L^-1.[C, GALAXY],
+    which is computed with triangular solves instead of multiplying by the
+    explicit inverse of L.
+
+    COV can be a dense array or a scipy.sparse matrix. When its nonzero
+    elements are confined within a band much narrower than the matrix,
+    the factorization and the solves use the banded LAPACK routines,
+    with O(npix*bandwidth) cost per column instead of O(npix^2).
+
+    """
+    def __init__(self, cov):
+
+        n = cov.shape[0]
+        if sparse.issparse(cov):
+            cov = cov.tocoo()
+            i, j = cov.row, cov.col
+        else:
+            i, j = np.nonzero(cov)
+        p = np.max(np.abs(i - j)) if i.size else 0  # Bandwidth
+
+        self.banded = 4*p < n
+        if self.banded:
+            ab = np.zeros((p + 1, n)) # Lower banded storage ab[i - j, j] = cov[i, j]
+            if sparse.issparse(cov):
+                low = i >= j
+                ab[i[low] - j[low], j[low]] = cov.data[low]
+            else:
+                for d in range(p + 1):
+                    ab[d, :n-d] = np.diagonal(cov, -d)
+            self.lower = linalg.cholesky_banded(ab, lower=True)
+            self.upper = np.zeros_like(self.lower) # Band storage of L^T
+            for d in range(p + 1):
+                self.upper[p-d, d:] = self.lower[d, :n-d]
+            self.bandwidth = p
+        else:
+            if sparse.issparse(cov):
+                cov = cov.toarray()
+            self.lower = linalg.cholesky(cov, lower=True)
+
+    def solve(self, b, trans=False):
+        """
+        Solve L.x = B (or L^T.x = B if TRANS is True) along the first axis of B
+
+        """
+        if self.banded:
+            if trans:
+                return linalg.solve_banded((0, self.bandwidth), self.upper, b)
+            else:
+                return linalg.solve_banded((self.bandwidth, 0), self.lower, b)
+        else:
+            return linalg.solve_triangular(self.lower, b, lower=True, trans='T' if trans else 'N')
+
+#-------------------------------------------------------------------------------
+
+class least_squares_fit(object):
+    """
+    Minimize the residuals returned by FCN with scipy.optimize.least_squares,
+    using the Trust Region Reflective method. The input and the output
+    attributes (PARAMS, PERROR, NFEV, NITER, STATUS) are the ones of
+    cap_mpfit.mpfit, which this class can replace.
+
+    FCN(p, fjac=None) returns [status, residuals] or, when FJAC is not None
+    and AUTODERIVATIVE=0, [status, residuals, jacobian] with the sign
+    convention of MPFIT. PARINFO gives the starting 'value' of the
+    parameters and their 'limits', 'limited', 'fixed' and 'step' (used for
+    the finite differences, forward or backward within the limits).
+
+    """
+    def __init__(self, fcn, parinfo=None, ftol=1e-10, xtol=1e-10, gtol=1e-10,
+                 maxiter=200, autoderivative=1, quiet=1):
+
+        self.fcn = fcn
+        self.params = np.array([par['value'] for par in parinfo], dtype=float)
+        free = np.array([not par.get('fixed', 0) for par in parinfo])
+        self.ifree = np.flatnonzero(free)
+        limited = np.array([par.get('limited', [0, 0]) for par in parinfo], dtype=bool)
+        limits = np.array([par.get('limits', [0., 0.]) for par in parinfo], dtype=float)
+        lower = np.where(limited[:, 0], limits[:, 0], -np.inf)[free]
+        upper = np.where(limited[:, 1], limits[:, 1], np.inf)[free]
+        self.step = np.array([par.get('step', 0.) for par in parinfo], dtype=float)[free]
+        self.lower, self.upper = lower, upper
+        self.nfev = 0
+        self._last = None  # Residuals at the last evaluated parameters
+
+        jac = self._numerical_jac if autoderivative else self._analytic_jac
+        res = optimize.least_squares(self._residuals, self.params[free], jac=jac,
+                                     bounds=(lower, upper), method='trf', x_scale='jac',
+                                     ftol=ftol, xtol=xtol, gtol=gtol,
+                                     max_nfev=maxiter*(1 + len(self.ifree)),
+                                     verbose=0 if quiet else 1)
+        self.params[free] = res.x
+        self.niter = res.njev
+        self.status = res.status
+        self.errmsg = res.message
+
+        # Formal errors from the pseudo-inverse of J^T.J, as in MPFIT
+        # the errors of the fixed parameters are zero
+        u, w, vt = np.linalg.svd(res.jac, full_matrices=False)
+        w = np.where(w > w[0]*1e-14, 1/w, 0.)
+        self.perror = np.zeros_like(self.params)
+        self.perror[free] = np.sqrt(np.sum((vt*w[:, None])**2, 0))
+
+    def _call(self, x, fjac=None):
+        self.nfev += 1
+        pars = self.params.copy()
+        pars[self.ifree] = x
+        return self.fcn(pars, fjac=fjac)
+
+    def _residuals(self, x):
+        f = self._call(x)[1]
+        self._last = x.copy(), f
+        return f
+
+    def _analytic_jac(self, x):
+        """ Jacobian computed by FCN, with the sign convention of MPFIT """
+        out = self._call(x, fjac=np.ones(self.params.size))
+        return -out[2][:, self.ifree]
+
+    def _numerical_jac(self, x):
+        """ One-sided differences with the steps of PARINFO, as in MPFIT """
+        if np.array_equal(x, self._last[0]):
+            f0 = self._last[1]
+        else:
+            f0 = self._call(x)[1]
+        h = np.where(self.step > 0, self.step, np.sqrt(np.finfo(float).eps)*np.maximum(np.abs(x), 1))
+        h = np.where(x + h > self.upper, -h, h)
+        jac = np.empty((f0.size, x.size))
+        for j in range(x.size):
+            xp = x.copy()
+            xp[j] += h[j]
+            jac[:, j] = (self._call(xp)[1] - f0)/h[j]
+        return jac
+
+#-------------------------------------------------------------------------------
+
+_fit_worker = {}  # The ppxf object of the fit, in the processes of a pool
+
+def _init_fit_worker(pp):
+    """ Initializer of the process pool: the ppxf object is sent once """
+    _fit_worker['pp'] = pp
+
+def _worker_fitfunc(goodpixels, clean):
+    """ _fitfunc of the ppxf object of this process, see _pool_fitfunc """
+    pp = _fit_worker['pp']
+    if not np.array_equal(pp.goodpixels, goodpixels):
+        pp.goodpixels = goodpixels  # The workspace is only updated when they change
+    pp.clean = clean
+    return pp._fitfunc
+
+class _pool_fitfunc(object):
+    """
+    ppxf._fitfunc, which is pickled as a reference to the copy of the ppxf
+    object sent once to each process of the pool by _init_fit_worker.
+    Only GOODPIXELS and CLEAN, which change between the cleaning iterations,
+    are sent with every function evaluation
+
+    """
+    def __init__(self, pp):
+        self.pp = pp
+
+    def __call__(self, pars, fjac=None):
+        return self.pp._fitfunc(pars, fjac)
+
+    def __reduce__(self):
+        return _worker_fitfunc, (self.pp.goodpixels, self.pp.clean)
+
+def _process_pool(executor, pp):
+    """
+    Pool of processes with the size of the process pool EXECUTOR, to which
+    the ppxf object PP is sent once by the initializer, instead of being
+    pickled with every function evaluation. None if EXECUTOR is not a
+    process pool
+
+    """
+    if ProcessPoolExecutor is not None and isinstance(executor, ProcessPoolExecutor):
+        return ProcessPoolExecutor(executor._max_workers, initializer=_init_fit_worker,
+                                   initargs=(pp,))
+    if isinstance(executor, multiprocessing.pool.Pool) and \
+            not isinstance(executor, multiprocessing.pool.ThreadPool):
+        return multiprocessing.Pool(executor._processes, _init_fit_worker, (pp,))
+    return None
+
+#-------------------------------------------------------------------------------
+
+def _convolve_templates(star_rfft, losvd_rfft, comp_index, npad, factor, mpoly, out, fft=None):
+    """
+    Convolve the templates with the LOSVD of their kinematic component.
+    All templates of one component are transformed back with a single
+    2-dim inverse FFT and written directly into the columns of OUT
+
+    """
+    if fft is None:
+        fft = fft_backend()
+    nspec = losvd_rfft.shape[2]
+    npix = out.shape[0]//nspec
+    mpoly = np.broadcast_to(np.asarray(mpoly, dtype=out.dtype), npix*nspec)
+    for j, cols in enumerate(comp_index): # loop over kinematic components
+        for k in range(nspec):
+            tt = fft.irfft(star_rfft[:, cols]*losvd_rfft[:, j, k, None], npad, axis=0)
+            if factor == 1:  # No oversampling
+                tt = tt[:npix]
+            else:            # Template was oversampled before convolution
+                tt = tt[:npix*factor].reshape(npix, factor, -1).mean(1)
+            out[k*npix:(k+1)*npix, cols] = mpoly[k*npix:(k+1)*npix, None]*tt
 
 #-------------------------------------------------------------------------------
 
@@ -667,7 +1356,10 @@ class ppxf(object):
     def __init__(self, templates, galaxy, noise, velScale, start,
             bias=None, clean=False, degree=4, goodpixels=None, mdegree=0,
             moments=2, oversample=False, plot=False, quiet=False, sky=None,
-            vsyst=0, regul=0, lam=None, reddening=None, component=0, reg_dim=None):
+            vsyst=0, regul=0, lam=None, reddening=None, component=0, reg_dim=None,
+            autoderivative=False, rfft_cache=None, fft=None, float32=False,
+            executor=None, lapack=False, optimizer='mpfit', analytic_losvd=False,
+            eigen_templates=False):
 
         # Do extensive checking of possible input errors
         #
@@ -684,6 +1376,9 @@ class ppxf(object):
         self.lam = lam
         self.reddening = reddening
         self.reg_dim = np.asarray(reg_dim)
+        self.autoderivative = autoderivative
+        self.analytic_losvd = analytic_losvd
+        self.eigen_templates = eigen_templates
 
         s1 = templates.shape
         if len(s1) == 1: # Single template
@@ -712,6 +1407,9 @@ class ppxf(object):
         if not np.array_equal(tmp, np.arange(self.ncomp)):
             raise ValueError('must be 0 < COMPONENT < NCOMP-1')
 
+        if regul > 0 and eigen_templates:
+            raise ValueError('REGUL cannot be used with EIGEN_TEMPLATES')
+
         if regul > 0 and reg_dim is None:
             if self.ncomp == 1:
                 self.reg_dim = np.asarray(templates.shape[1:])
@@ -744,9 +1442,9 @@ class ppxf(object):
         if len(s3) > 1 and s3[0] == s3[1]: # NOISE is a 2-dim covariance matrix
             if s3[0] != s2[0]:
                 raise ValueError('Covariance Matrix must have size xpix*npix')
-            noise = linalg.cholesky(noise, lower=1) # Cholesky factor of symmetric, positive-definite covariance matrix
-            self.noise = linalg.solve_triangular(noise, np.identity(s3[0]), lower=1) # Invert Cholesky factor
+            self.whitening = _whitening(noise) # Cholesky factor of symmetric, positive-definite covariance matrix
         else:   # NOISE is an error spectrum
+            self.whitening = None
             if not np.equal(s2, s3):
                 raise ValueError('GALAXY and NOISE must have the same size/type')
             if not np.all((noise > 0) & np.isfinite(noise)):
@@ -846,34 +1544,84 @@ class ppxf(object):
 
         # Pre-compute the FFT and possibly oversample the templates
         #
+        if fft is None:
+            fft = fft_backend()
+        elif not isinstance(fft, fft_backend):
+            fft = fft_backend(fft)
+        self.fft = fft
+        self.dtype = np.float32 if float32 else np.float64
         self.star_rfft, self.npad = _rfft_templates(
-            self.star, self.vsyst, vlims, parinfo[1]['limits'][1],
-            self.factor, galaxy.ndim)
+            self.star.astype(self.dtype, copy=False), self.vsyst, vlims, parinfo[1]['limits'][1],
+            self.factor, galaxy.ndim, rfft_cache, fft)
+
+        # Group the templates by kinematic component: all templates sharing
+        # the same LOSVD are convolved together in _fitfunc.
+        # Use a slice (no copy) when the templates of a component are contiguous.
+        #
+        self.comp_index = []
+        for j in range(self.ncomp):
+            cols = np.flatnonzero(self.component == j)
+            if cols[-1] - cols[0] == cols.size - 1:
+                cols = slice(cols[0], cols[-1] + 1)
+            self.comp_index.append(cols)
 
         # Here the actual calculation starts.
         # If required, once the minimum is found, clean the pixels deviating
         # more than 3*sigma from the best fit and repeat the minimization
         # until the set of cleaned pixels does not change any more.
+        # The minimization is not repeated when a Gauss-Newton step, with
+        # the new set of pixels, changes the parameters by less than 0.1*sigma.
+        # Otherwise it starts from the solution of the previous iteration.
         #
         good = self.goodpixels.copy()
-        for j in range(5): # Do at most five cleaning iterations
-            self.clean = False # No cleaning during chi2 optimization
-            mp = mpfit.mpfit(self._fitfunc, parinfo=parinfo, quiet=1, ftol=1e-4)
-            ncalls = mp.nfev
-            if not clean:
-                break
-            goodOld = self.goodpixels.copy()
-            self.goodpixels = good.copy()  # Reset goodpixels
-            self.clean = True  # Do cleaning during linear fit
-            tmp = self._fitfunc(mp.params)
-            if np.array_equal(goodOld, self.goodpixels):
-                break
+        self.reg_matrix = None # Sparse regularization operator, see _workspace
+        self.workspace = {}  # Arrays reused by all _fitfunc calls, one set per thread
+        # With a process pool the ppxf object is sent once to each process
+        pool = _process_pool(executor, self) if optimizer == 'mpfit' and self.autoderivative else None
+        fitfunc = self._fitfunc if pool is None else _pool_fitfunc(self)
+        try:
+            for j in range(5): # Do at most five cleaning iterations
+                self.clean = False # No cleaning during chi2 optimization
+                if j > 0:
+                    if self._converged(mp, parinfo):
+                        break
+                    for par, value in zip(parinfo, mp.params):
+                        par['value'] = value
+                if optimizer == 'mpfit':
+                    mp = mpfit.mpfit(fitfunc, parinfo=parinfo, quiet=1, ftol=1e-4,
+                                     autoderivative=int(self.autoderivative),
+                                     executor=executor if pool is None else pool,
+                                     lapack=int(lapack))
+                elif optimizer == 'least_squares':
+                    mp = least_squares_fit(self._fitfunc, parinfo=parinfo, quiet=1, ftol=1e-4,
+                                           autoderivative=int(self.autoderivative))
+                elif callable(optimizer):
+                    mp = optimizer(self._fitfunc, parinfo=parinfo, quiet=1, ftol=1e-4,
+                                   autoderivative=int(self.autoderivative))
+                else:
+                    raise ValueError("OPTIMIZER must be 'mpfit', 'least_squares' or a function")
+                self.nfev = mp.nfev
+                if not clean:
+                    break
+                goodOld = self.goodpixels.copy()
+                self.goodpixels = good.copy()  # Reset goodpixels
+                self.clean = True  # Do cleaning during linear fit
+                tmp = self._fitfunc(mp.params)
+                if np.array_equal(goodOld, self.goodpixels):
+                    break
+        finally:
+            if pool is not None:
+                if hasattr(pool, 'shutdown'):
+                    pool.shutdown()
+                else:
+                    pool.terminate()
 
         # Evaluate scatter at the bestfit (with BIAS=0)
         # and also get the output bestfit and weights.
         #
         self.bias = 0
         status, err = self._fitfunc(mp.params)
+        self.workspace = None  # self.matrix keeps the final Design Matrix
         self.chi2 = robust_sigma(err, zero=True)**2   # Robust computation of Chi**2/DOF.
 
         p = 0
@@ -892,16 +1640,22 @@ class ppxf(object):
         if degree >= 0:
             self.polyweights = self.weights[:(self.degree+1)*len(s2)] # output weights for the additive polynomials
         self.weights = self.weights[(self.degree+1)*len(s2):] # output weights for the templates (or sky) only
+        if eigen_templates:
+            ntemp = self.star.shape[1]
+            self.positive = all(np.all(self.star[:, self.component == j].dot(
+                self.weights[:ntemp][self.component == j]) > 0) for j in range(self.ncomp))
         if not quiet:
             print("Best Fit:       V     sigma        h3        h4        h5        h6")
             for j in range(self.ncomp):
                 print("comp.", j, "".join("%10.3g" % f for f in self.sol[j]))
             print("chi2/DOF: %.4g" % self.chi2)
-            print('Function evaluations:', ncalls)
+            print('Function evaluations:', self.nfev)
             nw = self.weights.size
             if reddening is not None:
                 print('Reddening E(B-V): ', self.reddening)
             print('Nonzero Templates: ', np.sum(self.weights > 0), ' / ', nw)
+            if eigen_templates and not self.positive:
+                print('Warning: the reconstructed template is not positive')
             if self.weights.size <= 20:
                 print('Templates weights:')
                 print("".join("%8.3g" % f for f in self.weights))
@@ -936,6 +1690,19 @@ class ppxf(object):
             for gj in self.goodpixels[w]:
                 plt.plot([gj, gj], [mn, self.bestfit[gj]], 'LimeGreen')
 
+#-------------------------------------------------------------------------------
+
+    def __getstate__(self):
+        """
+        The workspace is not pickled, e.g. when _fitfunc is sent to a process
+        pool by MPFIT: each process allocates its own arrays
+
+        """
+        state = self.__dict__.copy()
+        if state.get('workspace'):
+            state['workspace'] = {}
+        return state
+
 #-------------------------------------------------------------------------------
 
     def _fitfunc(self, pars, fjac=None):
@@ -962,47 +1729,42 @@ class ppxf(object):
         else:
             dx = int(np.ceil(np.max(abs(self.vsyst + pars[0+vj]) + 5*pars[1+vj])))
 
-        nl = 2*dx*self.factor + 1
-        x = np.linspace(-dx, dx, nl)   # Evaluate the Gaussian using steps of 1/factor pixel
-        losvd = np.empty((nl, self.ncomp, nspec))
-        for j, p in enumerate(vj):    # loop over kinematic components
-            for k in range(nspec):    # nspec=2 for two-sided fitting, otherwise nspec=1
-                s = 1 if k == 0 else -1 # s=+1 for left spectrum, s=-1 for right one
-                vel = self.vsyst + s*pars[0+p]
-                w = (x - vel)/pars[1+p]
-                w2 = w**2
-                gauss = np.exp(-0.5*w2)
-                losvd[:, j, k] = gauss/gauss.sum()
-
-                # Hermite polynomials normalized as in Appendix A of van der Marel & Franx (1993).
-                # Coefficients for h5, h6 are given e.g. in Appendix C of Cappellari et al. (2002)
-                #
-                if self.moments[j] > 2:        # h_3 h_4
-                    poly = 1 + s*pars[2+p]/np.sqrt(3)*(w*(2*w2-3)) \
-                             + pars[3+p]/np.sqrt(24)*(w2*(4*w2-12)+3)
-                    if self.moments[j] == 6:  # h_5 h_6
-                        poly += s*pars[4+p]/np.sqrt(60)*(w*(w2*(4*w2-20)+15)) \
-                              + pars[5+p]/np.sqrt(720)*(w2*(w2*(8*w2-60)+90)-15)
-                    losvd[:, j, k] *= poly
-
-        # Compute the FFT of all LOSVDs
-        #
-        losvd_pad = np.zeros((self.npad, self.ncomp, nspec))
-        losvd_pad[:nl, :, :] = losvd                        # Zero padding
-        losvd_pad = np.roll(losvd_pad, (2 - nl)//2, axis=0) # Bring kernel center to first position
-        losvd_rfft = np.fft.rfft(losvd_pad, axis=0)
+        ws = self._workspace()
+
+        if self.analytic_losvd:
+            # Analytic Fourier transform of the LOSVDs, at the frequencies of the
+            # FFT of the templates. This is not truncated nor undersampled.
+            #
+            losvd_rfft = _losvd_kernels(pars[:ngh], self.moments, self.vsyst,
+                                        ws['omega'], nspec, rfft=True)
+            losvd_rfft = losvd_rfft.astype(np.result_type(self.dtype, np.complex64), copy=False)
+        else:
+            nl = 2*dx*self.factor + 1
+            x = np.linspace(-dx, dx, nl)   # Evaluate the Gaussian using steps of 1/factor pixel
+            losvd = _losvd_kernels(pars[:ngh], self.moments, self.vsyst, x, nspec)
+
+            # Compute the FFT of all LOSVDs. The zero-padded kernels are written
+            # wrapped around, with their center in the first position
+            #
+            losvd_pad = ws['losvd_pad']
+            m = (nl - 1)//2
+            losvd_pad[:nl-m] = losvd[m:]
+            losvd_pad[nl-m:self.npad-m] = 0
+            losvd_pad[self.npad-m:] = losvd[:m]
+            losvd_rfft = self.fft.rfft(losvd_pad, self.npad, axis=0)
 
         # The zeroth order multiplicative term is already included in the
         # linear fit of the templates. The polynomial below has mean of 1.
+        # The Legendre polynomials are evaluated once in the workspace.
         #
-        x = np.linspace(-1, 1, npix) # X needs to be within [-1, 1] for Legendre Polynomials
         if self.mdegree > 0:
+            vand = ws['vander'][:, 1:self.mdegree+1]
             if nspec == 2: # Different multiplicative poly for left and right spectra
-                mpoly1 = legendre.legval(x, np.append(1.0, pars[ngh::2]))
-                mpoly2 = legendre.legval(x, np.append(1.0, pars[ngh+1::2]))
+                mpoly1 = 1 + vand.dot(pars[ngh::2])
+                mpoly2 = 1 + vand.dot(pars[ngh+1::2])
                 mpoly = np.append(mpoly1, mpoly2)
             else:
-                mpoly = legendre.legval(x, np.append(1.0, pars[ngh:]))
+                mpoly = 1 + vand.dot(pars[ngh:])
         else:
             mpoly = 1.0
 
@@ -1012,6 +1774,114 @@ class ppxf(object):
         if self.reddening is not None:
             mpoly = reddening_curve(self.lam, pars[ngh])
 
+        # Only the template columns of the Design Matrix change between calls:
+        # the additive polynomials and the sky are filled once in the workspace
+        #
+        npoly = ws['npoly']
+        ntemp = self.star.shape[1]
+        c = ws['c']  # This array is used for estimating predictions
+        _convolve_templates(self.star_rfft, losvd_rfft, self.comp_index,
+                            self.npad, self.factor, mpoly, c[:, npoly:npoly+ntemp], self.fft)
+
+        # Select the spectral region to fit and solve the overconditioned system
+        # using SVD/BVLS. Use unweighted array for estimating bestfit predictions.
+        # The regularization rows are passed as the sparse operator self.reg_matrix.
+        # Iterate to exclude pixels deviating more than 3*sigma if /CLEAN keyword is set.
+
+        # When cleaning, the outliers are removed from the weighted system and
+        # their contribution is subtracted from the normal equations, instead
+        # of building and factorizing the system again from the Design Matrix.
+
+        aa, bb = self._weighted_system(c)
+        nfree = npoly + ntemp if self.eigen_templates else npoly # Unconstrained weights
+        normal = (aa.T.dot(aa), aa.T.dot(bb)) if self.clean else None
+        while True:
+            weights = _bvls_solve(aa, bb, nfree, ws['passive'], self.reg_matrix, normal)
+            ws['passive'] = weights != 0 # Warm start NNLS at the next call of this thread
+            err = bb - aa.dot(weights) # Weighted residuals of the GOODPIXELS, in double precision
+            if not self.clean:
+                break
+            w = np.abs(err) < 3  # select residuals smaller than 3*sigma
+            m = err.size - w.sum()
+            if m == 0:
+                break
+            self.goodpixels = self.goodpixels[w]
+            if not self.quiet:
+                print('Outliers:', m)
+            out = ~w
+            normal = (normal[0] - aa[out].T.dot(aa[out]), normal[1] - aa[out].T.dot(bb[out]))
+            aa, bb = aa[w], bb[w]
+
+        self.weights = weights
+        self.bestfit = c.dot(weights)
+        self.matrix = c  # Returns LOSVD-convolved design matrix
+
+        # Penalize the solution towards (h3, h4, ...) = 0 if the inclusion of
+        # these additional terms does not significantly decrease the error.
+        # The lines below implement eq.(8)-(9) in Cappellari & Emsellem (2004)
+        #
+        if fjac is not None: # Analytic derivatives requested by MPFIT
+            jac = self._jacobian(pars, fjac, vj, dx, mpoly, losvd_rfft, aa, bb, npoly)
+
+        if np.any(self.moments > 2) and self.bias != 0:
+            D2 = 0.
+            for j, p in enumerate(vj): # loop over kinematic components
+                if self.moments[j] > 2:  
+                    D2 += np.sum(pars[2+p:self.moments[j]+p]**2)  # eq.(8)
+            penalty = self.bias*robust_sigma(err, zero=True)
+            err += penalty*np.sqrt(D2)  # eq.(9)
+            if fjac is not None and D2 > 0: # The robust sigma is kept constant
+                for j, p in enumerate(vj):
+                    if self.moments[j] > 2:
+                        jac[:, 2+p:self.moments[j]+p] -= penalty*pars[2+p:self.moments[j]+p]/np.sqrt(D2)
+
+        if fjac is None:
+            return 0, err
+        else:
+            return 0, err, jac
+
+#-------------------------------------------------------------------------------
+
+    def _converged(self, mp, parinfo, tol=0.1):
+        """
+        True if a Gauss-Newton step from the solution MP of the previous
+        cleaning iteration, using the current GOODPIXELS and the analytic
+        derivatives, changes all free parameters by less than TOL times
+        their formal errors. In this case the solution would not change
+        significantly by repeating the nonlinear minimization.
+        The parameters pegged at their limits, which have zero formal
+        errors, are kept fixed. Without errors (e.g. when the minimization
+        failed) the minimization is always repeated
+
+        """
+        if mp.perror is None:
+            return False
+        free = np.array([not p['fixed'] for p in parinfo]) & (mp.perror > 0)
+        if not free.any():
+            return True
+        status, err, jac = self._fitfunc(mp.params, fjac=free.astype(int))
+        step = linalg.lstsq(jac[:, free], err)[0]
+
+        return np.all(np.abs(step) <= tol*mp.perror[free])
+
+#-------------------------------------------------------------------------------
+
+    def _workspace(self):
+        """
+        Arrays reused by all _fitfunc calls of one fit. They are allocated,
+        and the constant columns of the Design Matrix filled, at the first call.
+        Each thread has its own arrays, as MPFIT may call _fitfunc concurrently
+
+        """
+        if self.workspace is None:
+            self.workspace = {}
+        thread = threading.current_thread().ident
+        if thread in self.workspace:
+            return self.workspace[thread]
+
+        nspec = self.galaxy.ndim
+        npix = self.galaxy.shape[0]
+
         skydim = len(np.shape(self.sky))  # This can be zero
         if skydim == 0:
             nsky = 0
@@ -1020,44 +1890,23 @@ class ppxf(object):
         else:
             nsky = np.shape(self.sky)[1]
 
-        tempdim = self.star.ndim
-        ntemp = self.star.shape[1] if tempdim == 2 else 1 # Number of template spectra
-
+        ntemp = self.star.shape[1] # Number of template spectra
         npoly = (self.degree + 1)*nspec # Number of additive polynomials in the fit
         nrows = npoly + nsky*nspec + ntemp
-        ncols = npix*nspec
         if self.regul > 0:
-            dim = self.reg_dim.size
-            reg2 = self.reg_dim - 2
-            if dim == 1:
-                nreg = reg2
-            elif dim == 2:
-                nreg = 2*np.prod(reg2) + 2*np.sum(reg2) # Rectangle sides have one finite difference
-            elif dim == 3:                              # Hyper-rectangle edges have one finite difference
-                nreg = 3*np.prod(reg2) + 4*np.sum(reg2) \
-                     + 4*(np.prod(reg2[[0, 1]]) + np.prod(reg2[[0, 2]]) + np.prod(reg2[[1, 2]]))
-            ncols += nreg
-
-        c = np.zeros((npix*nspec, nrows))  # This array is used for estimating predictions
+            self.reg_matrix = _regularization_matrix(self.reg_dim, self.regul, npoly, nrows)
+
+        x = np.linspace(-1, 1, npix) # X needs to be within [-1, 1] for Legendre Polynomials
+        vand = legendre.legvander(x, max(self.degree, self.mdegree, 0))
+        c = np.zeros((npix*nspec, nrows), dtype=self.dtype)
 
         if self.degree >= 0: # Fill first columns of the Design Matrix
-            vand = legendre.legvander(x, self.degree)
             if nspec == 2:
-                for j, leg in enumerate(vand.T):
+                for j, leg in enumerate(vand[:, :self.degree+1].T):
                     c[:npix, 2*j] = leg   # Additive polynomials for left spectrum
                     c[npix:, 2*j+1] = leg # Additive polynomials for right spectrum
             else:
-                c[:, :npoly] = vand
-
-        tmp = np.empty((self.star.shape[0], nspec))
-        for j, star_rfft in enumerate(self.star_rfft.T): # loop over columns
-            for k in range(nspec):
-                tt = np.fft.irfft(star_rfft*losvd_rfft[:, int(self.component[j]), k])
-                if self.factor == 1:  # No oversampling
-                    tmp[:, k] = tt[:self.star.shape[0]]
-                else:                 # Template was oversampled before convolution
-                    tmp[:, k] = rebin(tt[:self.star.shape[0]*self.factor], self.factor)
-            c[:, npoly+j] = mpoly*tmp[:npix, :].ravel()  # reform into a vector
+                c[:, :npoly] = vand[:, :npoly]
 
         for j in range(nsky):
             skyj = self.sky[:, j]
@@ -1068,92 +1917,732 @@ class ppxf(object):
             else:
                 c[:, k+j] = skyj
 
-        a = np.zeros((ncols, nrows)) # This array is used for the system solution
+        ws = {'c': c, 'vander': vand, 'npoly': npoly, 'goodpixels': None, 'passive': None}
+        if self.analytic_losvd: # Angular frequencies of the rfft, in 1/pixels
+            ws['omega'] = 2*np.pi*self.factor*np.arange(self.npad//2 + 1)/self.npad
+        else:
+            ws['losvd_pad'] = np.zeros((self.npad, self.ncomp, nspec), dtype=self.dtype)
+        self.workspace[thread] = ws
 
-        s3 = self.noise.shape
-        if len(s3) > 1 and s3[0] == s3[1]: # input NOISE is a npix*npix covariance matrix
-            a[:npix*nspec, :] = self.noise.dot(c)
-            b = self.noise.dot(self.galaxy)
-        else:                              # input NOISE is a 1sigma error vector
-            a[:npix*nspec, :] = c / self.noise[:, None] # Weight all columns with errors
-            b = self.galaxy / self.noise
+        return ws
 
-        # Add second-degree 1D, 2D or 3D linear regularization
-        # Press W.H., et al., 2007, Numerical Recipes, 3rd ed. equation (19.5.10)
-        #
-        if self.regul > 0:
-            i = npoly + np.arange(np.prod(self.reg_dim)).reshape(self.reg_dim)
-            p = npix*nspec
-            diff = np.array([-1, 2, -1])*self.regul
-            ind = np.array([-1, 0, 1])
-            if dim == 1:
-                for j in range(1, self.reg_dim-1):
-                    a[p, i[j+ind]] = diff
-                    p += 1
-            elif dim == 2:
-                for k in range(self.reg_dim[1]):
-                    for j in range(self.reg_dim[0]):
-                        if 0 != j != self.reg_dim[0]-1:
-                            a[p, i[j+ind, k]] = diff
-                            p += 1
-                        if 0 != k != self.reg_dim[1]-1:
-                            a[p, i[j, k+ind]] = diff
-                            p += 1
-            elif dim == 3:
-                for q in range(self.reg_dim[2]):
-                    for k in range(self.reg_dim[1]):
-                        for j in range(self.reg_dim[0]):
-                            if 0 != j != self.reg_dim[0]-1:
-                                a[p, i[j+ind, k, q]] = diff
-                                p += 1
-                            if 0 != k != self.reg_dim[1]-1:
-                                a[p, i[j, k+ind, q]] = diff
-                                p += 1
-                            if 0 != q != self.reg_dim[2]-1:
-                                a[p, i[j, k, q+ind]] = diff
-                                p += 1
+#-------------------------------------------------------------------------------
 
-        # Select the spectral region to fit and solve the overconditioned system
-        # using SVD/BVLS. Use unweighted array for estimating bestfit predictions.
-        # Iterate to exclude pixels deviating more than 3*sigma if /CLEAN keyword is set.
+    def _weighted_system(self, c):
+        """
+        Rows of the Design Matrix C and of the GALAXY spectrum for the
+        current GOODPIXELS, weighted by the errors. These are written into
+        arrays which are only reallocated when GOODPIXELS change
+
+        """
+        ws = self._workspace()
+        good = self.goodpixels
+        if ws['goodpixels'] is not good:
+            ws['goodpixels'] = good
+            ws['aa'] = np.empty((good.size, c.shape[1]))
+            if self.whitening is not None: # input NOISE is a npix*npix covariance matrix
+                ws['bb'] = self.whitening.solve(self.galaxy)[good]
+            else:
+                ws['noise'] = 1/self.noise[good, None]
+                ws['bb'] = self.galaxy[good]/self.noise[good]
+                ws['rows'] = np.empty((good.size, c.shape[1]), dtype=c.dtype)
+
+        aa = ws['aa']
+        if self.whitening is not None:
+            aa[...] = self.whitening.solve(c)[good]
+        else:
+            np.take(c, good, axis=0, out=ws['rows'])
+            np.multiply(ws['rows'], ws['noise'], out=aa) # Weight all columns with errors
+
+        return aa, ws['bb']
+
+#-------------------------------------------------------------------------------
+
+    def _dlosvd_sampled(self, gh, nspec, x):
+        """
+        FFT of the derivatives of the LOSVD of one kinematic component, with
+        parameters GH = [vel, sigma, h3, ...], sampled at the pixels X.
+        The output has dimensions [npad//2 + 1, len(gh), nspec]
+
+        """
+        mj = gh.size
+        nl = x.size
+        dlosvd = np.zeros((self.npad, mj, nspec), dtype=self.dtype)
+        for k in range(nspec):
+            s = 1 if k == 0 else -1
+            sigma = gh[1]
+            w = (x - self.vsyst - s*gh[0])/sigma
+            w2 = w**2
+            gauss = np.exp(-0.5*w2)
+            g = gauss/gauss.sum()
+            dw = [np.full_like(w, -s/sigma), -w/sigma] # dw/dV, dw/dsigma
+            poly = 1.
+            dpoly = 0.   # d(poly)/dw
+            hpoly = []   # d(poly)/dh_m
+            if mj > 2:
+                hpoly = [s*(w*(2*w2-3))/np.sqrt(3), (w2*(4*w2-12)+3)/np.sqrt(24)]
+                dpoly = s*gh[2]*(6*w2-3)/np.sqrt(3) \
+                      + gh[3]*(w*(16*w2-24))/np.sqrt(24)
+                if mj == 6:
+                    hpoly += [s*(w*(w2*(4*w2-20)+15))/np.sqrt(60),
+                              (w2*(w2*(8*w2-60)+90)-15)/np.sqrt(720)]
+                    dpoly += s*gh[4]*(w2*(20*w2-60)+15)/np.sqrt(60) \
+                           + gh[5]*(w*(w2*(48*w2-240)+180))/np.sqrt(720)
+                poly += np.dot(gh[2:], hpoly)
+            for q in range(2):
+                dg = -w*dw[q]*g
+                dg -= g*dg.sum()  # Derivative of the normalized Gaussian
+                dlosvd[:nl, q, k] = dg*poly + g*dpoly*dw[q]
+            for q, hp in enumerate(hpoly):
+                dlosvd[:nl, 2+q, k] = g*hp
+
+        dlosvd = np.roll(dlosvd, (2 - nl)//2, axis=0)
+
+        return self.fft.rfft(dlosvd, self.npad, axis=0)
+
+#-------------------------------------------------------------------------------
+
+    def _dlosvd_rfft(self, gh, nspec):
+        """
+        Analytic derivatives of the Fourier transform of the LOSVD of one
+        kinematic component (see _losvd_rfft), with respect to its
+        parameters GH = [vel, sigma, h3, ...].
+        The output has dimensions [npad//2 + 1, len(gh), nspec]
+
+        """
+        mj = gh.size
+        omega = self._workspace()['omega']
+        dlosvd_rfft = np.empty((omega.size, mj, nspec), dtype=np.result_type(self.dtype, np.complex64))
+        for k in range(nspec):
+            s = 1 if k == 0 else -1
+            w = omega*gh[1]
+            gauss = np.exp(-1j*omega*(self.vsyst + s*gh[0]) - 0.5*w**2)
+            poly, dpoly = 1., 0.   # Hermite series and its derivative with respect to w
+            if mj > 2:
+                h = gh[2:, None].copy()
+                h[::2] *= s        # h3, h5 change sign for the right spectrum
+                poly = _hermite_rfft(w, h)
+                dpoly = _hermite_rfft(w, h, deriv=True)
+                for q in range(mj - 2):
+                    unit = np.zeros((mj - 2, 1))
+                    unit[q] = 1 if q % 2 else s
+                    dlosvd_rfft[:, 2+q, k] = gauss*(_hermite_rfft(w, unit) - 1)
+            dlosvd_rfft[:, 0, k] = -1j*s*omega*gauss*poly           # d/dV
+            dlosvd_rfft[:, 1, k] = omega*gauss*(dpoly - w*poly)     # d/dsigma
+
+        return dlosvd_rfft
+
+#-------------------------------------------------------------------------------
+
+    def _jacobian(self, pars, fjac, vj, dx, mpoly, losvd_rfft, aa, bb, npoly):
+        """
+        Analytic derivatives of the model with respect to the nonlinear
+        parameters, as required by MPFIT with autoderivative=0.
+
+        The linear weights are eliminated with the variable projection
+        method of Golub & Pereyra (1973, SIAM J. Numer. Anal., 10, 413):
+        the BVLS solution is treated as an unconstrained least-squares fit
+        to the columns with nonzero weight (the passive set).
+
+        """
+        nspec = self.galaxy.ndim
+        npix = self.galaxy.shape[0]
+        ngood = np.size(self.goodpixels)
 
-        m = 1
-        while m != 0:
-            if self.regul > 0:
-                aa = a[np.append(self.goodpixels, np.arange(npix*nspec, ncols)), :]
-                bb = np.append(b[self.goodpixels], np.zeros(nreg))
+        # Passive set: additive polynomials and all nonzero weights.
+        # Only the template columns depend on the nonlinear parameters.
+        #
+        free = np.union1d(np.arange(npoly), np.flatnonzero(self.weights))
+        ntemp = self.star.shape[1]
+        tfree = free[(free >= npoly) & (free < npoly + ntemp)] - npoly
+        comp = self.component[tfree]
+        dc = np.zeros((pars.size, npix*nspec, tfree.size), dtype=self.dtype)
+
+        nl = 2*dx*self.factor + 1
+        x = np.linspace(-dx, dx, nl)
+        for j, p in enumerate(vj):    # loop over kinematic components
+            mj = self.moments[j]
+            tj = np.flatnonzero(comp == j)
+            if not (np.any(fjac[p:p+mj]) and tj.size):
+                continue
+            if self.analytic_losvd:
+                dlosvd_rfft = self._dlosvd_rfft(pars[p:p+mj], nspec)
             else:
-                aa = a[self.goodpixels, :]
-                bb = b[self.goodpixels]
-            self.weights = _bvls_solve(aa, bb, npoly)
-            self.bestfit = c.dot(self.weights)
-            if len(s3) > 1 and s3[0] == s3[1]: # input NOISE is a npix*npix covariance matrix
-                err = self.noise.dot(self.galaxy - self.bestfit)[self.goodpixels]
-            else:                              # input NOISE is a 1sigma error vector
-                err = ((self.galaxy - self.bestfit)/self.noise)[self.goodpixels]
-            if self.clean:
-                w = np.abs(err) < 3  # select residuals smaller than 3*sigma
-                m = err.size - w.sum()
-                if m > 0:
-                    self.goodpixels = self.goodpixels[w]
-                    if not self.quiet:
-                        print('Outliers:', m)
+                dlosvd_rfft = self._dlosvd_sampled(pars[p:p+mj], nspec, x)
+
+            # Convolve the passive templates of this component with
+            # the derivatives of its LOSVD
+            #
+            star_rfft = self.star_rfft[:, tfree[tj]]
+            for q in range(mj):
+                if fjac[p+q]:
+                    tt = dc[p+q] if tj.size == tfree.size else np.empty((npix*nspec, tj.size), dtype=self.dtype)
+                    _convolve_templates(star_rfft, dlosvd_rfft[:, q, None, :], [slice(None)],
+                                        self.npad, self.factor, mpoly, tt, self.fft)
+                    dc[p+q][:, tj] = tt
+
+        ngh = vj[-1] + self.moments[-1]
+        if (self.mdegree > 0 or self.reddening is not None) and tfree.size:
+            conv = np.empty((npix*nspec, tfree.size), dtype=self.dtype) # Templates convolved with the LOSVD
+            comp_index = [np.flatnonzero(comp == j) for j in range(self.ncomp)]
+            _convolve_templates(self.star_rfft[:, tfree], losvd_rfft, comp_index,
+                                self.npad, self.factor, 1., conv, self.fft)
+            if self.reddening is not None:
+                frac = np.log(reddening_curve(self.lam, 1.)) # d(log(mpoly))/d(E(B-V))
+                dc[ngh] = (mpoly*frac)[:, None]*conv
             else:
+                leg = legendre.legvander(np.linspace(-1, 1, npix), self.mdegree)
+                for k in range(nspec):
+                    rows = slice(k*npix, (k+1)*npix)
+                    for q in range(1, self.mdegree + 1):
+                        dc[ngh + (q - 1)*nspec + k, rows] = leg[:, q, None]*conv[rows]
+
+        # Variable projection derivative of the weighted model, with P the
+        # projector orthogonal to the passive columns A and r the residuals:
+        #   d(model) = P.dA.w + pinv(A)^T.dA^T.r
+        # The noise weighting of dA is applied to the products with w and r.
+        # Regularization rows do not depend on the nonlinear parameters.
+        # With FLOAT32 the products with dA are computed in single precision.
+        #
+        af = aa[:, free]
+        r = bb - af.dot(self.weights[free])
+        if self.reg_matrix is not None:
+            reg = self.reg_matrix[:, free].toarray()
+            af = np.vstack([af, reg])
+            r = np.append(r, -reg.dot(self.weights[free]))
+        dcw = dc.dot(self.weights[npoly + tfree].astype(self.dtype))
+        if self.whitening is not None: # input NOISE is a npix*npix covariance matrix
+            daw = self.whitening.solve(dcw.T)[self.goodpixels]
+            rw = np.zeros(npix*nspec)
+            rw[self.goodpixels] = r[:ngood]
+            rw = self.whitening.solve(rw, trans=True)
+        else:                              # input NOISE is a 1sigma error vector
+            daw = (dcw[:, self.goodpixels]/self.noise[self.goodpixels]).T
+            rw = np.zeros(npix*nspec)
+            rw[self.goodpixels] = r[:ngood]/self.noise[self.goodpixels]
+        daw = np.append(daw, np.zeros((af.shape[0] - ngood, pars.size)), axis=0)
+        q, rr = np.linalg.qr(af)
+        daw -= q.dot(q[:ngood].T.dot(daw[:ngood]))
+        dar = np.zeros((free.size, pars.size))
+        dar[np.searchsorted(free, npoly + tfree)] = rw.astype(self.dtype).dot(dc).T
+        daw += q.dot(linalg.solve_triangular(rr, dar, trans='T'))
+
+        return daw[:ngood]
+
+#-------------------------------------------------------------------------------
+
+def _losvd_batch(pars, moments, vsyst, x):
+    """
+    Gauss-Hermite LOSVDs of all kinematic components, sampled at the pixels X,
+    for a batch of parameters PARS[nbatch, sum(moments)] in pixels, as in
+    ppxf._fitfunc. The output has dimensions [nbatch, ncomp, x.size].
+    All components and parameter sets are evaluated together
+
+    """
+    moments = np.asarray(moments)
+    vj = np.cumsum(moments) - moments  # Index of vel_j for all components
+    vel = vsyst + pars[:, vj, None]
+    w = (x - vel)/pars[:, vj + 1, None]
+    w2 = w**2
+    gauss = np.exp(-0.5*w2)
+    losvd = gauss/gauss.sum(2)[..., None]
+
+    # Hermite polynomials normalized as in Appendix A of van der Marel & Franx (1993).
+    # Coefficients for h5, h6 are given e.g. in Appendix C of Cappellari et al. (2002)
+    #
+    # The polynomials are only evaluated for the components with h3, h4
+    # (and h5, h6). They are selected without copies when all components
+    # have the same MOMENTS.
+    #
+    c4 = np.flatnonzero(moments > 2)
+    if c4.size:
+        sel = slice(None) if c4.size == moments.size else c4
+        w, w2, p = w[:, sel], w2[:, sel], vj[c4]
+        poly = 1 + pars[:, p+2, None]/np.sqrt(3)*(w*(2*w2-3)) \
+                 + pars[:, p+3, None]/np.sqrt(24)*(w2*(4*w2-12)+3)
+        c6 = moments[c4] == 6
+        if np.any(c6):
+            sel6 = slice(None) if np.all(c6) else np.flatnonzero(c6)
+            w, w2, p = w[:, sel6], w2[:, sel6], p[sel6]
+            poly[:, sel6] += pars[:, p+4, None]/np.sqrt(60)*(w*(w2*(4*w2-20)+15)) \
+                           + pars[:, p+5, None]/np.sqrt(720)*(w2*(w2*(8*w2-60)+90)-15)
+        losvd[:, sel] *= poly
+
+    return losvd
+
+#-------------------------------------------------------------------------------
+
+def _hermite_rfft(w, h, deriv=False):
+    """
+    Fourier transform of the Gauss-Hermite series [1 + sum(h_m*H_m(y))],
+    divided by the Gaussian: the normalized Hermite polynomials H_m times the
+    Gaussian are eigenfunctions of the Fourier transform with eigenvalue
+    (-i)^m. Here W = omega*sigma and H[m-3] are the coefficients (h3, h4, ...).
+    With DERIV=True returns the derivative with respect to W
+
+    """
+    w2 = w**2
+    if deriv:
+        poly = 1j*h[0]*(6*w2-3)/np.sqrt(3) \
+             + h[1]*(w*(16*w2-24))/np.sqrt(24)
+        if len(h) > 2:
+            poly = poly - 1j*h[2]*(w2*(20*w2-60)+15)/np.sqrt(60) \
+                        - h[3]*(w*(w2*(48*w2-240)+180))/np.sqrt(720)
+    else:
+        poly = 1 + 1j*h[0]*(w*(2*w2-3))/np.sqrt(3) \
+                 + h[1]*(w2*(4*w2-12)+3)/np.sqrt(24)
+        if len(h) > 2:
+            poly = poly - 1j*h[2]*(w*(w2*(4*w2-20)+15))/np.sqrt(60) \
+                        - h[3]*(w2*(w2*(8*w2-60)+90)-15)/np.sqrt(720)
+
+    return poly
+
+#-------------------------------------------------------------------------------
+
+def _losvd_rfft(pars, moments, vsyst, omega):
+    """
+    Analytic Fourier transform of the Gauss-Hermite LOSVDs of _losvd_batch,
+    at the angular frequencies OMEGA (in 1/pixels), for a batch of parameters
+    PARS[nbatch, sum(moments)] in pixels. The output has dimensions
+    [nbatch, ncomp, omega.size]. With omega = 2*pi*factor*k/npad this is
+    the rfft of the LOSVD sampled with steps of 1/factor pixel, without
+    truncation at 5*sigma and without undersampling when sigma < 1 pixel.
+    See e.g. Section 3.2 of Cappellari (2017, MNRAS, 466, 798)
+
+    """
+    moments = np.asarray(moments)
+    vj = np.cumsum(moments) - moments  # Index of vel_j for all components
+    vel = vsyst + pars[:, vj, None]
+    w = omega*pars[:, vj + 1, None]
+    losvd_rfft = np.exp(-1j*omega*vel - 0.5*w**2)
+
+    c4 = np.flatnonzero(moments > 2)
+    if c4.size:
+        sel = slice(None) if c4.size == moments.size else c4
+        h = pars[:, vj[c4, None] + np.arange(2, np.max(moments)), None]
+        h[:, moments[c4] < 6, 2:] = 0  # no h5, h6 for these components
+        losvd_rfft[:, sel] *= _hermite_rfft(w[:, sel], np.moveaxis(h, 2, 0))
+
+    return losvd_rfft
+
+#-------------------------------------------------------------------------------
+
+def _losvd_kernels(pars, moments, vsyst, x, nspec, rfft=False):
+    """
+    LOSVDs of all kinematic components and sides, with dimensions
+    [x.size, ncomp, nspec], evaluated together with _losvd_batch.
+    For the right spectrum of two-sided fitting (nspec=2) the LOSVD is
+    reflected: the odd moments (vel, h3, h5) change sign.
+    With RFFT=True, X are angular frequencies and the output is the
+    Fourier transform of the LOSVDs, evaluated with _losvd_rfft
+
+    """
+    gh = pars[None, :]
+    if nspec == 2:
+        sign = np.ones(pars.size)
+        sign[:: 2] = -1  # vel, h3, h5 of all components when MOMENTS are even
+        gh = np.vstack([pars, sign*pars])
+
+    if rfft:
+        return _losvd_rfft(gh, moments, vsyst, x).T
+    else:
+        return _losvd_batch(gh, moments, vsyst, x).T
+
+#-------------------------------------------------------------------------------
+
+def _wrap_kernels(kernels, npad):
+    """
+    Zero pad the kernels along the last axis to length NPAD, with their
+    central element in the first position, as required by the FFT convolution
+
+    """
+    nl = kernels.shape[-1]
+    m = (nl - 1)//2
+    pad = np.zeros(kernels.shape[:-1] + (npad,))
+    pad[..., :nl-m] = kernels[..., m:]
+    pad[..., npad-m:] = kernels[..., :m]
+
+    return pad
+
+#-------------------------------------------------------------------------------
+
+class ppxf_batch(object):
+    """
+    Fit many galaxy spectra with the same templates, velocity scale and
+    GOODPIXELS. GALAXY has dimensions [npix, nspec], with one spectrum per
+    column, and NOISE has the same dimensions or is a single error spectrum
+    [npix] for all of them. START is either the ppxf START, common to all
+    spectra, or a list with one ppxf START per spectrum. The other keywords
+    have the same meaning as in ppxf, but CLEAN, REGUL, REDDENING, two-sided
+    fits, covariance matrices and fixed kinematics are not supported.
+
+    The template FFTs are computed once. The spectra are fitted in blocks of
+    BATCH_SIZE with a Levenberg-Marquardt method which advances all spectra
+    of a block together: the LOSVDs, their convolution with the templates
+    and the derivatives of the model are computed with single vectorized
+    calls for the whole block, and only the NNLS solutions are computed one
+    spectrum at a time. The derivatives are taken at fixed template weights
+    and projected orthogonally to the columns with nonzero weight. This is
+    the approximation of Kaufman (1975, BIT, 15, 49) to the variable
+    projection derivatives of ppxf. By default BATCH_SIZE is set to keep
+    the convolved templates of one block within about 32MB.
+
+    The output attributes have one row per spectrum: SOL and ERROR
+    [nspec, sum(moments)] (V and sigma in km/s, all components in a row),
+    WEIGHTS [nspec, ntemp+nsky], POLYWEIGHTS [nspec, degree+1], MPOLYWEIGHTS
+    [nspec, mdegree], CHI2 and NFEV [nspec]. BESTFIT [npix, nspec] has the
+    same layout as GALAXY.
+
+    """
+    def __init__(self, templates, galaxy, noise, velScale, start,
+                 bias=None, degree=4, goodpixels=None, mdegree=0, moments=2,
+                 oversample=False, quiet=False, sky=None, vsyst=0, component=0,
+                 batch_size=None, ftol=1e-4, maxiter=100, rfft_cache=None,
+                 fft=None, float32=False):
+
+        templates = np.asarray(templates)
+        if templates.ndim == 1:
+            self.star = templates[:, None]
+        else:
+            self.star = templates.reshape(templates.shape[0], -1)
+        ntemp = self.star.shape[1]
+
+        galaxy = np.asarray(galaxy, dtype=float)
+        if galaxy.ndim == 1:
+            galaxy = galaxy[:, None]
+        npix, nspec = galaxy.shape
+        noise = np.broadcast_to(np.asarray(noise, dtype=float).T, galaxy.T.shape)
+        if not np.all((noise > 0) & np.isfinite(noise)):
+            raise ValueError('NOISE must be positive')
+        if self.star.shape[0] < npix:
+            raise ValueError('STAR length cannot be smaller than GALAXY')
+        self.galaxy = galaxy
+        self.noise = noise.T
+
+        self.component = np.zeros(ntemp, dtype=int) + component
+        self.ncomp = self.component.max() + 1
+        if not np.array_equal(np.unique(self.component), np.arange(self.ncomp)):
+            raise ValueError('must be 0 < COMPONENT < NCOMP-1')
+        self.moments = np.zeros(self.ncomp, dtype=int) + moments
+        if not np.all(np.isin(self.moments, [2, 4, 6])):
+            raise ValueError('MOMENTS should be 2, 4 or 6')
+
+        if sky is None:
+            sky = np.empty((npix, 0))
+        sky = np.asarray(sky).reshape(npix, -1)
+
+        if goodpixels is None:
+            goodpixels = np.arange(npix)
+        elif np.any(np.diff(goodpixels) <= 0) or goodpixels[0] < 0 or goodpixels[-1] > npix - 1:
+            raise ValueError('goodpixels must be increasing and within the data range')
+        self.goodpixels = goodpixels
+
+        self.bias = 0.7*np.sqrt(500./goodpixels.size) if bias is None else bias
+        self.degree = max(degree, -1)
+        self.mdegree = max(mdegree, 0)
+        if oversample is True:
+            self.factor = 30
+        elif oversample is False:
+            self.factor = 1
+        else:
+            self.factor = oversample
+        self.vsyst = vsyst/velScale
+        self.velscale = velScale
+        self.ftol = ftol
+        self.maxiter = maxiter
+
+        # Starting guess and limits of the parameters, as in ppxf
+        #
+        start = np.asarray(start, dtype=float)
+        start = start.reshape((-1, self.ncomp, start.shape[-1]) if start.ndim > 1 + (self.ncomp > 1)
+                              else (1, self.ncomp, start.shape[-1]))
+        start = np.broadcast_to(start[:, :, :2], (nspec, self.ncomp, 2))/velScale
+        ngh = self.moments.sum()
+        npars = ngh + self.mdegree
+        self.vel = np.append(0, np.cumsum(self.moments)[:-1]) # Index of V of each component
+        self.start = np.zeros((nspec, npars))
+        self.lower = np.full((nspec, npars), -0.3)
+        self.upper = np.full((nspec, npars), 0.3)
+        self.lower[:, ngh:], self.upper[:, ngh:] = -1., 1.
+        for j, p in enumerate(self.vel):
+            self.start[:, p:p+2] = start[:, j]
+            self.lower[:, p] = start[:, j, 0] - 2e3/velScale # +/-2000 km/s from first guess
+            self.upper[:, p] = start[:, j, 0] + 2e3/velScale
+            self.lower[:, p+1], self.upper[:, p+1] = 0.1, 1e3/velScale
+        if self.star.shape[0] <= 2*np.max(np.abs(self.vsyst + start[..., 0]) + 5*start[..., 1]):
+            raise ValueError('Velocity shift too big: Adjust wavelength ranges of spectrum and templates')
+
+        # Pre-compute the FFT and possibly oversample the templates
+        #
+        if fft is None:
+            fft = fft_backend()
+        elif not isinstance(fft, fft_backend):
+            fft = fft_backend(fft)
+        self.fft = fft
+        self.dtype = np.float32 if float32 else np.float64
+        vlims = np.append(self.lower[:, self.vel], self.upper[:, self.vel])
+        self.star_rfft, self.npad = _rfft_templates(
+            self.star.astype(self.dtype, copy=False), self.vsyst, vlims, self.upper[0, 1],
+            self.factor, 1, rfft_cache, fft)
+        self.comp_index = [np.flatnonzero(self.component == j) for j in range(self.ncomp)]
+
+        # Columns of the Design Matrix which are the same for all spectra
+        #
+        vand = legendre.legvander(np.linspace(-1, 1, npix), max(self.degree, self.mdegree, 0))
+        self.vander = vand
+        self.fixed_cols = np.column_stack([vand[:, :self.degree+1], sky])
+        self.npoly = self.degree + 1
+
+        if batch_size is None:
+            batch_size = max(1, 2**22//(self.npad*ntemp))
+        self.batch_size = batch_size
+
+        # Fit the spectra in blocks
+        #
+        ncols = self.npoly + ntemp + sky.shape[1]
+        self.sol = np.empty((nspec, ngh))
+        self.error = np.empty((nspec, ngh))
+        self.weights = np.empty((nspec, ncols))
+        self.mpolyweights = np.empty((nspec, self.mdegree))
+        self.chi2 = np.empty(nspec)
+        self.nfev = np.empty(nspec, dtype=int)
+        self.bestfit = np.empty((npix, nspec))
+        for j in range(0, nspec, batch_size):
+            self._fit_block(np.arange(j, min(j + batch_size, nspec)))
+
+        self.polyweights = self.weights[:, :self.npoly]
+        self.weights = self.weights[:, self.npoly:] # output weights for the templates (or sky) only
+        for p in self.vel:
+            self.sol[:, p:p+2] *= velScale # Bring velocity scale back to km/s
+            self.error[:, p:p+2] *= velScale
+
+        if not quiet:
+            print('ppxf_batch: %d spectra, median function evaluations: %d'
+                  % (nspec, np.median(self.nfev)))
+
+#-------------------------------------------------------------------------------
+
+    def _fit_block(self, idx):
+        """
+        Levenberg-Marquardt fit of the spectra IDX, which are advanced together.
+        Each spectrum has its own damping parameter and is removed from the
+        block when the relative decrease of its chi2 falls below FTOL.
+        Parameters at their limits, with the gradient pointing outside,
+        or without effect on the model are kept fixed in the step, and the
+        step is shortened to keep all the others within their limits
+
+        """
+        pars = self.start[idx].copy()
+        lower, upper = self.lower[idx], self.upper[idx]
+        npars = pars.shape[1]
+        passive = [None]*idx.size
+        fit = self._evaluate(pars, idx, passive, self.bias)
+        err, jac, weights = fit['err'], fit['jac'], fit['weights']
+        passive = list(weights != 0)
+        chi2 = np.sum(err**2, 1)
+        lam = np.full(idx.size, 1e-3)
+        nfev = np.ones(idx.size, dtype=int)
+        active = np.ones(idx.size, dtype=bool)
+        eye = np.identity(npars)
+
+        for it in range(self.maxiter):
+            a = np.flatnonzero(active)
+            if a.size == 0:
                 break
+            ja = jac[a]
+            alpha = np.matmul(ja.transpose(0, 2, 1), ja)
+            beta = np.einsum('kmi,km->ki', ja, err[a])
+            diag = np.einsum('kii->ki', alpha)
+            pegged = ((pars[a] <= lower[a]) & (beta < 0)) | ((pars[a] >= upper[a]) & (beta > 0))
+            pegged |= diag <= 1e-12*diag.max(1)[:, None]  # e.g. LOSVD of a component without templates
+            alpha[pegged[:, :, None] | pegged[:, None, :]] = 0
+            beta[pegged] = 0
+            diag = np.where(pegged, 1, diag)
+            step = np.linalg.solve(alpha + (lam[a, None]*diag)[:, :, None]*eye, beta[:, :, None])[:, :, 0]
+            step[((pars[a] <= lower[a]) & (step < 0)) | ((pars[a] >= upper[a]) & (step > 0))] = 0
+            with np.errstate(divide='ignore', invalid='ignore'): # As in MPFIT, shorten the
+                frac = np.where(step < 0, (lower[a] - pars[a])/step,  # whole step to stay
+                                (upper[a] - pars[a])/step)           # within the limits
+            frac = np.where(np.isfinite(frac), frac, 1).clip(0, 1).min(1)
+            trial = np.clip(pars[a] + frac[:, None]*step, lower[a], upper[a])
+
+            new = self._evaluate(trial, idx[a], [passive[k] for k in a], self.bias)
+            nfev[a] += 1
+            chi2_new = np.sum(new['err']**2, 1)
+            better = chi2_new < chi2[a]
+            small = np.all(np.abs(trial - pars[a]) <= 1e-10*(np.abs(pars[a]) + 1e-10), 1)
+            ok = a[better]
+            pars[ok] = trial[better]
+            err[ok] = new['err'][better]
+            jac[ok] = new['jac'][better]
+            for k, w in zip(ok, new['weights'][better]):
+                passive[k] = w != 0
+            lam[ok] *= 0.1
+            lam[a[~better]] *= 10
+            done = better & (chi2[a] - chi2_new <= self.ftol*chi2[a])
+            done |= ~better & (lam[a] > 1e10)
+            done |= small
+            chi2[ok] = chi2_new[better]
+            active[a[done]] = False
+
+        # Evaluate scatter and formal errors at the bestfit (with BIAS=0)
+        # and also get the output bestfit and weights.
+        #
+        fit = self._evaluate(pars, idx, passive, 0)
+        jac = fit['jac']
+        covar = np.linalg.pinv(np.matmul(jac.transpose(0, 2, 1), jac))
+        ngh = self.moments.sum()
+        self.sol[idx] = pars[:, :ngh]
+        self.error[idx] = np.sqrt(np.einsum('kii->ki', covar)[:, :ngh].clip(0))
+        self.mpolyweights[idx] = pars[:, ngh:]
+        self.weights[idx] = fit['weights']
+        self.bestfit[:, idx] = fit['model'].T
+        self.chi2[idx] = [robust_sigma(e, zero=True)**2 for e in fit['err']]
+        self.nfev[idx] = nfev + 1
 
-        self.matrix = c  # Returns LOSVD-convolved design matrix
+#-------------------------------------------------------------------------------
 
-        # Penalize the solution towards (h3, h4, ...) = 0 if the inclusion of
-        # these additional terms does not significantly decrease the error.
-        # The lines below implement eq.(8)-(9) in Cappellari & Emsellem (2004)
+    def _evaluate(self, pars, idx, passive, bias):
+        """
+        Weighted residuals ERR and their (negative) derivatives JAC with
+        respect to PARS, for the GOODPIXELS of the spectra IDX
+
+        """
+        nb = idx.size
+        npix = self.galaxy.shape[0]
+        ngh = self.moments.sum()
+        npoly = self.npoly
+        good = self.goodpixels
+        fft = self.fft
+
+        def rebin_pixels(tt):
+            if self.factor == 1:  # No oversampling
+                return tt[..., :npix]
+            else:                 # Template was oversampled before convolution
+                return tt[..., :npix*self.factor].reshape(tt.shape[:-1] + (npix, self.factor)).mean(-1)
+
+        # LOSVDs of all spectra and their derivatives by central differences
         #
-        if np.any(self.moments > 2) and self.bias != 0:
-            D2 = 0.
-            for j, p in enumerate(vj): # loop over kinematic components
-                if self.moments[j] > 2:  
-                    D2 += np.sum(pars[2+p:self.moments[j]+p]**2)  # eq.(8)
-            err += self.bias*robust_sigma(err, zero=True)*np.sqrt(D2)  # eq.(9)
+        dx = int(np.ceil(np.max(np.abs(self.vsyst + pars[:, self.vel]) + 5*pars[:, self.vel+1])))
+        nl = 2*dx*self.factor + 1
+        x = np.linspace(-dx, dx, nl)  # Evaluate the Gaussian using steps of 1/factor pixel
+        losvd = _losvd_batch(pars[:, :ngh], self.moments, self.vsyst, x)
+        h = 1e-4*np.maximum(np.abs(pars[:, :ngh]), 1)
+        dpars = np.repeat(pars[:, None, :ngh], 2*ngh, axis=1)
+        q = np.arange(ngh)
+        dpars[:, q, q] += h
+        dpars[:, ngh+q, q] -= h
+        dlosvd = _losvd_batch(dpars.reshape(-1, ngh), self.moments, self.vsyst, x)
+        dlosvd = dlosvd.reshape(nb, 2, ngh, self.ncomp, nl)
+        comp = np.repeat(np.arange(self.ncomp), self.moments)  # Component of each parameter
+        dlosvd = (dlosvd[:, 0, q, comp] - dlosvd[:, 1, q, comp])/(2*h[:, :, None])
+
+        losvd_rfft = fft.rfft(_wrap_kernels(losvd, self.npad).astype(self.dtype), self.npad, axis=-1)
+        dlosvd_rfft = fft.rfft(_wrap_kernels(dlosvd, self.npad).astype(self.dtype), self.npad, axis=-1)
+
+        mpoly = 1 + pars[:, ngh:].dot(self.vander[:, 1:self.mdegree+1].T)  # [nb, npix]
+
+        # Convolve the templates of each component with the LOSVDs of all spectra
+        #
+        star_rfft = self.star_rfft.T
+        ntemp = star_rfft.shape[0]
+        tmpl = np.empty((nb, ntemp, npix), dtype=self.dtype)
+        for j, cols in enumerate(self.comp_index):
+            tt = fft.irfft(star_rfft[None, cols]*losvd_rfft[:, j, None, :], self.npad, axis=-1)
+            tmpl[:, cols] = rebin_pixels(tt)
+
+        # Weighted Design Matrix of the GOODPIXELS and NNLS fit of each spectrum
+        #
+        inv_noise = 1/self.noise[good][:, idx].T  # [nb, ngood]
+        a = np.empty((nb, good.size, self.fixed_cols.shape[1] + ntemp))
+        a[:, :, :npoly] = self.fixed_cols[good, :npoly]*inv_noise[:, :, None]
+        a[:, :, npoly:npoly+ntemp] = (tmpl[:, :, good]*mpoly[:, None, good]).transpose(0, 2, 1)
+        a[:, :, npoly:npoly+ntemp] *= inv_noise[:, :, None]
+        a[:, :, npoly+ntemp:] = self.fixed_cols[good, npoly:]*inv_noise[:, :, None]
+        b = self.galaxy[good][:, idx].T*inv_noise
+        weights = np.array([_bvls_solve(a[k], b[k], npoly, passive[k]) for k in range(nb)])
+        err = b - np.einsum('kmn,kn->km', a, weights)
+
+        # Derivatives of the model at fixed weights: the templates of each
+        # component are first combined with their weights
+        #
+        wtemp = weights[:, npoly:npoly+ntemp]
+        comb_rfft = np.array([wtemp[:, cols].dot(star_rfft[cols]) for cols in self.comp_index])
+        comb_rfft = comb_rfft.transpose(1, 0, 2)  # [nb, ncomp, nfreq]
+        dmodel = np.empty((nb, ngh + self.mdegree, npix))
+        dmodel[:, :ngh] = rebin_pixels(fft.irfft(comb_rfft[:, comp]*dlosvd_rfft, self.npad, axis=-1))
+        dmodel[:, :ngh] *= mpoly[:, None]
+        conv = rebin_pixels(fft.irfft(np.sum(comb_rfft*losvd_rfft, 1), self.npad, axis=-1))
+        dmodel[:, ngh:] = self.vander[:, 1:self.mdegree+1].T*conv[:, None]
+        jac = dmodel[:, :, good].transpose(0, 2, 1)*inv_noise[:, :, None]
+        for k in range(nb):
+            free = np.arange(weights.shape[1]) < npoly
+            free |= weights[k] != 0
+            qk = np.linalg.qr(a[k][:, free])[0]
+            jac[k] -= qk.dot(qk.T.dot(jac[k]))
+
+        # Penalize the solution towards (h3, h4, ...) = 0, as in ppxf._fitfunc
+        #
+        hpars = np.zeros(pars.shape[1], dtype=bool)
+        for j, p in enumerate(self.vel):
+            hpars[p+2:p+self.moments[j]] = True
+        if np.any(hpars) and bias != 0:
+            D = np.sqrt(np.sum(pars[:, hpars]**2, 1))
+            penalty = bias*np.array([robust_sigma(e, zero=True) for e in err])
+            err += (penalty*D)[:, None]
+            jac[:, :, hpars] -= (penalty/np.where(D > 0, D, 1))[:, None, None]*pars[:, None, hpars]
+
+        model = np.einsum('kn,mn->km', weights[:, :npoly], self.fixed_cols[:, :npoly]) \
+              + np.einsum('kn,mn->km', weights[:, npoly+ntemp:], self.fixed_cols[:, npoly:]) \
+              + mpoly*np.einsum('kt,ktm->km', wtemp, tmpl)
 
-        return 0, err
+        return {'err': err, 'jac': jac, 'weights': weights, 'model': model}
+
+#-------------------------------------------------------------------------------
+
+def mc_errors(templates, model, noise, velScale, start, nsim=200, seed=None,
+              block=25, rtol=None, cache=None, bias=0., **kwargs):
+    """
+    Monte Carlo errors of the ppxf kinematics. NSIM realizations of MODEL
+    plus Gaussian NOISE [npix] are generated at once with a RandomState(SEED),
+    so that the results are reproducible, and are fitted with ppxf_batch in
+    blocks of BLOCK spectra. The FFT of the TEMPLATES is computed once and
+    shared by all blocks through CACHE (an rfft_cache), which is created if
+    not given. The other keywords are passed to ppxf_batch. As required for
+    Monte Carlo errors, BIAS is zero by default: with the default BIAS of
+    ppxf the Gauss-Hermite moments are pulled towards zero and their
+    scatter is underestimated.
+
+    The error of each parameter is the robust standard deviation (1.4826
+    times the median absolute deviation) of the solutions. If RTOL is set,
+    the simulations stop after the first block which changes none of the
+    errors by more than RTOL times their value.
+
+    Returns the errors [sum(moments)] and the solutions of the simulations
+    [nfit, sum(moments)], where nfit <= NSIM is the number of realizations
+    fitted before stopping. V and sigma are in km/s.
+
+    """
+    model = np.asarray(model, dtype=float)
+    noise = np.broadcast_to(noise, model.shape)
+    rng = np.random.RandomState(seed)
+    sims = model[:, None] + noise[:, None]*rng.standard_normal((model.size, nsim))
+    if cache is None:
+        cache = rfft_cache(maxsize=1)
+
+    sols, error = [], None
+    for j in range(0, nsim, block):
+        pp = ppxf_batch(templates, sims[:, j:j+block], noise, velScale, start,
+                        quiet=True, rfft_cache=cache, bias=bias, **kwargs)
+        sols.append(pp.sol)
+        sol = np.vstack(sols)
+        new_error = 1.4826*np.median(np.abs(sol - np.median(sol, 0)), 0)
+        converged = rtol is not None and error is not None \
+            and np.all(np.abs(new_error - error) <= rtol*new_error)
+        error = new_error
+        if converged:
+            break
+
+    return error, sol
 
 #-------------------------------------------------------------------------------
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar store for the pPXF results of many spectra.
+
+All the fits of a logs directory are kept in a single uncompressed npz
+file, which can also be read with numpy.load. The scalar quantities (chi2,
+degrees, number of templates...) are stored as columns and the
+kinematics as tables of shape (nspec, ncomp, max(moments)) padded with
+NaN, so that they can be read for all spectra at once. Each distinct
+array (galaxy, bestfit, matrix...) is written, with its own dtype, to a
+member "name/j" of the npz file as soon as it is read, so that writing
+the store only needs the memory of one array, and the array of a given
+spectrum is read through a memory map of its member, without loading
+the rest of the file. A column "name_index" gives the member j of each
+spectrum. Identical arrays, e.g. the template library shared by all
+fits, are stored only once.
+
+"""
+from __future__ import print_function
+
+import hashlib
+import struct
+import zipfile
+
+import numpy as np
+
+# Attributes of the pPXF results stored as columns, one value per spectrum
+SCALARS = ["chi2", "degree", "mdegree", "ncomp", "has_emission", "ngas",
+           "ntemplates", "nsky", "velscale", "dv", "vsyst"]
+# Attributes stored as concatenated arrays, one array per spectrum
+ARRAYS = ["galaxy", "noise", "bestfit", "w", "goodpixels", "matrix", "star",
+          "weights", "polyweights", "mpolyweights", "template_files", "lam",
+          "wtemp"]
+
+#------------------------------------------------------------------------
+
+def kinematics_table(sols, moments):
+    """
+    Pack the solutions of many fits, each either one array (one component)
+    or a list of arrays (one per component), into an array of shape
+    (nspec, ncomp, max(moments)) padded with NaN
+
+    """
+    table = np.full(moments.shape + (moments.max(),), np.nan)
+    for sol, row, mom in zip(sols, table, moments):
+        for j, s in enumerate(np.atleast_2d(sol) if np.ndim(sol[0]) == 0 else sol):
+            row[j, :mom[j]] = s
+    return table
+
+#------------------------------------------------------------------------
+
+def write_member(z, key, a):
+    """ Write the array A as the uncompressed member KEY of the zip file Z """
+    with z.open(key + ".npy", "w", force_zip64=True) as f:
+        np.lib.format.write_array(f, np.asanyarray(a))
+
+#------------------------------------------------------------------------
+
+def write_store(filename, results, names=None):
+    """
+    Write a sequence of pPXF results (ppxf objects, or objects with the
+    same attributes as returned by ppload) to a single npz file.
+    The results are identified by names, by default their spec attribute.
+    RESULTS is only iterated once, so it can be a generator: the arrays
+    are written to the file one at a time and are not kept in memory.
+    Missing scalar attributes drop the column, missing arrays are skipped
+    for the given spectrum
+
+    """
+    names = [] if names is None else list(names)
+    scalars = dict((att, []) for att in SCALARS)
+    index = dict((att, []) for att in ARRAYS)
+    seen = dict((att, {}) for att in ARRAYS)
+    sols, errors, moments = [], [], []
+    with zipfile.ZipFile(filename, "w", zipfile.ZIP_STORED, allowZip64=True) as z:
+        for i, pp in enumerate(results):
+            if i == len(names):
+                names.append(pp.spec)
+            for att in SCALARS:
+                scalars[att].append(getattr(pp, att, None))
+            moments.append(np.atleast_1d(pp.moments))
+            sols.append(pp.sol)
+            errors.append(pp.error)
+            for att in ARRAYS:
+                a = getattr(pp, att, None)
+                if a is None:
+                    index[att].append(-1)
+                    continue
+                a = np.ascontiguousarray(a)
+                key = (a.dtype.str, a.shape, hashlib.sha1(memoryview(a)).hexdigest())
+                j = seen[att].get(key)
+                if j is None:
+                    j = seen[att][key] = len(seen[att])
+                    write_member(z, "{0}/{1}".format(att, j), a)
+                index[att].append(j)
+
+        data = {"spec": np.array(names)}
+        for att, values in scalars.items():
+            if not any(v is None or np.ndim(v) for v in values):
+                data[att] = np.array(values)
+        data["moments"] = np.zeros((len(moments), max(m.size for m in moments)), dtype=int)
+        for row, mom in zip(data["moments"], moments):
+            row[:mom.size] = mom
+        data["sol"] = kinematics_table(sols, data["moments"])
+        data["error"] = kinematics_table(errors, data["moments"])
+        for att in ARRAYS:
+            if seen[att]:
+                data[att + "_index"] = np.array(index[att])
+        for key, value in data.items():
+            write_member(z, key, value)
+
+#------------------------------------------------------------------------
+
+def npz_memmap(filename, key):
+    """
+    Memory map of a member of an uncompressed npz file. Compressed members
+    are read in memory
+
+    """
+    with zipfile.ZipFile(filename) as z:
+        info = z.getinfo(key + ".npy")
+        if info.compress_type != zipfile.ZIP_STORED:
+            return np.load(filename)[key]
+    with open(filename, "rb") as f:
+        f.seek(info.header_offset + 26)
+        nname, nextra = struct.unpack("<HH", f.read(4))
+        f.seek(nname + nextra, 1)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    if not shape or 0 in shape:  # np.memmap cannot map empty arrays
+        return np.load(filename)[key]
+    return np.memmap(filename, dtype=dtype, mode="r", offset=offset,
+                     shape=shape, order="F" if fortran else "C")
+
+#------------------------------------------------------------------------
+
+class StoredResult(object):
+    """ pPXF results read from a ResultStore, with the attributes of ppload """
+    pass
+
+#------------------------------------------------------------------------
+
+class ResultStore(object):
+    """
+    Read access to a file written by write_store.
+
+    store.column(name) returns a column for all spectra, e.g. "chi2" or
+    "sol", without reading the arrays. store.array(name, spec) returns the
+    array of one spectrum as a read-only memory map, and store.load(spec)
+    an object with all the stored attributes, which can be given to pPXF.
+
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.npz = np.load(filename)
+        self.spec = self.npz["spec"]
+        self.index = dict((s, i) for i, s in enumerate(self.spec))
+        self._columns = {}
+        self._maps = {}
+
+    def __len__(self):
+        return len(self.spec)
+
+    def __contains__(self, spec):
+        return spec in self.index
+
+    def column(self, name):
+        """ Column of a scalar attribute, or the kinematics tables """
+        if name not in self._columns:
+            self._columns[name] = self.npz[name]
+        return self._columns[name]
+
+    def array(self, name, spec):
+        """ Array attribute of one spectrum, or None if it was not stored """
+        if name + "_index" not in self.npz.files:
+            return None
+        j = self.column(name + "_index")[self.index[spec]]
+        if j < 0:
+            return None
+        key = "{0}/{1}".format(name, j)
+        if key not in self._maps:
+            self._maps[key] = npz_memmap(self.filename, key)
+        return self._maps[key]
+
+    def load(self, spec):
+        """ Results of one spectrum, with the attributes of ppload """
+        i = self.index[spec]
+        pp = StoredResult()
+        pp.spec = spec
+        for att in SCALARS:
+            if att in self.npz.files:
+                setattr(pp, att, self.column(att)[i].item())
+        pp.moments = self.column("moments")[i]
+        pp.moments = pp.moments[pp.moments > 0]
+        pp.sol = [s[:m].copy() for s, m in zip(self.column("sol")[i], pp.moments)]
+        pp.error = [s[:m].copy() for s, m in zip(self.column("error")[i], pp.moments)]
+        if pp.moments.size == 1:
+            pp.sol, pp.error = pp.sol[0], pp.error[0]
+        for att in ARRAYS:
+            a = self.array(att, spec)
+            if a is not None:
+                setattr(pp, att, a)
+        return pp
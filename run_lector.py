@@ -20,7 +20,7 @@ from astropy.stats import sigma_clip
 
 from config import *
 import lector as lector
-from run_ppxf import pPXF, ppload, wavelength_array, losvd_convolve
+from run_ppxf import pPXF, results_store, wavelength_array, losvd_convolve
 
 def check_intervals(setupfile, bands, vel):
     """ Check which indices are defined in the spectrum. """
@@ -170,9 +170,9 @@ def run_standard_stars(velscale, bands):
     for night in nights:
         os.chdir(os.path.join(stars_dir, night))
         stars = [x for x in os.listdir(".") if x.endswith(".fits")]
+        store = results_store("logs")
         for star in stars:
-            ppfile = "logs/{0}".format(star.replace(".fits", ""))
-            if not os.path.exists(ppfile + ".pkl"):
+            if star not in store:
                 continue
             name = star.split(".")[0].upper()
             if name not in ids:
@@ -180,8 +180,7 @@ def run_standard_stars(velscale, bands):
             print name
             idx = ids.index(name)
             lick_star = lick_ref[idx]
-            pp = ppload("logs/{0}".format(star.replace(".fits", "")))
-            pp = pPXF(star, velscale, pp)
+            pp = pPXF(star, velscale, store.load(star))
             mpoly = np.interp(pp.wtemp, pp.w, pp.mpoly)
             spec = pf.getdata(star)
             w = wavelength_array(star, axis=1, extension=0)
@@ -354,15 +353,14 @@ def run_candidates(velscale, bands):
     specs = sorted([x for x in os.listdir(wdir) if x.endswith(".fits")])
     obsres = hydra_resolution()
     offset, offerr = lick_offset()
+    store = results_store("logs_ssps")
     lickout = []
     for spec in specs:
-        ppfile = "logs_ssps/{0}".format(spec.replace(".fits", ""))
-        if not os.path.exists(ppfile + ".pkl"):
+        if spec not in store:
             print "Skiping spectrum: ", spec
             continue
-        print ppfile
-        pp = ppload("logs_ssps/{0}".format(spec.replace(".fits", "")))
-        pp = pPXF(spec, velscale, pp)
+        print spec
+        pp = pPXF(spec, velscale, store.load(spec))
         galaxy = pf.getdata(spec)
         w = wavelength_array(spec, axis=1, extension=0)
         if pp.ncomp > 1:
@@ -461,18 +459,17 @@ def run_candidates_mc(velscale, bands, nsim=50):
     os.chdir(wdir)
     specs = sorted([x for x in os.listdir(wdir) if x.endswith(".fits")])
     offset, offerr = lick_offset()
+    store = results_store("logs_ssps")
+    store_kin = results_store("logs")
     lickout = []
     for spec in specs:
         try:
-            ppfile = "logs_ssps/{0}".format(spec.replace(".fits", ""))
-            if not os.path.exists(ppfile + ".pkl"):
+            if spec not in store:
                 print "Skiping spectrum: ", spec
                 continue
-            print ppfile
-            pp = ppload("logs_ssps/{0}".format(spec.replace(".fits", "")))
-            pp = pPXF(spec, velscale, pp)
-            ppkin = ppload("logs/{0}".format(spec.replace(".fits", "")))
-            ppkin = pPXF(spec, velscale, ppkin)
+            print spec
+            pp = pPXF(spec, velscale, store.load(spec))
+            ppkin = pPXF(spec, velscale, store_kin.load(spec))
             w = wavelength_array(spec, axis=1, extension=0)
             if pp.ncomp > 1:
                 sol = ppkin.sol[0]
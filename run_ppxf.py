@@ -9,6 +9,8 @@ Run pPXF in data
 """
 import os
 import pickle
+import time
+import multiprocessing
 
 import numpy as np
 import pyfits as pf
@@ -19,8 +21,12 @@ from matplotlib import gridspec
 import matplotlib.cm as cm
 from scipy.ndimage.filters import convolve1d, gaussian_filter1d
 
-from ppxf import ppxf
+from ppxf import (ppxf, rfft_cache, prune_templates, xcorr_kinematics,
+                  mc_errors)
 import ppxf_util as util
+from load_templates import load_pca_templates
+from ppxf_store import ResultStore, write_store
+from lector import variable_gaussian_filter1d
 from config import *
 
 def wavelength_array(spec, axis=1, extension=0):
@@ -56,13 +62,37 @@ def losvd_convolve(spec, losvd, velscale):
         profile *= poly
         profile = profile / profile.sum()
     return convolve1d(spec, profile)
+
+def template_grid(names):
+    """ Integer coordinates of the MILES templates on the grid of age and
+    metallicity, obtained from the file names Mun1.30Z{metal}T{age}*.
+    Other templates (e.g. emission lines) get coordinates -1. """
+    pars = []
+    for name in names:
+        name = os.path.basename(name)
+        if name.startswith("Mun") and "Z" in name and "T" in name:
+            metal = name.split("Z")[1].split("T")[0]
+            age = name.split("T")[1][:7]
+            pars.append([float(age.replace("_", ".")),
+                         float(metal.replace("_", ".").replace("p", "").replace("m", "-"))])
+        else:
+            pars.append([np.nan, np.nan])
+    pars = np.array(pars)
+    grid = -np.ones(pars.shape, dtype=int)
+    for j in range(pars.shape[1]):
+        good = np.isfinite(pars[:,j])
+        grid[good,j] = np.unique(pars[good,j], return_inverse=True)[1]
+    return grid
  
-def run_ppxf(spectra, velscale, ncomp=None, has_emission=True, mdegree=-1,
-             degree=20, plot=False, sky=None, start=None, moments=None,
-             log_dir=None, w1=4000., w2=7000.):
-    """ Run pPXF in a list of spectra"""
-    if isinstance(spectra, str):
-        spectra = [spectra]
+def load_library(has_emission=True, ncomp=1, pca=None):
+    """ Load the templates used in the fits of run_ppxf.
+
+    Returns a dictionary with the templates (stars followed by the emission
+    lines if has_emission), their names, the stellar templates alone, their
+    log-wavelength, the number of stellar and gas templates, the component
+    of each template and the weights of the mean stellar spectrum used by
+    the cross-correlation.
+    """
     ##########################################################################
     # Load templates for both stars and gas
     star_templates = pf.getdata(os.path.join(templates_dir,
@@ -77,6 +107,13 @@ def run_ppxf(spectra, velscale, ncomp=None, has_emission=True, mdegree=-1,
     gas_files = np.loadtxt(os.path.join(templates_dir, 'emission_FWHM_3.7.txt'),
                        dtype=str).tolist()
 
+    if pca is not None:
+        if has_emission:
+            raise ValueError("pca cannot be used with has_emission")
+        star_templates, logLam2, coeffs = load_pca_templates(pca)
+        miles = ["PCA{0}".format(j+1) for j in range(pca)]
+    # Combination of the templates giving the mean MILES spectrum
+    xcorr_weights = None if pca is None else coeffs.mean(axis=1)
     ngas = len(gas_files)
     ntemplates = len(miles)
     ##########################################################################
@@ -89,95 +126,195 @@ def run_ppxf(spectra, velscale, ncomp=None, has_emission=True, mdegree=-1,
         templates_names = miles
         ngas = 0
     ##########################################################################
-    if sky == None:
-        nsky = 0
-    else:
-        nsky = sky.shape[1]
-    if ncomp == 1:
-        components = 0
-    elif ncomp == 2:
+    if ncomp == 2:
         components = np.hstack((np.zeros(len(star_templates[0])),
                                 np.ones(len(gas_templates[0]))))
+    else:
+        components = 0
+    return dict(templates=templates, templates_names=templates_names,
+                star_templates=star_templates, logLam2=logLam2,
+                ntemplates=ntemplates, ngas=ngas, components=components,
+                xcorr_weights=xcorr_weights, has_emission=has_emission,
+                pca=pca)
+
+def fit_spectrum(spec, velscale, library, ncomp=1, mdegree=-1, degree=20,
+                 sky=None, start=None, moments=None, log_dir=None, w1=4000.,
+                 w2=7000., cache=None, float32=False, prune=None,
+                 xcorr=False):
+    """ Fit one spectrum with pPXF and save the results in log_dir.
+
+    The library is the output of load_library, and the other keywords are
+    those of run_ppxf. The spectrum can be given with an absolute path, in
+    which case the outputs are still named after its basename, so that the
+    fit does not depend on the working directory.
+    """
+    name = os.path.basename(spec)
+    if log_dir is None:
+        log_dir = "logs"
+    outroot = os.path.join(log_dir, name.replace(".fits", ""))
+    templates = library["templates"]
+    templates_names = library["templates_names"]
+    components = library["components"]
+    logLam2 = library["logLam2"]
+    pca = library["pca"]
+    nsky = 0 if sky is None else sky.shape[1]
     if moments == None:
         moments = [4] if ncomp == 1 else [4,2]
+    plt.clf()
+    ######################################################################
+    # Read galaxy spectrum and define the wavelength range
+    hdu = pf.open(spec)
+    spec_lin = hdu[0].data
+    h1 = pf.getheader(spec)
+    lamRange1 = h1['CRVAL1'] + np.array([0.,h1['CDELT1']*(h1['NAXIS1']-1)])
+    ######################################################################
+    # Rebin to log scale
+    galaxy, logLam1, velscale = util.log_rebin(lamRange1, spec_lin,
+                                               velscale=velscale)
+    ######################################################################
+    # First guess for the noise
+    noise = np.ones_like(galaxy) * np.std(galaxy - medfilt(galaxy, 5))
+    ######################################################################
+    # Calculate difference of velocity between spectrum and templates
+    # due to different initial wavelength
+    dv = (logLam2[0]-logLam1[0])*c
+    ######################################################################
+    # Select goodpixels
+    w = np.exp(logLam1)
+    goodpixels = np.argwhere((w>w1) & (w<w2)).T[0]
+    ######################################################################
+    # Set first guess from setup files or from the cross-correlation
+    if xcorr:
+        start = xcorr_kinematics(library["star_templates"], galaxy, velscale,
+                                 vsyst=dv, weights=library["xcorr_weights"],
+                                 goodpixels=goodpixels,
+                                 cache=cache)[0].tolist()
+    elif start is None:
+        start = [v0s[name.split("_")[0]], 50]
+    ######################################################################
+    # Expand start variable to include multiple components
+    if ncomp > 1:
+        start = [start, [start[0], 30]]
+    # First pPXF interaction
+    pp0 = ppxf(templates, galaxy, noise, velscale, start,
+               goodpixels=goodpixels, plot=False, moments=moments,
+               degree=degree, mdegree=mdegree, vsyst=dv, component=components,
+               sky=sky, rfft_cache=cache, float32=float32,
+               eigen_templates=pca is not None)
+    rms0 = galaxy[goodpixels] - pp0.bestfit[goodpixels]
+    noise0 = 1.4826 * np.median(np.abs(rms0 - np.median(rms0)))
+    noise0 = np.zeros_like(galaxy) + noise0
+    ######################################################################
+    # Keep only the templates used by the first fit and their neighbours
+    keep = np.arange(len(templates_names))
+    temps, comps, cache1 = templates, components, cache
+    if prune is not None:
+        keep = prune_templates(pp0.weights[:len(templates_names)],
+                               template_grid(templates_names), prune)
+        print "Pruning: {0} of {1} templates kept".format(len(keep),
+              len(templates_names))
+        temps = templates[:,keep]
+        if ncomp == 2:
+            comps = components[keep]
+        cache1 = None # The FFT of this subset is only used once
+    # Second pPXF interaction, realistic noise estimation
+    pp = ppxf(temps, galaxy, noise0, velscale, start,
+              goodpixels=goodpixels, plot=False, moments=moments,
+              degree=degree, mdegree=mdegree, vsyst=dv,
+              component=comps, sky=sky, rfft_cache=cache1,
+              float32=float32, eigen_templates=pca is not None)
+    plt.title(name.replace("_", "-"))
+    plt.show(block=False)
+    plt.savefig(outroot + ".png")
+    ######################################################################
+    # Adding other things to the pp object
+    pp.template_files = np.asarray(templates_names)[keep]
+    pp.has_emission = library["has_emission"]
+    pp.dv = dv
+    pp.w = w
+    pp.velscale = velscale
+    pp.spec = name
+    pp.ngas = library["ngas"]
+    pp.ntemplates = np.sum(keep < library["ntemplates"])
+    pp.nsky = nsky
+    pp.templates = 0
+    ######################################################################
+    # Save fit to keep session
+    ppsave(pp, outroot)
+    ######################################################################
+    ppf = pPXF(name, velscale, pp)
+    ppf.plot(outroot + ".png")
+    ######################################################################
+    # # Save to output text file
+    # if ncomp > 1:
+    #     pp.sol = pp.sol[0]
+    #     pp.error = pp.error[0]
+    # sol = [val for pair in zip(pp.sol, pp.error) for val in pair]
+    # sol = ["{0:12s}".format("{0:.3g}".format(x)) for x in sol]
+    # sol.append("{0:12s}".format("{0:.3g}".format(pp0.chi2)))
+    # sol = ["{0:30s}".format(spec)] + sol
+    return
+
+def run_ppxf(spectra, velscale, ncomp=None, has_emission=True, mdegree=-1,
+             degree=20, plot=False, sky=None, start=None, moments=None,
+             log_dir=None, w1=4000., w2=7000., rfft_dir=None, float32=False,
+             prune=None, pca=None, xcorr=False):
+    """ Run pPXF in a list of spectra.
+
+    The FFT of the templates is computed once and shared by all the fits.
+    If rfft_dir is given, it is also stored on disk and reused by later runs.
+    If float32 is True, the fits use single precision arrays (see ppxf).
+    If prune is an integer, the second fit only uses the templates with
+    nonzero weight in the first fit, plus their neighbours within prune
+    steps in age and metallicity (see ppxf.prune_templates). Emission
+    line templates are always kept.
+    If pca is an integer, the MILES library is replaced by its first pca
+    eigen-templates (see load_templates.pca_templates), which is enough to
+    measure the kinematics. This requires has_emission=False.
+    If xcorr is True, the starting guess of each fit is obtained from the
+    cross-correlation with the mean stellar template (see
+    ppxf.xcorr_kinematics), instead of the velocities in the setup files.
+    """
+    if isinstance(spectra, str):
+        spectra = [spectra]
+    library = load_library(has_emission=has_emission, ncomp=ncomp, pca=pca)
+    cache = rfft_cache(directory=rfft_dir)
     for i, spec in enumerate(spectra):
         print "pPXF run of spectrum {0} ({1} of {2})".format(spec, i+1,
               len(spectra))
-        plt.clf()
-        ######################################################################
-        # Read galaxy spectrum and define the wavelength range
-        hdu = pf.open(spec)
-        spec_lin = hdu[0].data
+        fit_spectrum(spec, velscale, library, ncomp=ncomp, mdegree=mdegree,
+                     degree=degree, sky=sky, start=start, moments=moments,
+                     log_dir=log_dir, w1=w1, w2=w2, cache=cache,
+                     float32=float32, prune=prune, xcorr=xcorr)
+    return
+
+def xcorr_velocities(spectra, velscale, output, w1=4000., w2=7000.,
+                     rfft_dir=None):
+    """ Velocities of a list of spectra from the FFT cross-correlation with
+    the mean MILES template (see ppxf.xcorr_kinematics), as a replacement
+    of FXCOR. The output table has columns spec, V, error of V, sigma and
+    the Tonry & Davis r value, in the format used by check_candidates. """
+    if isinstance(spectra, str):
+        spectra = [spectra]
+    templates = pf.getdata(os.path.join(templates_dir,
+                                        'miles_FWHM_3.7.fits'), 0)
+    logLam2 = pf.getdata(os.path.join(templates_dir, 'miles_FWHM_3.7.fits'), 1)
+    cache = rfft_cache(directory=rfft_dir)
+    lines = []
+    for spec in spectra:
         h1 = pf.getheader(spec)
         lamRange1 = h1['CRVAL1'] + np.array([0.,h1['CDELT1']*(h1['NAXIS1']-1)])
-        ######################################################################
-        # Rebin to log scale
-        galaxy, logLam1, velscale = util.log_rebin(lamRange1, spec_lin, 
+        galaxy, logLam1, velscale = util.log_rebin(lamRange1, pf.getdata(spec),
                                                    velscale=velscale)
-        ######################################################################
-        # First guess for the noise
-        noise = np.ones_like(galaxy) * np.std(galaxy - medfilt(galaxy, 5))
-        ######################################################################
-        # Calculate difference of velocity between spectrum and templates
-        # due to different initial wavelength
         dv = (logLam2[0]-logLam1[0])*c
-        ######################################################################
-        # Set first guess from setup files
-        if start is None:
-            start = [v0s[spec.split("_")[0]], 50]
-            goodPixels = None
-        ######################################################################
-        # Expand start variable to include multiple components
-        if ncomp > 1:
-            start = [start, [start[0], 30]]
-        ######################################################################
-        # Select goodpixels
         w = np.exp(logLam1)
         goodpixels = np.argwhere((w>w1) & (w<w2)).T[0]
-        # First pPXF interaction
-        pp0 = ppxf(templates, galaxy, noise, velscale, start,
-                   goodpixels=goodpixels, plot=False, moments=moments,
-                   degree=degree, mdegree=mdegree, vsyst=dv, component=components,
-                   sky=sky)
-        rms0 = galaxy[goodpixels] - pp0.bestfit[goodpixels]
-        noise0 = 1.4826 * np.median(np.abs(rms0 - np.median(rms0)))
-        noise0 = np.zeros_like(galaxy) + noise0
-        # Second pPXF interaction, realistic noise estimation
-        pp = ppxf(templates, galaxy, noise0, velscale, start,
-                  goodpixels=goodpixels, plot=False, moments=moments,
-                  degree=degree, mdegree=mdegree, vsyst=dv,
-                  component=components, sky=sky)
-        plt.title(spec.replace("_", "-"))
-        plt.show(block=False)
-        plt.savefig("{1}/{0}".format(spec.replace(".fits", ".png"), log_dir))
-        ######################################################################
-        # Adding other things to the pp object
-        pp.template_files = templates_names
-        pp.has_emission = has_emission
-        pp.dv = dv
-        pp.w = w
-        pp.velscale = velscale
-        pp.spec = spec
-        pp.ngas = ngas
-        pp.ntemplates = ntemplates
-        pp.nsky = nsky
-        pp.templates = 0
-        ######################################################################
-        # Save fit to pickles file to keep session
-        ppsave(pp, "{1}/{0}".format(spec.replace(".fits", ""), log_dir))
-        pp = ppload("{1}/{0}".format(spec.replace(".fits", ""), log_dir))
-        ######################################################################
-        ppf = pPXF(spec, velscale, pp)
-        ppf.plot("{1}/{0}".format(spec.replace(".fits", ".png"), log_dir))
-        ######################################################################
-        # # Save to output text file
-        # if ncomp > 1:
-        #     pp.sol = pp.sol[0]
-        #     pp.error = pp.error[0]
-        # sol = [val for pair in zip(pp.sol, pp.error) for val in pair]
-        # sol = ["{0:12s}".format("{0:.3g}".format(x)) for x in sol]
-        # sol.append("{0:12s}".format("{0:.3g}".format(pp0.chi2)))
-        # sol = ["{0:30s}".format(spec)] + sol
+        sol, verr, r = xcorr_kinematics(templates, galaxy, velscale, vsyst=dv,
+                                        goodpixels=goodpixels, cache=cache)
+        lines.append("{0:30s}{1:10.1f}{2:8.1f}{3:8.1f}{4:8.1f}".format(
+                     spec, sol[0], verr, sol[1], r))
+    with open(output, "w") as f:
+        f.write("\n".join(lines) + "\n")
     return
 
 def read_setup_file(gal, logw, mask_emline=True):
@@ -218,111 +355,69 @@ def read_setup_file(gal, logw, mask_emline=True):
         good.sort()
         return start, good
 
-def make_table(spectra, output, mc=False, nsim=200, clean=True, pkls=None):
-    """ Make table with results.
-
-    ===================
-    Input Parameters
-    ===================
-    spectra : list
-        Names of the spectra to be processed. Should end in "fits".
-    mc : bool
-        Calculate the errors using a Monte Carlo method.
-    nsim : int
-        Number of simulations in case mc keyword is True.
-    clean : bool
-        Remove lines for which the velocity dispersion is 1000 km/s.
-    pkls : list
-        Specify list of pkl files to be used. Default value replaces fits for
-        pkl
-    ==================
-    Output file
-    ==================
-    In case mc is False, the function produces a file called ppxf_results.dat.
-    Otherwise, the name of the file is named ppfx_results_mc_nsim.dat.
+class pPXF():
+    """ Class to read pPXF pkl files
 
+    The matrix of the fit and the weights are sliced into components
+    (m_poly, m_ssps, m_gas, m_sky and w_poly, w_ssps, w_gas, w_sky), and
+    the polynomials and components of the bestfit (poly, mpoly, ssps, gas,
+    bestsky) are computed, only when first accessed. The results are kept
+    as attributes, so the arrays read from memory maps by ppload are only
+    read when needed, e.g. not when making tables with sol and sn.
     """
-    print "Producing summary table..."
-    head = ("{0:<30}{1:<14}{2:<14}{3:<14}{4:<14}{5:<14}{6:<14}{7:<14}"
-             "{8:<14}{9:<14}{10:<14}{11:<14}{12:<14}{13:<14}\n".format("# FILE",
-             "V", "dV", "S", "dS", "h3", "dh3", "h4", "dh4", "chi/DOF",
-             "S/N (/ pixel)", "ADEGREE", "MDEGREE", "100*S/N/sigma"))
-    results = []
-    ##########################################################################
-    # Initiate the output file
-    ##########################################################################
-    with open(output, "w") as f:
-        f.write(head)
-    ##########################################################################
-    if pkls== None:
-        pkls = [x.replace(".fits", ".pkl") for x in spectra]
-    for i, (spec, pkl) in enumerate(zip(spectra, pkls)):
-        print "Working on spectra {0} ({1} / {2})".format(spec, i+1,
-                                                          len(spectra))
-        if not os.path.exists(spec.replace(".fits", ".pkl")):
-            continue
-        pp = pPXF(spec, velscale, pklfile=pkl)
-        sn = pp.sn
-        if mc:
-            pp.mc_errors(nsim=nsim)
-        if pp.ncomp > 1:
-            pp.sol = pp.sol[0]
-            pp.error = pp.error[0]
-        data = [pp.sol[0], pp.error[0],
-                pp.sol[1], pp.error[1], pp.sol[2], pp.error[2], pp.sol[3],
-                pp.error[3], pp.chi2, sn]
-        data = ["{0:12.3f} ".format(x) for x in data]
-        if clean and pp.sol[1] == 1000.:
-            comment = "#"
-        else:
-            comment = ""
-        line = ["{0}{1}".format(comment, spec)] + data + \
-               ["{0:12}".format(pp.degree), "{0:12}".format(pp.mdegree),
-                "{0:12.3f}".format(100 * sn / pp.sol[1])]
-        # Append results to outfile
-        with open(output, "a") as f:
-            f.write(" ".join(line) + "\n")
+    _components = ["m_poly", "m_ssps", "m_gas", "m_sky", "w_poly", "w_ssps",
+                   "w_gas", "w_sky", "poly", "mpoly", "ssps", "gas", "bestsky"]
 
-class pPXF():
-    """ Class to read pPXF pkl files """
     def __init__(self, spec, velscale, pp):
         self.__dict__ = pp.__dict__.copy()
         self.spec = spec
+        self.velscale = velscale
         self.dw = 0.7 # Angstrom / pixel
-        self.calc_arrays()
         self.calc_sn()
         return
 
+    def __getattr__(self, name):
+        """ Compute the components of the fit on first access. """
+        if name not in pPXF._components:
+            raise AttributeError(name)
+        value = self.calc_component(name)
+        setattr(self, name, value)
+        return value
+
+    def calc_component(self, name):
+        """ Calculate one of the useful arrays of the fit."""
+        # Columns of matrix and weights of each component
+        n = np.cumsum([0, self.ntemplates, self.ngas])
+        cols = {"ssps": slice(n[0], n[1]), "gas": slice(n[1], n[2]),
+                "sky": slice(n[2], None)}
+        if name == "m_poly":
+            return self.matrix[:,:self.degree + 1]
+        elif name.startswith("m_"):
+            col = cols[name[2:]]
+            return self.matrix[:,self.degree + 1:][:,col]
+        elif name == "w_poly":
+            return self.polyweights
+        elif name.startswith("w_"):
+            return self.weights[cols[name[2:]]]
+        elif name == "poly":
+            if hasattr(self, "polyweights"):
+                return self.m_poly.dot(self.w_poly)
+            return np.zeros_like(self.galaxy)
+        elif name == "mpoly":
+            if hasattr(self, "mpolyweights"):
+                x = np.linspace(-1, 1, len(self.galaxy))
+                return np.polynomial.legendre.legval(x, np.append(1,
+                                                     self.mpolyweights))
+            return np.ones_like(self.galaxy)
+        elif name == "bestsky":
+            return self.m_sky.dot(self.w_sky)
+        return getattr(self, "m_" + name).dot(getattr(self, "w_" + name))
+
     def calc_arrays(self):
-        """ Calculate the different useful arrays."""
-        # Slice matrix into components
-        self.m_poly = self.matrix[:,:self.degree + 1]
-        self.matrix = self.matrix[:,self.degree + 1:]
-        self.m_ssps = self.matrix[:,:self.ntemplates]
-        self.matrix = self.matrix[:,self.ntemplates:]
-        self.m_gas = self.matrix[:,:self.ngas]
-        self.matrix = self.matrix[:,self.ngas:]
-        self.m_sky = self.matrix
-        # Slice weights
-        if hasattr(self, "polyweights"):
-            self.w_poly = self.polyweights
-            self.poly = self.m_poly.dot(self.w_poly)
-        else:
-            self.poly = np.zeros_like(self.galaxy)
-        if hasattr(self, "mpolyweights"):
-            x = np.linspace(-1, 1, len(self.galaxy))
-            self.mpoly = np.polynomial.legendre.legval(x, np.append(1, self.mpolyweights))
-        else:
-            self.mpoly = np.ones_like(self.galaxy)
-        self.w_ssps = self.weights[:self.ntemplates]
-        self.weights = self.weights[self.ntemplates:]
-        self.w_gas = self.weights[:self.ngas]
-        self.weights = self.weights[self.ngas:]
-        self.w_sky = self.weights
-        # Calculating components
-        self.ssps = self.m_ssps.dot(self.w_ssps)
-        self.gas = self.m_gas.dot(self.w_gas)
-        self.bestsky = self.m_sky.dot(self.w_sky)
+        """ Calculate all the useful arrays at once."""
+        for name in pPXF._components:
+            if name != "w_poly" or hasattr(self, "polyweights"):
+                getattr(self, name)
         return
 
     def calc_sn(self, w1=4700., w2=6000.):
@@ -335,26 +430,41 @@ class pPXF():
         self.sn = self.signal / self.noise
         return
 
-    def mc_errors(self, nsim=200):
-        """ Calculate the errors using MC simulations"""
-        errs = np.zeros((nsim, len(self.error)))
-        for i in range(nsim):
-            y = self.bestfit + np.random.normal(0, self.noise,
-                                                len(self.galaxy))
-
-            noise = np.ones_like(self.galaxy) * self.noise
-            sim = ppxf(self.bestfit_unbroad, y, noise, velscale,
-                       [0, self.sol[1]],
-                       goodpixels=self.goodpixels, plot=False, moments=4,
-                       degree=-1, mdegree=-1,
-                       vsyst=self.vsyst, lam=self.lam, quiet=True, bias=0.)
-            errs[i] = sim.sol
-        median = np.ma.median(errs, axis=0)
-        error = 1.4826 * np.ma.median(np.ma.abs(errs - median), axis=0)
+    def mc_errors(self, nsim=200, seed=None, rtol=None):
+        """ Calculate the errors using MC simulations
+
+        The simulated spectra are the stellar part of the bestfit
+        (bestfit - gas - bestsky) plus noise. Each is fitted with a single
+        template, the combination of the stellar templates with the best
+        fitting weights w_ssps, instead of the full set of templates, and
+        with the degree, mdegree, goodpixels and moments of the fit, and with
+        bias=0 as required for MC errors. The errors therefore do not
+        include the template mismatch, nor the degeneracies with the gas
+        and sky components.
+
+        The nsim fits are done all at once with ppxf.mc_errors. The
+        simulations are reproducible for a given seed, and stop early when
+        the errors change by less than rtol (see ppxf.mc_errors). Returns
+        the solutions of the simulations.
+        """
+        sol = self.sol if self.ncomp == 1 else self.sol[0]
+        error = self.error if self.ncomp == 1 else self.error[0]
+        model = self.bestfit - self.gas - self.bestsky
+        template = self.star[:,:self.ntemplates].dot(self.w_ssps)
+        noise = np.ones_like(self.galaxy) * self.noise
+        mcerr, sims = mc_errors(template, model, noise, self.velscale, sol[:2],
+                                nsim=nsim, seed=seed, rtol=rtol,
+                                goodpixels=self.goodpixels, moments=len(sol),
+                                degree=self.degree, mdegree=self.mdegree,
+                                vsyst=self.vsyst * self.velscale, bias=0.)
         # Here I am using always the maximum error between the simulated
         # and the values given by pPXF.
-        self.error = np.maximum(error, self.error)
-        return
+        error = np.maximum(mcerr, error)
+        if self.ncomp == 1:
+            self.error = error
+        else:
+            self.error = [error] + list(self.error[1:])
+        return sims
 
     def plot(self, output, xlims = [4000, 6500], fignumber=1, textsize = 16):
         """ Plot pPXF run in a output file"""
@@ -515,40 +625,76 @@ def run_over_all():
     return
 
 def ppsave(pp, outroot="logs/out"):
-    """ Produces output files for a ppxf object. """
-    arrays = ["matrix", "w", "bestfit", "goodpixels", "galaxy", "noise"]
-    # delattr(pp, "star_rfft")
-    # delattr(pp, "star")
-    hdus = []
-    for i,att in enumerate(arrays):
-        if i == 0:
-            hdus.append(pf.PrimaryHDU(getattr(pp, att)))
-        else:
-            hdus.append(pf.ImageHDU(getattr(pp, att)))
-        delattr(pp, att)
-    hdulist = pf.HDUList(hdus)
-    hdulist.writeto(outroot + ".fits", clobber=True)
-    with open(outroot + ".pkl", "w") as f:
-        pickle.dump(pp, f)
+    """ Save a ppxf object in the result store outroot.npz.
+
+    The results are stored under the name of the spectrum, i.e. the
+    basename of outroot with the extension fits (see ppxf_store).
+    """
+    name = os.path.basename(outroot) + ".fits"
+    write_store(outroot + ".npz", [pp], names=[name])
 
 def ppload(inroot="logs/out"):
-    """ Read ppxf arrays. """
+    """ Read the results saved by ppsave.
+
+    Results saved as pickle and FITS files by older versions are also read.
+    """
+    if os.path.exists(inroot + ".npz"):
+        store = ResultStore(inroot + ".npz")
+        return store.load(os.path.basename(inroot) + ".fits")
     with open(inroot + ".pkl") as f:
         pp = pickle.load(f)
     arrays = ["matrix", "w", "bestfit", "goodpixels", "galaxy", "noise"]
     for i, item in enumerate(arrays):
-        setattr(pp, item, pf.getdata(inroot + ".fits", i))
+        setattr(pp, item, pf.getdata(inroot + ".fits", i, memmap=True))
     return pp
 
+def _result_files(log_dir):
+    """ Files saved by ppsave in log_dir, including the pkl files of older
+    versions, but not the store of build_store. """
+    files = []
+    for x in sorted(os.listdir(log_dir)):
+        root, ext = os.path.splitext(os.path.join(log_dir, x))
+        if x == "ppxf_results.npz":
+            continue
+        if ext == ".npz" or (ext == ".pkl" and not
+                             os.path.exists(root + ".npz")):
+            files.append(root + ext)
+    return files
+
+def build_store(log_dir="logs", output=None):
+    """ Collect all the results of a logs directory in a single store.
+
+    Each fit of run_ppxf is saved in its own file, so that the fits can run
+    in parallel. This function gathers them, and converts the pickle and
+    FITS files of older versions, into the file ppxf_results.npz of log_dir,
+    which is read at once by results_store.
+    """
+    if output is None:
+        output = os.path.join(log_dir, "ppxf_results.npz")
+    roots = [os.path.splitext(x)[0] for x in _result_files(log_dir)]
+    names = [os.path.basename(x) + ".fits" for x in roots]
+    write_store(output, (ppload(x) for x in roots), names=names)
+    return output
+
+def results_store(log_dir="logs"):
+    """ Read the results of a logs directory, from the file produced by
+    build_store. The file is rebuilt if any fit is more recent. """
+    filename = os.path.join(log_dir, "ppxf_results.npz")
+    files = _result_files(log_dir)
+    if not os.path.exists(filename) or any([os.path.getmtime(x) >
+                                os.path.getmtime(filename) for x in files]):
+        build_store(log_dir, filename)
+    return ResultStore(filename)
+
 def plot_all():
     """ Make plot of all fits. """
     os.chdir(data_dir)
     specs = sorted([x for x in os.listdir(".") if x.endswith(".fits")])
+    store = results_store("logs")
     for i,spec in enumerate(specs):
         print "Working on spec {0} ({1}/{2})".format(spec, i+1, len(specs))
         vhelio = pf.getval(spec, "VHELIO")
-        pp = ppload("logs/{0}".format(spec.replace(".fits", "")))
-        pp = pPXF(spec, velscale, pp)
+        pp = pPXF(spec, velscale, store.load(spec))
         if pp.ncomp == 1:
             pp.sol[0] += vhelio
         else:
@@ -658,8 +804,7 @@ def run_stellar_templates(velscale):
             if not os.path.exists("logs"):
                 os.mkdir("logs")
             ppsave(pp0, "logs/{0}".format(standard.replace(".fits", "")))
-            pp = ppload("logs/{0}".format(standard.replace(".fits", "")))
-            pp = pPXF(standard, velscale, pp)
+            pp = pPXF(standard, velscale, pp0)
             pp.plot("logs/{0}".format(standard.replace(".fits", ".png")))
             # plt.show()
     return
@@ -675,9 +820,9 @@ def flux_calibration_test(velscale):
         fibers = np.array([int(x.split(".")[1]) for x in standards])
         cmap = cm.get_cmap("rainbow")
         color = np.linspace(0,1,len(nights))
+        store = results_store("logs")
         for i,standard in enumerate(standards):
-            pp = ppload("logs/{0}".format(standard.replace(".fits", "")))
-            pp = pPXF(standard, velscale, pp)
+            pp = pPXF(standard, velscale, store.load(standard))
             h = pf.getheader(standard)
             # plt.plot(pp.w, pp.galaxy, "-k")
             # plt.plot(pp.w, pp.bestfit, "-r")
@@ -689,7 +834,8 @@ def flux_calibration_test(velscale):
     return
 
 def run_candidates(velscale, filenames=None, start=None, has_emission=False,
-                   ncomp=1, log_dir=None, mdegree=-1, degree=20):
+                   ncomp=1, log_dir=None, mdegree=-1, degree=20, float32=False,
+                   pca=None, xcorr=False):
     """ Run pPXF over candidates. """
     os.chdir(data_dir)
     if log_dir is None:
@@ -716,11 +862,166 @@ def run_candidates(velscale, filenames=None, start=None, has_emission=False,
         # # Go to the main routine of fitting
         run_ppxf(specs, velscale, ncomp=ncomp, has_emission=has_emission,
                  mdegree=mdegree, degree=degree, plot=True, sky=sky,
-                 start=start, log_dir=log_dir)
+                 start=start, log_dir=log_dir, float32=float32, pca=pca,
+                 xcorr=xcorr)
+    return
+
+##############################################################################
+# Parallel driver: the fits are first collected as tasks with absolute
+# paths, then dispatched to a pool of processes.
+
+def survey_tasks(nights=None, **options):
+    """ Tasks fitting all spectra of the nights in data_dir (run_over_all).
+
+    Each task is a dictionary with the absolute path of the spectrum, the
+    list of sky spectra of its night, the logs directory of the night and
+    the options of the fit (keywords of fit_spectrum and of load_library).
+    """
+    opts = dict(ncomp=1, has_emission=True, mdegree=-1, degree=12)
+    opts.update(options)
+    if nights is None:
+        nights = sorted(os.listdir(data_dir))
+    tasks = []
+    for night in nights:
+        wdir = os.path.join(data_dir, night)
+        fits = sorted([x for x in os.listdir(wdir) if x.endswith(".fits")])
+        skies = [os.path.join(wdir, x) for x in fits if x.startswith("sky")]
+        for spec in [x for x in fits if not x.startswith("sky")]:
+            tasks.append(dict(spec=os.path.join(wdir, spec), sky=skies,
+                              log_dir=os.path.join(wdir, "logs"),
+                              options=opts))
+    return tasks
+
+def candidate_tasks(filenames=None, log_dir=None, **options):
+    """ Tasks fitting the candidates in data_dir (run_candidates).
+
+    The sky spectra of each night are taken from the combined data. See
+    survey_tasks for the content of the tasks.
+    """
+    opts = dict(ncomp=1, has_emission=False, mdegree=-1, degree=20)
+    opts.update(options)
+    if log_dir is None:
+        log_dir = os.path.join(data_dir, "logs")
+    if filenames is None:
+        filenames = [x for x in os.listdir(data_dir) if x.endswith(".fits")]
+    tasks = []
+    for night in nights:
+        specs = sorted([x for x in filenames if
+                        x.endswith("{0}.fits".format(night))])
+        if len(specs) == 0:
+            continue
+        sky_dir = os.path.join(home, "data/combined", night)
+        skies = sorted([os.path.join(sky_dir, x) for x in os.listdir(sky_dir)
+                        if x.startswith("sky") and x.endswith(".fits")])
+        for spec in specs:
+            tasks.append(dict(spec=os.path.join(data_dir, spec), sky=skies,
+                              log_dir=log_dir, options=opts))
+    return tasks
+
+def _library_options(options):
+    """ Split the options of a task into those of load_library and the
+    keywords of fit_spectrum. """
+    fit_options = dict(options)
+    config = (fit_options.pop("has_emission", True), options.get("ncomp", 1),
+              fit_options.pop("pca", None))
+    return config, fit_options
+
+# State of each worker process of run_parallel
+_worker = {}
+
+def _init_worker(velscale, configs, rfft_dir=None):
+    """ Load the template libraries once in each worker process. """
+    plt.switch_backend("Agg") # The figures are only saved to the logs
+    _worker["velscale"] = velscale
+    _worker["cache"] = rfft_cache(directory=rfft_dir)
+    _worker["libraries"] = dict([(config, load_library(*config))
+                                 for config in configs])
+    _worker["skies"] = {}
+
+def _fit_task(task):
+    """ Fit the spectrum of a task in a worker process.
+
+    Returns the spectrum, the process id, the time spent and the status of
+    the fit, which is the error message if it failed.
+    """
+    t0 = time.time()
+    config, fit_options = _library_options(task["options"])
+    try:
+        skies = tuple(task["sky"])
+        if skies not in _worker["skies"]:
+            _worker["skies"][skies] = load_sky(list(skies),
+                            _worker["velscale"]) if len(skies) else None
+        fit_spectrum(task["spec"], _worker["velscale"],
+                     _worker["libraries"][config],
+                     sky=_worker["skies"][skies], log_dir=task["log_dir"],
+                     cache=_worker["cache"], **fit_options)
+        status = "ok"
+    except Exception as e:
+        status = "{0}: {1}".format(type(e).__name__, e).replace("\n", " ")
+    return task["spec"], os.getpid(), time.time() - t0, status
+
+def run_parallel(tasks, velscale, processes=None, rfft_dir=None):
+    """ Run the tasks of survey_tasks or candidate_tasks in parallel.
+
+    Each worker loads the template libraries needed by the tasks once, and
+    the sky spectra once per night. The outputs are written in the logs
+    directory of each task, as in the serial drivers, and the time spent
+    in each fit is appended to the file timing.txt in the same directory.
+    If processes is None, the number of CPUs is used. If processes is 1,
+    the tasks are run in the current process.
+    """
+    configs = sorted(set([_library_options(t["options"])[0] for t in tasks]))
+    for log_dir in set([t["log_dir"] for t in tasks]):
+        if not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+    initargs = (velscale, configs, rfft_dir)
+    t0 = time.time()
+    if processes == 1:
+        _init_worker(*initargs)
+        results = (_fit_task(task) for task in tasks)
+    else:
+        pool = multiprocessing.Pool(processes, initializer=_init_worker,
+                                    initargs=initargs)
+        results = pool.imap_unordered(_fit_task, tasks)
+    logs = dict([(t["spec"], t["log_dir"]) for t in tasks])
+    ttot, nfail = 0., 0
+    for i, (spec, pid, dt, status) in enumerate(results):
+        print "{0} ({1} of {2}): {3:.1f} s, {4}".format(
+              os.path.basename(spec), i+1, len(tasks), dt, status)
+        with open(os.path.join(logs[spec], "timing.txt"), "a") as f:
+            f.write("{0:40s} {1:8d} {2:10.2f} {3}\n".format(
+                    os.path.basename(spec), pid, dt, status))
+        ttot += dt
+        nfail += status != "ok"
+    if processes != 1:
+        pool.close()
+        pool.join()
+    for log_dir in set(logs.values()):
+        build_store(log_dir)
+    print "{0} fits ({1} failed) in {2:.1f} s ({3:.1f} s summed over the " \
+          "fits)".format(len(tasks), nfail, time.time() - t0, ttot)
     return
 
-def make_table():
-    """ Make table with results. """
+def make_table(mc=False, nsim=200, seed=None, rtol=None):
+    """ Make table with results.
+
+    ===================
+    Input Parameters
+    ===================
+    mc : bool
+        Calculate the errors using a Monte Carlo method.
+    nsim : int
+        Number of simulations in case mc keyword is True.
+    seed : int
+        Seed of the random numbers of the simulations.
+    rtol : float
+        Stop the simulations when the errors change by less than rtol.
+    ==================
+    Output file
+    ==================
+    In case mc is False, the function produces a file called ppxf_results.dat.
+    Otherwise, the name of the file is ppxf_results_mc_nsim.dat.
+    """
     head = ("{0:<30}{1:<14}{2:<14}{3:<14}{4:<14}{5:<14}{6:<14}{7:<14}"
              "{8:<14}{9:<14}{10:<14}{11:<14}{12:<14}{13:<14}\n".format("# "
                                                                        "FILE",
@@ -728,13 +1029,16 @@ def make_table():
              "S/N (/ pixel)", "ADEGREE", "MDEGREE", "EMISSION"))
     os.chdir(data_dir)
     specs = sorted([x for x in os.listdir(".") if x.endswith(".fits")])
+    store = results_store("logs")
     results = []
     for spec in specs:
         print spec
         vhelio = pf.getval(spec, "VHELIO")
-        output = os.path.join(data_dir, "ppxf_results.dat")
-        pp = ppload("logs/" + spec.replace(".fits", ""))
-        pp = pPXF(spec, velscale, pp)
+        output = os.path.join(data_dir, "ppxf_results_mc_{0}.dat".format(nsim)
+                              if mc else "ppxf_results.dat")
+        pp = pPXF(spec, velscale, store.load(spec))
+        if mc:
+            pp.mc_errors(nsim=nsim, seed=seed, rtol=rtol)
         sol = pp.sol if pp.ncomp == 1 else pp.sol[0]
         sol[0] += vhelio
         error = pp.error if pp.ncomp == 1 else pp.error[0]
@@ -769,10 +1073,10 @@ def make_table_standards():
         print night
         os.chdir(os.path.join(standards_dir, night))
         specs = sorted([x for x in os.listdir(".") if x.endswith(".fits")])
+        store = results_store("logs")
         for spec in specs:
             try:
-                pp = ppload("logs/" + spec.replace(".fits", ""))
-                pp = pPXF(spec, velscale, pp)
+                pp = pPXF(spec, velscale, store.load(spec))
             except:
                 continue
             sol = pp.sol if pp.ncomp == 1 else pp.sol[0]
@@ -801,8 +1105,9 @@ def broad2hydra(wave, intens, obsres):
         Wavelenght 1-D array in Angstroms.
 
     intens: array_like
-        Intensity 1-D array of Intensity, in arbitrary units. The lenght has
-        to be the same as wl.
+        Intensity array, in arbitrary units. Either 1-D with the same lenght
+        as wave, or 2-D with one spectrum per column, e.g. a whole template
+        library.
 
     obsres: float
         Value of the observed resolution Full Width at Half Maximum (FWHM) in
@@ -812,18 +1117,14 @@ def broad2hydra(wave, intens, obsres):
     Output parameters
     =================
     array_like
-        The convolved intensity 1-D array.
+        The convolved intensity array, with the same shape as intens.
 
     """
     coeffs = np.array([1.84892311e-16, -4.32973804e-12, 3.94864261e-08,
                      -1.73552121e-04, 3.61151772e-01, -2.70743632e+02])
     poly = np.poly1d(coeffs)
     sigmas = np.sqrt(poly(wave)**2 - obsres**2) / 2.3548 / (wave[1] - wave[0])
-    intens2D = np.diag(intens)
-    for i in range(len(sigmas)):
-        intens2D[i] = gaussian_filter1d(intens2D[i], sigmas[i],
-                      mode="constant", cval=0.0)
-    return intens2D.sum(axis=0)
+    return variable_gaussian_filter1d(intens, sigmas)
 
 if __name__ == '__main__':
     # run_stellar_templates(velscale)
@@ -837,5 +1138,6 @@ if __name__ == '__main__':
     #                ncomp=1, log_dir=logs_ssps, mdegree=15, degree=4,
     #                filenames=["ngc7619_166_blanco11bn1.fits"])
     # run_not_combined(velscale)
+    # run_parallel(survey_tasks(), velscale)
     # plot_all()
     make_table()
\ No newline at end of file
@@ -0,0 +1,156 @@
+##############################################################################
+#
+# Regression tests for the LAPACK=1 option of cap_mpfit, which must follow
+# the same iterations as the MINPACK translation
+#
+##############################################################################
+
+from __future__ import print_function
+
+import numpy as np
+from scipy.interpolate import LinearNDInterpolator
+
+import cap_mpfit as mpfit
+from ppxf import ppxf
+from test_ppxf import synthetic_spectrum
+
+#------------------------------------------------------------------------
+
+def random_jacobian(m=300, n=12, seed=1):
+    """ Jacobian with columns of very different norms, and residuals """
+    rng = np.random.RandomState(seed)
+    a = rng.randn(m, n)*np.logspace(-2, 2, n)
+    a[:, 5] = a[:, 2] + 1e-8*rng.randn(m)  # nearly degenerate columns
+    return a, rng.randn(m)
+
+#------------------------------------------------------------------------
+
+def minpack_qr(fit, a, b):
+    """
+    R, pivots, column norms and (q transpose)*b as computed by the
+    MINPACK code path in the body of mpfit
+
+    """
+    n = a.shape[1]
+    [a, ipvt, rdiag, acnorm] = fit.qrfac(a.copy(), pivot=1)
+    qtb = b.copy()
+    for j in range(n):
+        lj = ipvt[j]
+        if a[j, lj] != 0:
+            qtb[j:] -= a[j:, lj]*np.sum(a[j:, lj]*qtb[j:])/a[j, lj]
+        a[j, lj] = rdiag[j]
+    return np.triu(a[:n, :n][:, ipvt]), ipvt, acnorm, qtb[:n]
+
+#------------------------------------------------------------------------
+
+def test_qrfac_lmpar():
+    """
+    The LAPACK factorization and Levenberg-Marquardt parameter agree with
+    the MINPACK ones, for steps bounds DELTA in the three regimes of lmpar
+
+    """
+    fit = mpfit.mpfit(None)
+    fit.machar = mpfit.machar(double=1)
+    a, b = random_jacobian()
+    r, ipvt, acnorm, qtb = minpack_qr(fit, a, b)
+    r1, ipvt1, rdiag1, acnorm1, qtb1 = fit.qrfac_lapack(a, b)
+    assert np.array_equal(ipvt, ipvt1)
+    assert np.allclose(r1, r, rtol=0, atol=1e-12*np.abs(r).max())
+    assert np.allclose(qtb1, qtb) and np.allclose(acnorm1, acnorm)
+
+    n = a.shape[1]
+    for delta in [1e-3, 1., 1e6]:
+        out = fit.lmpar(r.copy(), ipvt, acnorm, qtb, delta, np.zeros(n), np.zeros(n), par=0.)
+        out1 = fit.lmpar_lapack(r.copy(), ipvt, acnorm, qtb, delta, np.zeros(n), np.zeros(n), par=0.)
+        assert np.isclose(out1[1], out[1], rtol=1e-8)
+        assert np.allclose(out1[2], out[2], rtol=1e-6, atol=1e-10*np.abs(out[2]).max())
+
+#------------------------------------------------------------------------
+
+def check_same_fit(fcn, p0, **kwargs):
+    """
+    Same sequence of function evaluations with and without LAPACK. The
+    number of successful iterations can still differ when, at the minimum,
+    steps giving a reduction of chi2 at the rounding level are accepted
+    in one case and rejected in the other
+
+    """
+    fit, calls = [], []
+    for lapack in [0, 1]:
+        params = []
+        def func(p, fjac=None, **functkw):
+            params.append(p.copy())
+            return fcn(p, fjac=fjac, **functkw)
+        fit.append(mpfit.mpfit(func, p0, quiet=1, lapack=lapack, **kwargs))
+        calls.append(np.array(params))
+    assert fit[0].status > 0 and fit[1].status == fit[0].status
+    assert fit[1].nfev == fit[0].nfev
+    assert np.allclose(calls[1], calls[0], rtol=1e-6, atol=1e-6)
+    assert np.allclose(fit[1].params, fit[0].params, rtol=1e-8, atol=1e-8)
+    assert np.allclose(fit[1].perror, fit[0].perror, rtol=1e-6)
+    return fit
+
+#------------------------------------------------------------------------
+
+def test_ssp_fit():
+    """
+    Fit of line strengths with a linearly interpolated grid of stellar
+    population models, as in run_mcmc.fit_interactive
+
+    """
+    age, metal, alpha = np.meshgrid(np.linspace(1, 15, 15), np.linspace(-2.25, 0.67, 12),
+                                    np.linspace(-0.3, 0.5, 5), indexing='ij')
+    pars = np.column_stack([age.ravel(), metal.ravel(), alpha.ravel()])
+    coef = np.random.RandomState(2).uniform(-1, 1, (4, 8))
+    data = coef[0] + np.log(pars[:, :1]).dot(coef[1:2]) + pars[:, 1:2].dot(coef[2:3]) \
+         + pars[:, 2:3].dot(coef[3:]) + 0.3*(pars[:, :1]*pars[:, 1:2]).dot(coef[3:])
+    ssp = LinearNDInterpolator(pars, data)
+
+    def fitfunc(p, fjac=None, y=None, err=None, model=None):
+        return [0, (y - model(p)[0])/err]
+
+    err = np.full(8, 0.02)
+    for p in [[10., -0.4, 0.2], [3., 0.2, 0.05]]:
+        y = ssp(p)[0] + err*np.random.RandomState(3).randn(8)
+        fa = {'y': y, 'err': err, 'model': ssp}
+        check_same_fit(fitfunc, np.array([5., 0., 0.]), functkw=fa)
+
+#------------------------------------------------------------------------
+
+def test_bounded_fit():
+    """ Fit with parameter limits and pegged parameters """
+    x = np.linspace(-1, 1, 500)
+    y = 3*np.exp(-0.5*((x - 0.2)/0.15)**2) + 0.5*x + 0.01*np.random.RandomState(4).randn(x.size)
+
+    def fitfunc(p, fjac=None):
+        return [0, y - p[0]*np.exp(-0.5*((x - p[1])/p[2])**2) - p[3] - p[4]*x]
+
+    parinfo = [{'value': v, 'limited': [1, 1], 'limits': lim, 'step': 1e-3}
+               for v, lim in zip([1., 0., 0.3, 0.1, 0.], [[0, 10], [-1, 1], [0.01, 1], [0, 1], [0, 0.4]])]
+    fit = check_same_fit(fitfunc, None, parinfo=parinfo)
+    assert fit[0].params[4] == 0.4  # pegged at the upper limit
+
+#------------------------------------------------------------------------
+
+def test_ppxf_lapack():
+    """ ppxf fits with analytic and numerical derivatives, and CLEAN """
+    templates, galaxy, noise, velscale = synthetic_spectrum(npix=3000, ngas=3)
+    component = [0]*10 + [1]*3
+    for kwargs in [dict(moments=4, mdegree=10), dict(moments=[4, 2], component=component, mdegree=5),
+                   dict(moments=6, autoderivative=True), dict(moments=4, clean=True)]:
+        start = [[100., 100.], [100., 50.]] if 'component' in kwargs else [100., 100.]
+        tpl = templates if 'component' in kwargs else templates[:, :10]
+        pp = [ppxf(tpl, galaxy, noise, velscale, start, quiet=True, lapack=lapack, **kwargs)
+              for lapack in [False, True]]
+        sol = [np.hstack(p.sol) for p in pp]
+        assert np.all(np.abs(sol[1] - sol[0]) < 1e-8*np.hstack(pp[0].error))
+        assert np.allclose(pp[1].weights, pp[0].weights, rtol=1e-6)
+        assert np.array_equal(pp[1].goodpixels, pp[0].goodpixels)
+
+#------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    test_qrfac_lmpar()
+    test_ssp_fit()
+    test_bounded_fit()
+    test_ppxf_lapack()
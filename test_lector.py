@@ -0,0 +1,47 @@
+##############################################################################
+#
+# Tests of the variable-width Gaussian broadening of lector
+#
+##############################################################################
+
+from __future__ import print_function
+
+import numpy as np
+from scipy.ndimage import gaussian_filter1d
+
+from lector import variable_gaussian_filter1d
+
+#------------------------------------------------------------------------
+
+def dense_broadening(intens, sigmas):
+    """ Broadening with one gaussian_filter1d per pixel, as in broad2lick """
+    intens2D = np.diag(intens)
+    for i in range(len(sigmas)):
+        intens2D[i] = gaussian_filter1d(intens2D[i], sigmas[i],
+                      mode="constant", cval=0.0)
+    return intens2D.sum(axis=0)
+
+#------------------------------------------------------------------------
+
+def test_variable_gaussian_filter1d():
+    """
+    Same result as the dense computation, for one spectrum and for a stack
+    of spectra, with kernels wider than the distance to the edges
+
+    """
+    rng = np.random.RandomState(5)
+    npix = 600
+    sigmas = 1 + 8*np.linspace(0, 1, npix)**2 + rng.uniform(0, 0.5, npix)
+    spectra = 1 + 0.1*rng.randn(npix, 3)
+    spectra[::37] -= 0.8
+    out = variable_gaussian_filter1d(spectra, sigmas)
+    assert out.shape == spectra.shape
+    for j in range(spectra.shape[1]):
+        dense = dense_broadening(spectra[:, j], sigmas)
+        assert np.allclose(out[:, j], dense, rtol=1e-13, atol=0)
+        assert np.array_equal(variable_gaussian_filter1d(spectra[:, j], sigmas), out[:, j])
+
+#------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    test_variable_gaussian_filter1d()
@@ -0,0 +1,762 @@
+##############################################################################
+#
+# Regression tests for the procedure ppxf, using synthetic spectra
+#
+##############################################################################
+
+from __future__ import print_function
+
+import multiprocessing
+import pickle
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
+from scipy import optimize, sparse, linalg
+
+from ppxf import (ppxf, ppxf_batch, nnls_flags, rfft_cache, fft_backend, fast_fft_length,
+                  least_squares_fit, prune_templates, xcorr_kinematics, mc_errors,
+                  _regularization_matrix, _losvd_kernels)
+
+#------------------------------------------------------------------------
+
+def synthetic_spectrum(ntemp=10, npix=1500, velscale=20., ngas=0,
+                       sol=(150., 120., 0.05, -0.03), noise=0.01, seed=123):
+    """
+    Random absorption-line templates and a galaxy spectrum obtained by
+    convolving a positive combination of them with a Gauss-Hermite LOSVD
+
+    """
+    np.random.seed(seed)
+    n = npix + 400
+    x = np.arange(n)
+    lines = np.random.uniform(0, n, 100)
+    templates = np.empty((n, ntemp))
+    for j in range(ntemp):
+        t = 1 + 0.3*np.sin(x/500. + j)
+        for lj in lines:
+            t -= np.random.uniform(0, 0.3)*np.exp(-0.5*((x - lj)/np.random.uniform(1.5, 4))**2)
+        templates[:, j] = t
+    if ngas > 0:
+        gas = np.exp(-0.5*((x[:, None] - np.random.uniform(200, n - 200, ngas))/1.5)**2)
+        templates = np.column_stack([templates, gas])
+
+    weights = np.random.uniform(0, 1, templates.shape[1])
+    galaxy = losvd_convolve(templates.dot(weights), sol, velscale)[:npix]
+    galaxy += np.random.normal(0, noise, npix)
+
+    return templates, galaxy, np.full(npix, noise), velscale
+
+#------------------------------------------------------------------------
+
+def losvd_convolve(spectrum, sol, velscale):
+    """ Convolve a spectrum with the Gauss-Hermite LOSVD SOL = [V, sigma, h3, h4] """
+    vel, sigma = np.asarray(sol[:2])/velscale
+    dx = int(abs(vel) + 6*sigma)
+    w = (np.arange(-dx, dx + 1) - vel)/sigma
+    losvd = np.exp(-0.5*w**2)*(1 + sol[2]/np.sqrt(3)*(w*(2*w**2 - 3))
+                               + sol[3]/np.sqrt(24)*(w**2*(4*w**2 - 12) + 3))
+
+    return np.convolve(spectrum, losvd/losvd.sum(), mode='same')
+
+#------------------------------------------------------------------------
+
+def sky_residuals(galaxy, velscale, lam0=4800., amplitude=0.3, ncosmics=5, seed=0):
+    """
+    Add to GALAXY, logarithmically sampled from LAM0 with steps of VELSCALE,
+    the residual of the subtraction of the [OI] 5577A sky line, with its
+    negative wing, and a few cosmic rays. Returns the wavelength and the spectrum
+
+    """
+    rng = np.random.RandomState(seed)
+    lam = lam0*np.exp(np.arange(galaxy.size)*velscale/299792.458)
+    x = (lam - 5577.34)/1.3
+    galaxy = galaxy + amplitude*(np.exp(-0.5*x**2) - 0.8*np.exp(-0.5*(x - 1.5)**2))
+    galaxy[rng.randint(0, galaxy.size, ncosmics)] += rng.uniform(0.2, 1.0, ncosmics)
+
+    return lam, galaxy
+
+#------------------------------------------------------------------------
+
+def synthetic_batch(nspec=8, ntemp=10, npix=1500, velscale=20., ngas=0, noise=0.01, seed=123):
+    """
+    Spectra with random kinematics and weights, all made from the same
+    templates of synthetic_spectrum, one per column of GALAXY
+
+    """
+    templates = synthetic_spectrum(ntemp, npix, velscale, ngas, seed=seed)[0]
+    galaxy = np.empty((npix, nspec))
+    for j in range(nspec):
+        sol = [np.random.uniform(50, 300), np.random.uniform(60, 200),
+               np.random.uniform(-0.1, 0.1), np.random.uniform(-0.1, 0.1)]
+        weights = np.random.uniform(0, 1, templates.shape[1])
+        galaxy[:, j] = losvd_convolve(templates.dot(weights), sol, velscale)[:npix]
+    galaxy += np.random.normal(0, noise, galaxy.shape)
+
+    return templates, galaxy, np.full(galaxy.shape, noise), velscale
+
+#------------------------------------------------------------------------
+
+def synthetic_grid(nage=8, nmetal=5, npix=1500, velscale=20., ngas=0, noise=0.01, seed=123):
+    """
+    Templates with line strengths varying smoothly on a grid of NAGE x NMETAL
+    stellar population parameters, their integer coordinates on the grid
+    (-1 for the gas templates), and a galaxy spectrum made of a few
+    neighbouring templates as in synthetic_spectrum
+
+    """
+    np.random.seed(seed)
+    n = npix + 400
+    x = np.arange(n)
+    lines = np.random.uniform(0, n, 100)
+    depth = np.random.uniform(0, 0.3, (3, lines.size))
+    width = np.random.uniform(1.5, 4, lines.size)
+    profiles = np.exp(-0.5*((x[:, None] - lines)/width)**2)
+    age, metal = np.meshgrid(np.linspace(0, 1, nage), np.linspace(-1, 1, nmetal), indexing='ij')
+    depths = depth[0] + 0.5*np.outer(age.ravel(), depth[1]) + 0.3*np.outer(metal.ravel(), depth[2])
+    templates = 1 + 0.3*np.sin(x[:, None]/500. + age.ravel()) - profiles.dot(depths.T)
+    grid = np.column_stack(np.unravel_index(np.arange(nage*nmetal), (nage, nmetal)))
+    if ngas > 0:
+        gas = np.exp(-0.5*((x[:, None] - np.random.uniform(200, n - 200, ngas))/1.5)**2)
+        templates = np.column_stack([templates, gas])
+        grid = np.vstack([grid, -np.ones((ngas, 2), dtype=int)])
+
+    weights = np.zeros(templates.shape[1])
+    weights[np.ravel_multi_index(([nage//2, nage//2 + 1, 1], [nmetal//2]*2 + [1]), (nage, nmetal))] = [1., 0.5, 0.2]
+    weights[nage*nmetal:] = np.random.uniform(0, 1, ngas)
+    galaxy = losvd_convolve(templates.dot(weights), (150., 120., 0.05, -0.03), velscale)[:npix]
+    galaxy += np.random.normal(0, noise, npix)
+
+    return templates, grid, galaxy, np.full(npix, noise), velscale
+
+#------------------------------------------------------------------------
+
+def gaussian_losvd_rfft(pp, vel, sigma):
+    """
+    FFT of a Gaussian LOSVD sampled as in ppxf._fitfunc (velocities in pixels)
+
+    """
+    dx = int(np.ceil(abs(pp.vsyst + vel) + 5*sigma))
+    nl = 2*dx*pp.factor + 1
+    w = (np.linspace(-dx, dx, nl) - pp.vsyst - vel)/sigma
+    losvd = np.exp(-0.5*w**2)
+    losvd_pad = np.zeros(pp.npad)
+    losvd_pad[:nl] = losvd/losvd.sum()
+
+    return np.fft.rfft(np.roll(losvd_pad, (2 - nl)//2))
+
+#------------------------------------------------------------------------
+
+def convolve_templates_loop(pp, losvd_rfft):
+    """
+    Reference one-template-at-a-time LOSVD convolution (pPXF V5.1.16)
+
+    """
+    npix = pp.galaxy.size
+    out = np.empty((npix, pp.star.shape[1]))
+    for j, star_rfft in enumerate(pp.star_rfft.T):
+        tt = np.fft.irfft(star_rfft*losvd_rfft)
+        if pp.factor > 1:
+            tt = np.mean(tt[:pp.star.shape[0]*pp.factor].reshape(-1, pp.factor), axis=1)
+        out[:, j] = tt[:npix]
+
+    return out
+
+#------------------------------------------------------------------------
+
+def test_batched_convolution():
+    """
+    The block convolution of _fitfunc reproduces the per-template loop
+
+    """
+    templates, galaxy, noise, velscale = synthetic_spectrum()
+    for oversample in [False, 3]:
+        pp = ppxf(templates, galaxy, noise, velscale, [100., 100.],
+                  degree=-1, oversample=oversample, quiet=True)
+        pars = np.array([5.3, 4.1])
+        pp._fitfunc(pars)
+        ref = convolve_templates_loop(pp, gaussian_losvd_rfft(pp, *pars))
+        assert np.allclose(pp.matrix, ref, rtol=1e-12, atol=1e-12)
+
+#------------------------------------------------------------------------
+
+def numerical_jacobian(pp, pars, step=1e-6):
+    """
+    Central finite-difference derivatives of the model in ppxf._fitfunc
+
+    """
+    jac = np.empty((pp.goodpixels.size, pars.size))
+    for j in range(pars.size):
+        h = np.zeros_like(pars)
+        h[j] = step*max(abs(pars[j]), 1)
+        jac[:, j] = (pp._fitfunc(pars - h)[1] - pp._fitfunc(pars + h)[1])/(2*h[j])
+
+    return jac
+
+#------------------------------------------------------------------------
+
+def test_analytic_jacobian():
+    """
+    The analytic derivatives agree with finite differences
+
+    """
+    templates, galaxy, noise, velscale = synthetic_spectrum(ngas=3)
+    component = [0]*10 + [1]*3
+    cases = [(dict(moments=4, mdegree=3), [7.2, 6.1, 0.04, -0.02, 0.01, -0.02, 0.03]),
+             (dict(moments=6, oversample=3), [7.2, 6.1, 0.04, -0.02, 0.01, 0.02]),
+             (dict(moments=[4, 2], component=component), [7.2, 6.1, 0.04, -0.02, 6.9, 3.2])]
+    for kwargs, pars in cases:
+        start = [[100., 100.], [100., 50.]] if 'component' in kwargs else [100., 100.]
+        tpl = templates if 'component' in kwargs else templates[:, :10]
+        pp = ppxf(tpl, galaxy, noise, velscale, start, bias=0, quiet=True, **kwargs)
+        pars = np.array(pars)
+        jac = pp._fitfunc(pars, fjac=np.ones_like(pars))[2]
+        num = numerical_jacobian(pp, pars)
+        assert np.allclose(jac, num, rtol=1e-6, atol=1e-6*np.abs(num).max())
+
+    # Analytic and numerical derivatives converge to the same solution
+    #
+    sol = [ppxf(templates[:, :10], galaxy, noise, velscale, [100., 100.], moments=4,
+                quiet=True, autoderivative=autoderivative).sol for autoderivative in [False, True]]
+    assert np.allclose(sol[0], sol[1], rtol=1e-3, atol=1e-3)
+
+#------------------------------------------------------------------------
+
+def nnls_flags_doubled(A, b, flag):
+    """
+    Reference solution splitting the free variables into two non-negative
+    ones, as done by nnls_flags in pPXF V5.1.16
+
+    """
+    n = A.shape[1]
+    x = optimize.nnls(np.hstack([A, -A[:, flag]]), b)[0]
+    x[:n][flag] -= x[n:]
+
+    return x[:n]
+
+#------------------------------------------------------------------------
+
+def test_nnls_flags():
+    """
+    The active-set solver reproduces the reference solution, both from
+    a cold start and from an arbitrary starting passive set
+
+    """
+    np.random.seed(1)
+    for j in range(50):
+        m, n = np.random.randint(60, 300), np.random.randint(5, 50)
+        A = np.random.normal(size=(m, n))
+        b = np.random.normal(size=m)
+        flag = np.arange(n) < np.random.randint(0, 5)
+        ref = nnls_flags_doubled(A, b, flag)
+        for passive in [None, np.random.uniform(size=n) < 0.5]:
+            x = nnls_flags(A, b, flag, passive)
+            assert np.all(x[~flag] >= 0)
+            assert np.allclose(x, ref, rtol=1e-8, atol=1e-10)
+
+#------------------------------------------------------------------------
+
+def regularization_rows_loop(reg_dim, regul, npoly, ncols):
+    """
+    Reference dense regularization rows built as in pPXF V5.1.16
+
+    """
+    i = npoly + np.arange(np.prod(reg_dim)).reshape(reg_dim)
+    diff = np.array([-1, 2, -1])*regul
+    ind = np.array([-1, 0, 1])
+    rows = []
+    for q in np.ndindex(*reg_dim):
+        for ax, n in enumerate(reg_dim):
+            if 0 != q[ax] != n - 1:
+                j = list(q)
+                j[ax] = q[ax] + ind
+                row = np.zeros(ncols)
+                row[i[tuple(j)]] = diff
+                rows.append(row)
+
+    return np.array(rows)
+
+#------------------------------------------------------------------------
+
+def test_regularization_matrix():
+    """
+    The sparse operator contains the same finite differences as the
+    dense rows, and regularized fits are unchanged
+
+    """
+    for reg_dim in [[7], [5, 4], [4, 3, 5]]:
+        reg = _regularization_matrix(reg_dim, 3., 4, 4 + np.prod(reg_dim) + 1)
+        ref = regularization_rows_loop(reg_dim, 3., 4, reg.shape[1])
+        assert reg.shape == ref.shape
+        assert np.allclose(reg.T.dot(reg).toarray(), ref.T.dot(ref))
+
+    templates, galaxy, noise, velscale = synthetic_spectrum(ntemp=12)
+    pp = ppxf(templates.reshape(-1, 4, 3), galaxy, noise, velscale, [100., 100.],
+              regul=10., quiet=True)
+    a = np.vstack([pp.matrix/noise[:, None], regularization_rows_loop([4, 3], 10., 5, 17)])
+    b = np.append(galaxy/noise, np.zeros(a.shape[0] - galaxy.size))
+    flag = np.arange(17) < 5
+    ref = nnls_flags_doubled(a, b, flag)
+    assert np.allclose(np.append(pp.polyweights, pp.weights), ref, rtol=1e-7, atol=1e-9)
+
+#------------------------------------------------------------------------
+
+def test_rfft_cache():
+    """
+    Fits using the template FFT cache, in memory or memory-mapped on disk,
+    are identical to fits without it, and the FFT is computed only once
+
+    """
+    templates, galaxy, noise, velscale = synthetic_spectrum()
+    ref = ppxf(templates, galaxy, noise, velscale, [100., 100.], moments=4, quiet=True)
+    directory = tempfile.mkdtemp()
+    try:
+        for d in [None, directory]:
+            cache = rfft_cache(directory=d)
+            for vsyst in [0., 0., 10.]:
+                pp = ppxf(templates, galaxy, noise, velscale, [100., 100.], moments=4,
+                          quiet=True, rfft_cache=cache, vsyst=vsyst)
+                if vsyst == 0:
+                    assert np.array_equal(pp.bestfit, ref.bestfit)
+            assert cache.misses == 1 and cache.hits == 2
+
+        # A new cache finds the FFT on disk
+        #
+        cache = rfft_cache(maxsize=1, directory=directory)
+        pp = ppxf(templates, galaxy, noise, velscale, [100., 100.], moments=4,
+                  quiet=True, rfft_cache=cache)
+        assert cache.misses == 0 and np.array_equal(pp.bestfit, ref.bestfit)
+
+        # Least recently used entries are evicted
+        #
+        ppxf(templates[:, :5], galaxy, noise, velscale, [100., 100.], quiet=True, rfft_cache=cache)
+        assert len(cache.entries) == 1 and cache.misses == 1
+    finally:
+        shutil.rmtree(directory)
+
+#------------------------------------------------------------------------
+
+def test_fft_backend():
+    """
+    The FFT length is the smallest 5-smooth number above the required
+    padding, and all FFT backends give the same fit
+
+    """
+    smooth = sorted(2**i*3**j*5**k for i in range(12) for j in range(8) for k in range(6))
+    for n in range(1, 2000):
+        assert fast_fft_length(n) == next(m for m in smooth if m >= n)
+
+    templates, galaxy, noise, velscale = synthetic_spectrum()
+    ref = ppxf(templates, galaxy, noise, velscale, [100., 100.], moments=4, quiet=True)
+    assert ref.npad == fast_fft_length(ref.npad)
+    for fft in ['scipy', fft_backend('scipy', workers=2)]:
+        pp = ppxf(templates, galaxy, noise, velscale, [100., 100.], moments=4,
+                  quiet=True, fft=fft)
+        assert np.allclose(pp.bestfit, ref.bestfit, rtol=1e-10, atol=1e-12)
+
+#------------------------------------------------------------------------
+
+def test_float32():
+    """
+    Single precision fits give the kinematics of double precision ones
+    to a tiny fraction of the formal errors
+
+    """
+    templates, galaxy, noise, velscale = synthetic_spectrum(ngas=3)
+    component = [0]*10 + [1]*3
+    for kwargs in [dict(moments=4, mdegree=3), dict(moments=[4, 2], component=component),
+                   dict(moments=4, clean=True, autoderivative=True)]:
+        start = [[100., 100.], [100., 50.]] if 'component' in kwargs else [100., 100.]
+        tpl = templates if 'component' in kwargs else templates[:, :10]
+        pp = [ppxf(tpl, galaxy, noise, velscale, start, quiet=True, float32=single, **kwargs)
+              for single in [False, True]]
+        assert pp[1].star_rfft.dtype == np.complex64 and pp[1].matrix.dtype == np.float32
+        sol = [np.hstack(p.sol) for p in pp]
+        assert np.all(np.abs(sol[1] - sol[0]) < 1e-3*np.hstack(pp[0].error))
+        assert abs(pp[1].chi2/pp[0].chi2 - 1) < 1e-4
+
+#------------------------------------------------------------------------
+
+def test_covariance():
+    """
+    Fits with a covariance matrix, dense or sparse, are solved with the
+    Cholesky factor: a diagonal covariance is equivalent to the error
+    vector, and banded covariances agree with the explicit inverse factor
+
+    """
+    templates, galaxy, noise, velscale = synthetic_spectrum()
+    ref = ppxf(templates, galaxy, noise, velscale, [100., 100.], moments=4, quiet=True)
+    pp = ppxf(templates, galaxy, np.diag(noise**2), velscale, [100., 100.], moments=4, quiet=True)
+    assert np.allclose(pp.sol, ref.sol, rtol=1e-8, atol=1e-10)
+
+    npix = galaxy.size
+    band = sparse.diags([0.1, 0.3, 1., 0.3, 0.1], [-2, -1, 0, 1, 2], shape=(npix, npix))*noise[0]**2
+    dense = band.toarray()
+    np.random.seed(2)
+    x = np.random.normal(size=(npix, 3))
+    for cov, banded in [(band, True), (dense, True), (dense + 1e-3*noise[0]**2, False)]:
+        pp = ppxf(templates, galaxy, cov, velscale, [100., 100.], moments=4, quiet=True)
+        assert pp.whitening.banded == banded
+        lower = linalg.cholesky(sparse.csr_matrix(cov).toarray(), lower=True)
+        for trans in [False, True]:
+            assert np.allclose(pp.whitening.solve(x, trans),
+                               linalg.solve(lower.T if trans else lower, x))
+        assert np.allclose(pp.sol[:2], ref.sol[:2], rtol=1e-3)
+
+#------------------------------------------------------------------------
+
+def test_ppxf_batch():
+    """
+    The batch fits agree with separate ppxf fits of each spectrum, within
+    the accuracy allowed by the convergence tolerance
+
+    """
+    templates, galaxy, noise, velscale = synthetic_batch(ngas=3)
+    component = [0]*10 + [1]*3
+    for kwargs in [dict(moments=4, mdegree=3), dict(moments=[4, 2], component=component),
+                   dict(moments=2, oversample=3, sky=templates[:1500, :1], batch_size=3)]:
+        start = [[100., 100.], [100., 50.]] if 'component' in kwargs else [100., 100.]
+        tpl = templates if 'component' in kwargs else templates[:, :10]
+        pb = ppxf_batch(tpl, galaxy, noise, velscale, start, quiet=True, **kwargs)
+        kwargs.pop('batch_size', None)
+        for j in range(galaxy.shape[1]):
+            pp = ppxf(tpl, galaxy[:, j], noise[:, j], velscale, start, quiet=True, **kwargs)
+            sol, error = np.hstack(pp.sol), np.hstack(pp.error)
+            assert np.all(np.abs(pb.sol[j] - sol) < 0.2*error)
+            assert np.allclose(pb.error[j], error, rtol=0.05)
+            assert np.allclose(pb.bestfit[:, j], pp.bestfit, atol=0.1*noise[0, 0])
+            assert abs(pb.chi2[j]/pp.chi2 - 1) < 1e-3
+
+#------------------------------------------------------------------------
+
+def test_mc_errors():
+    """
+    The Monte Carlo errors agree with the formal ppxf errors and are
+    reproducible with a seed. With early stopping, the simulations are the
+    first ones of the full run
+
+    """
+    templates, galaxy, noise, velscale = synthetic_spectrum(noise=0.02)
+    pp = ppxf(templates, galaxy, noise, velscale, [100., 100.], moments=4, quiet=True)
+    kwargs = dict(nsim=100, seed=1, block=20, moments=4)
+    error, sol = mc_errors(templates, pp.bestfit, noise, velscale, pp.sol[:2], **kwargs)
+    assert sol.shape == (100, 4)
+    assert np.all(np.abs(error/(pp.error*np.sqrt(pp.chi2)) - 1) < 0.3)
+    assert np.array_equal(mc_errors(templates, pp.bestfit, noise, velscale, pp.sol[:2], **kwargs)[1], sol)
+    error1, sol1 = mc_errors(templates, pp.bestfit, noise, velscale, pp.sol[:2], rtol=0.2, **kwargs)
+    assert len(sol1) < len(sol) and np.allclose(sol1, sol[:len(sol1)])
+
+    # At low S/N the h3, h4 errors are those of serial fits with BIAS=0,
+    # which are not reduced by the penalty towards a Gaussian LOSVD
+    #
+    templates, galaxy, noise, velscale = synthetic_spectrum(noise=0.2)
+    pp = ppxf(templates, galaxy, noise, velscale, [100., 100.], moments=4, quiet=True)
+    error, sol = mc_errors(templates, pp.bestfit, noise, velscale, pp.sol[:2], **kwargs)
+    rng = np.random.RandomState(1)
+    sims = pp.bestfit[:, None] + noise[:, None]*rng.standard_normal((pp.bestfit.size, 100))
+    ref = np.array([ppxf(templates, sim, noise, velscale, pp.sol[:2], moments=4,
+                         bias=0., quiet=True).sol for sim in sims.T])
+    error0 = 1.4826*np.median(np.abs(ref - np.median(ref, 0)), 0)
+    assert np.allclose(error, error0, rtol=0.05)
+
+#------------------------------------------------------------------------
+
+def test_parallel_jacobian():
+    """
+    The finite-difference derivatives computed by MPFIT with a thread or
+    process pool give the same fit as the serial ones, also when cleaning.
+    The ppxf object, which is sent once to the processes, can be pickled
+
+    """
+    templates, galaxy, noise, velscale = synthetic_spectrum()
+    kwargs = dict(moments=4, mdegree=3, quiet=True, autoderivative=True)
+    pp = ppxf(templates, galaxy, noise, velscale, [100., 100.], **kwargs)
+    for executor in [ThreadPoolExecutor(3), ProcessPoolExecutor(2), multiprocessing.Pool(2)]:
+        with executor:
+            pp1 = ppxf(templates, galaxy, noise, velscale, [100., 100.],
+                       executor=executor, **kwargs)
+        assert np.allclose(pp1.sol, pp.sol, rtol=0, atol=1e-6*np.max(pp.error))
+        assert np.allclose(pp1.weights, pp.weights)
+
+    pp = ppxf(templates, galaxy, noise, velscale, [100., 100.], clean=True, **kwargs)
+    with ProcessPoolExecutor(2) as executor:
+        pp1 = ppxf(templates, galaxy, noise, velscale, [100., 100.],
+                   clean=True, executor=executor, **kwargs)
+    assert np.array_equal(pp1.goodpixels, pp.goodpixels)
+    assert np.allclose(pp1.sol, pp.sol, rtol=0, atol=1e-6*np.max(pp.error))
+
+    pp2 = pickle.loads(pickle.dumps(pp))
+    assert np.array_equal(pp2.bestfit, pp.bestfit) and pp2.fft.name == pp.fft.name
+
+#------------------------------------------------------------------------
+
+def test_least_squares():
+    """
+    The scipy.optimize.least_squares optimizer finds the minimum of MPFIT,
+    also with fixed parameters and when called as a user-supplied optimizer
+
+    """
+    templates, galaxy, noise, velscale = synthetic_spectrum(ngas=3)
+    component = [0]*10 + [1]*3
+    for kwargs in [dict(moments=4, mdegree=5), dict(moments=4, autoderivative=True),
+                   dict(moments=[4, -2], component=component, optimizer=least_squares_fit)]:
+        start = [[100., 100.], [150., 120.]] if 'component' in kwargs else [100., 100.]
+        tpl = templates if 'component' in kwargs else templates[:, :10]
+        optimizer = kwargs.pop('optimizer', 'least_squares')
+        pp = [ppxf(tpl, galaxy, noise, velscale, start, quiet=True, optimizer=opt, **kwargs)
+              for opt in ['mpfit', optimizer]]
+        sol, err = [np.hstack(p.sol) for p in pp], np.hstack(pp[0].error)
+        assert np.all(np.abs(sol[1] - sol[0]) <= 0.1*err)
+        assert np.allclose(np.hstack(pp[1].error), err, rtol=0.05)
+        assert abs(pp[1].chi2/pp[0].chi2 - 1) < 1e-3 and pp[1].nfev > 0
+        if 'component' in kwargs:
+            assert np.array_equal(pp[1].sol[1], [150., 120.])
+
+#------------------------------------------------------------------------
+
+def losvd_loop(pars, moments, vsyst, x, nspec):
+    """ LOSVDs computed one kinematic component and side at a time """
+    losvd = np.empty((x.size, len(moments), nspec))
+    vj = np.append(0, np.cumsum(moments)[:-1])
+    for j, p in enumerate(vj):
+        for k in range(nspec):
+            s = 1 if k == 0 else -1 # s=+1 for left spectrum, s=-1 for right one
+            w = (x - (vsyst + s*pars[p]))/pars[p+1]
+            w2 = w**2
+            gauss = np.exp(-0.5*w2)
+            losvd[:, j, k] = gauss/gauss.sum()
+            if moments[j] > 2:
+                poly = 1 + s*pars[p+2]/np.sqrt(3)*(w*(2*w2-3)) \
+                         + pars[p+3]/np.sqrt(24)*(w2*(4*w2-12)+3)
+                if moments[j] == 6:
+                    poly += s*pars[p+4]/np.sqrt(60)*(w*(w2*(4*w2-20)+15)) \
+                          + pars[p+5]/np.sqrt(720)*(w2*(w2*(8*w2-60)+90)-15)
+                losvd[:, j, k] *= poly
+    return losvd
+
+#------------------------------------------------------------------------
+
+def test_losvd_kernels():
+    """
+    The LOSVDs of all components and sides evaluated together reproduce
+    the loop, including the reflection for two-sided fitting
+
+    """
+    x = np.linspace(-40, 40, 241)
+    for moments in [[2], [4], [6, 2], [2, 4, 6]]:
+        pars = np.concatenate([[3.5*j - 2, 4. + j, 0.05, -0.04, 0.03, 0.02][:mj]
+                               for j, mj in enumerate(moments)])
+        for nspec in [1, 2]:
+            losvd = _losvd_kernels(pars, moments, 2.5, x, nspec)
+            assert np.allclose(losvd, losvd_loop(pars, moments, 2.5, x, nspec), rtol=1e-13, atol=1e-16)
+
+#------------------------------------------------------------------------
+
+def test_analytic_losvd():
+    """
+    The analytic Fourier transform of the LOSVD and its derivatives agree
+    with the sampled ones for well resolved LOSVDs, and recover sigma below
+    one pixel, where the sampled LOSVD fails
+
+    """
+    npad, dx = 2048, 40
+    x = np.arange(-dx, dx + 1.)
+    omega = 2*np.pi*np.arange(npad//2 + 1)/npad
+    for moments in [[2], [4], [6, 2]]:
+        pars = np.concatenate([[3.3 - 5*j, 4. + j, 0.05, -0.04, 0.02, 0.03][:mj]
+                               for j, mj in enumerate(moments)])
+        losvd = np.zeros((npad, len(moments), 1))
+        losvd[:x.size] = _losvd_kernels(pars, moments, 0., x, 1)
+        losvd_rfft = np.fft.rfft(np.roll(losvd, -dx, axis=0), axis=0)
+        assert np.allclose(_losvd_kernels(pars, moments, 0., omega, 1, rfft=True),
+                           losvd_rfft, rtol=0, atol=1e-13)
+
+    templates, galaxy, noise, velscale = synthetic_spectrum(ngas=3)
+    component = [0]*10 + [1]*3
+    cases = [(dict(moments=4, mdegree=3), [7.2, 6.1, 0.04, -0.02, 0.01, -0.02, 0.03]),
+             (dict(moments=6, oversample=3), [7.2, 6.1, 0.04, -0.02, 0.01, 0.02]),
+             (dict(moments=[4, 2], component=component), [7.2, 6.1, 0.04, -0.02, 6.9, 0.6])]
+    for kwargs, pars in cases:
+        start = [[100., 100.], [100., 50.]] if 'component' in kwargs else [100., 100.]
+        tpl = templates if 'component' in kwargs else templates[:, :10]
+        pp = ppxf(tpl, galaxy, noise, velscale, start, bias=0, quiet=True,
+                  analytic_losvd=True, **kwargs)
+        pars = np.array(pars)
+        jac = pp._fitfunc(pars, fjac=np.ones_like(pars))[2]
+        num = numerical_jacobian(pp, pars)
+        assert np.allclose(jac, num, rtol=1e-6, atol=1e-6*np.abs(num).max())
+
+    # Galaxy convolved exactly in Fourier space with sigma = 0.4 pixels
+    #
+    spectrum = templates[:, :10].dot(np.random.RandomState(1).uniform(0, 1, 10))
+    omega = 2*np.pi*np.fft.rfftfreq(spectrum.size)
+    galaxy = np.fft.irfft(np.fft.rfft(spectrum)*np.exp(-1j*omega*0.35 - 0.5*(omega*0.4)**2),
+                          spectrum.size)[:galaxy.size]
+    noise = np.full(galaxy.size, 0.002)
+    galaxy += np.random.RandomState(2).normal(0, noise)
+    goodpixels = np.arange(50, galaxy.size - 50)   # avoid the FFT wrap-around
+    pp = ppxf(templates[:, :10], galaxy, noise, velscale, [0., 20.], quiet=True,
+              goodpixels=goodpixels, analytic_losvd=True)
+    assert np.all(np.abs(pp.sol - [7., 8.]) < 3*pp.error)
+
+#------------------------------------------------------------------------
+
+def test_prune_templates():
+    """
+    Pruning keeps the templates with nonzero weight, their grid neighbours
+    and the templates outside the grid, and the refit with the pruned set
+    gives the same solution as the full one
+
+    """
+    grid = np.column_stack(np.unravel_index(np.arange(20), (5, 4)))
+    grid = np.vstack([grid, [[-1, -1], [-1, -1]]])
+    weights = np.zeros(22)
+    weights[[5, 19]] = 1    # Grid points (1, 1) and (4, 3)
+    keep = prune_templates(weights, grid)
+    assert np.array_equal(keep, [0, 1, 2, 4, 5, 6, 8, 9, 10, 14, 15, 18, 19, 20, 21])
+    assert np.array_equal(prune_templates(weights, grid, 0), [5, 19, 20, 21])
+    assert np.array_equal(prune_templates(weights[:20], np.arange(20) % 7), [4, 5, 6, 11, 12, 13, 18, 19])
+
+    templates, grid, galaxy, noise, velscale = synthetic_grid(ngas=3)
+    component = [0]*(templates.shape[1] - 3) + [1]*3
+    kwargs = dict(moments=[4, 2], degree=4, quiet=True)
+    start = [[100., 100.], [100., 50.]]
+    pp0 = ppxf(templates, galaxy, noise, velscale, start, component=component, **kwargs)
+    keep = prune_templates(pp0.weights, grid)
+    assert keep.size < templates.shape[1]
+    pp = ppxf(templates[:, keep], galaxy, noise, velscale, start,
+              component=np.asarray(component)[keep], **kwargs)
+    assert np.allclose(pp.chi2, pp0.chi2, rtol=1e-4)
+    for sol, sol0, err0 in zip(pp.sol, pp0.sol, pp0.error):
+        assert np.all(np.abs(sol - sol0) < 0.01*err0)
+
+#------------------------------------------------------------------------
+
+def test_eigen_templates():
+    """
+    The fit with eigen-templates only depends on the space they span, and
+    with a truncated SVD basis spanning the library the kinematics are
+    consistent with the nonnegative fit of the full library
+
+    """
+    templates, grid, galaxy, noise, velscale = synthetic_grid(15, 7)
+    u, s, vt = np.linalg.svd(templates, full_matrices=False)
+    assert np.sum(s[5:]**2) < 1e-20*np.sum(s**2)   # The library has rank 5
+    basis = u[:, :5]*s[:5]
+    rotation = linalg.qr(np.random.RandomState(0).randn(5, 5))[0]
+    kwargs = dict(moments=4, quiet=True)
+    pp0 = ppxf(templates, galaxy, noise, velscale, [100., 100.], **kwargs)
+    pp1 = ppxf(basis.dot(rotation), galaxy, noise, velscale, [100., 100.], eigen_templates=True, **kwargs)
+    pp = ppxf(basis, galaxy, noise, velscale, [100., 100.], eigen_templates=True, **kwargs)
+    assert pp.positive
+    assert np.all(np.abs(pp.sol - pp1.sol) < 1e-3*pp1.error)
+    assert np.allclose(pp.bestfit, pp1.bestfit, rtol=1e-6)
+    assert np.all(np.abs(pp.sol - pp0.sol) < pp0.error)
+    assert np.any(pp.weights < 0)
+
+    # A negative template is detected
+    #
+    pp = ppxf(-basis, galaxy, noise, velscale, [100., 100.], eigen_templates=True, **kwargs)
+    assert pp.positive
+    pp = ppxf(basis[:, 1:], galaxy, noise, velscale, [100., 100.], eigen_templates=True,
+              degree=10, **kwargs)
+    assert not pp.positive
+
+    try:
+        ppxf(basis, galaxy, noise, velscale, [100., 100.], eigen_templates=True, regul=1., **kwargs)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('REGUL with EIGEN_TEMPLATES must raise ValueError')
+
+#------------------------------------------------------------------------
+
+def test_xcorr_kinematics():
+    """
+    The cross-correlation recovers the velocity and roughly the dispersion,
+    gives the same results for a batch of spectra and single spectra, and
+    leads ppxf to the correct minimum from a distant first guess
+
+    """
+    cache = rfft_cache()
+    sols = [(1400., 180.), (-830., 270.), (-190., 50.), (150., 120.)]
+    galaxy = []
+    for sol in sols:
+        templates, gal, noise, velscale = synthetic_spectrum(npix=3000, sol=sol + (0.03, -0.02), noise=0.03)
+        galaxy.append(gal)
+        start, verr, r = xcorr_kinematics(templates, gal, velscale, cache=cache)
+        assert abs(start[0] - sol[0]) < max(5*verr, 0.2*sol[1])
+        assert abs(start[1] - sol[1]) < 0.5*sol[1]
+        assert r > 5
+    assert cache.misses == 1
+
+    sol, verr, r = xcorr_kinematics(templates, np.column_stack(galaxy), velscale, cache=cache)
+    start = xcorr_kinematics(templates, galaxy[0], velscale, cache=cache)[0]
+    assert sol.shape == (2, len(sols)) and np.allclose(sol[:, 0], start)
+
+    pp = ppxf(templates, galaxy[0], noise, velscale, start, moments=4, quiet=True)
+    assert np.all(np.abs(pp.sol[:2] - sols[0]) < 5*pp.error[:2])
+
+#------------------------------------------------------------------------
+
+def test_clean():
+    """
+    The normal equations updated after the removal of the outliers give the
+    same NNLS solution, and CLEAN removes the sky residual and gives the
+    same solution as a fit of the final GOODPIXELS without CLEAN
+
+    """
+    A = np.random.RandomState(5).rand(300, 12)
+    b = A.dot(np.random.RandomState(6).uniform(-0.5, 1, 12))
+    flag = np.arange(12) < 3
+    good = np.arange(300) % 17 > 0
+    out = ~good
+    normal = (A.T.dot(A) - A[out].T.dot(A[out]), A.T.dot(b) - A[out].T.dot(b[out]))
+    assert np.allclose(nnls_flags(A[good], b[good], flag, normal=normal),
+                       nnls_flags(A[good], b[good], flag), rtol=1e-10, atol=1e-12)
+
+    templates, galaxy, noise, velscale = synthetic_spectrum(npix=3000, noise=0.02)
+    for seed in range(3):
+        lam, gal = sky_residuals(galaxy, velscale, seed=seed)
+        kwargs = dict(moments=4, mdegree=4, quiet=True)
+        pp = ppxf(templates, gal, noise, velscale, [100., 100.], clean=True, **kwargs)
+        assert not np.any(np.abs(lam[pp.goodpixels] - 5577.34) < 0.5)  # Core of the sky line
+        pp0 = ppxf(templates, gal, noise, velscale, [100., 100.], goodpixels=pp.goodpixels, **kwargs)
+        assert np.all(np.abs(pp.sol - pp0.sol) < 0.2*pp0.error)
+
+    # No refit at the solution, also with a parameter pegged at its limit
+    # (zero error), and always a refit when MPFIT returned no errors
+    #
+    pp = ppxf(templates, galaxy, noise, velscale, [100., 100.], moments=4, quiet=True)
+    mp = type('mpfit', (), {})()
+    mp.params = np.append(pp.sol[:2]/velscale, pp.sol[2:])
+    mp.perror = np.append(pp.error[:2]/velscale, pp.error[2:])
+    parinfo = [{'fixed': 0}]*4
+    assert pp._converged(mp, parinfo)
+    mp.perror[3] = 0
+    assert pp._converged(mp, parinfo)
+    mp.perror = None
+    assert not pp._converged(mp, parinfo)
+
+#------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    test_batched_convolution()
+    test_analytic_jacobian()
+    test_nnls_flags()
+    test_regularization_matrix()
+    test_rfft_cache()
+    test_fft_backend()
+    test_float32()
+    test_covariance()
+    test_ppxf_batch()
+    test_mc_errors()
+    test_parallel_jacobian()
+    test_least_squares()
+    test_losvd_kernels()
+    test_analytic_losvd()
+    test_prune_templates()
+    test_eigen_templates()
+    test_xcorr_kinematics()
+    test_clean()
@@ -0,0 +1,62 @@
+##############################################################################
+#
+# Tests of the columnar store of pPXF results
+#
+##############################################################################
+
+from __future__ import print_function
+
+import os
+import tempfile
+
+import numpy as np
+
+from ppxf import ppxf
+from ppxf_store import ResultStore, write_store
+from test_ppxf import synthetic_spectrum
+
+#------------------------------------------------------------------------
+
+def test_result_store():
+    """
+    Fits with one and two kinematic components are read back unchanged,
+    with the dtype of each array, and the templates shared by the fits
+    are stored once
+
+    """
+    templates, galaxy, noise, velscale = synthetic_spectrum(npix=1500, ngas=3)
+    component = [0]*10 + [1]*3
+    results = []
+    for j, kwargs in enumerate([dict(moments=4), dict(moments=[4, 2], component=component),
+                                dict(moments=2, degree=-1, mdegree=4)]):
+        start = [[100., 100.], [100., 50.]] if 'component' in kwargs else [100., 100.]
+        pp = ppxf(templates, galaxy, noise, velscale, start, quiet=True, **kwargs)
+        pp.spec = "spec{0}.fits".format(j)
+        pp.w = np.arange(galaxy.size, dtype=np.float32 if j == 1 else float)
+        results.append(pp)
+
+    filename = os.path.join(tempfile.mkdtemp(), "results.npz")
+    write_store(filename, iter(results))
+    store = ResultStore(filename)
+    assert len(store) == 3 and "spec1.fits" in store
+    assert np.array_equal(store.column("chi2"), [pp.chi2 for pp in results])
+    assert np.array_equal(store.column("sol")[:, 0, :2], [np.hstack(pp.sol)[:2] for pp in results])
+    assert np.isnan(store.column("sol")[0, 1]).all() and np.isnan(store.column("sol")[2, 0, 2:]).all()
+    assert [k for k in store.npz.files if k.startswith("star/")] == ["star/0"]
+
+    for pp in results:
+        pp1 = store.load(pp.spec)
+        assert np.array_equal(np.hstack(pp1.sol), np.hstack(pp.sol))
+        assert np.array_equal(np.hstack(pp1.error), np.hstack(pp.error))
+        assert type(pp1.sol) is type(pp.sol)
+        for att in ["galaxy", "noise", "bestfit", "goodpixels", "matrix", "weights", "star", "w"]:
+            assert np.array_equal(getattr(pp1, att), getattr(pp, att))
+            assert getattr(pp1, att).dtype == getattr(pp, att).dtype
+        assert isinstance(pp1.matrix, np.memmap)
+        assert pp1.degree == pp.degree and pp1.ncomp == pp.ncomp
+        assert hasattr(pp1, "mpolyweights") == hasattr(pp, "mpolyweights")
+
+#------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    test_result_store()